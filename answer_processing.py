@@ -1,17 +1,198 @@
-from transformers import pipeline
-from llama_cpp import Llama
-
-def ask_question(question, model_path = "models/llama-2-7b.Q4_K_M.gguf"):
-    
-    llm = Llama(model_path=model_path, verbose=False)
-    print("Asking the question \"%s\" to %s (wait, it can take some time...)" % (question, model_path))
-    output = llm(
-        question, # Prompt
-        max_tokens=32, # Generate up to 32 tokens
-        stop=["Q:", "\n"], # Stop generating just before the model would generate a new question
-        echo=False # Echo the prompt back in the output
-    )
-    return output['choices'][0]['text']        
+import json
+import re
+import time
+
+from model_registry import get_model
+from tracing import count, span
+
+DEFAULT_MODEL_PATH = "models/llama-2-7b.Q4_K_M.gguf"
+
+class LlamaEngine:
+    """
+    Answers questions with one resident llama context.
+
+    The questions can be preceded by a fixed preamble (e.g. a few-shot prompt). The preamble is evaluated once,
+    its KV state is saved and restored whenever the context no longer starts with it, so every question only
+    pays for evaluating its own tokens. llama_cpp also reuses the longest common token prefix with the previous
+    prompt, which ask_many takes advantage of by answering similar questions one after the other.
+
+    For every question the prompt evaluation time (until the first token) and the generation time are recorded
+    in self.report.
+
+    Args:
+        model_path (str): Path of the gguf model.
+        preamble (str): Text put in front of every question.
+        max_tokens (int): Maximum number of generated tokens.
+        stop (list): Strings that end the generation.
+        temperature (float): Sampling temperature.
+        seed (int): Sampling seed, when set every question is answered with this seed so the answers do not depend on the order.
+        n_threads (int): Number of threads llama uses, None lets llama decide.
+        n_ctx (int): Context size in tokens.
+    """
+    
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, preamble='', max_tokens=32, stop=("Q:", "\n"),
+                 temperature=0.8, seed=None, n_threads=None, n_ctx=512):
+        self.model_path = model_path
+        self.preamble = preamble
+        self.max_tokens = max_tokens
+        self.stop = list(stop)
+        self.temperature = temperature
+        self.seed = seed
+        self.n_threads = n_threads
+        self.n_ctx = n_ctx
+        self.prefix_tokens = None
+        self.prefix_state = None
+        self.report = []
+    
+    @property
+    def llm(self):
+        return get_model('llm', model_path=self.model_path, n_ctx=self.n_ctx, n_threads=self.n_threads, seed=self.seed)
+    
+    def warm_up(self):
+        """
+        Loads the model and evaluates the preamble before the first question.
+        """
+        self._restore_prefix()
+    
+    def _restore_prefix(self):
+        if not self.preamble:
+            return
+        llm = self.llm
+        if self.prefix_tokens is None:
+            self.prefix_tokens = llm.tokenize(self.preamble.encode('utf-8'))
+        
+        n = len(self.prefix_tokens)
+        if llm.n_tokens >= n and list(llm.input_ids[:n]) == self.prefix_tokens:
+            return
+        
+        if self.prefix_state is None:
+            llm.reset()
+            llm.eval(self.prefix_tokens)
+            self.prefix_state = llm.save_state()
+        else:
+            llm.load_state(self.prefix_state)
+    
+    def _prompt_tokens(self, question):
+        llm = self.llm
+        if not self.preamble:
+            return llm.tokenize(question.encode('utf-8'))
+        #tokenize the question separately so the prompt always starts with exactly the cached preamble tokens
+        return self.prefix_tokens + llm.tokenize(question.encode('utf-8'), add_bos=False)
+    
+    def ask(self, question):
+        """
+        Answers a single question.
+
+        Returns:
+            str: The generated text.
+        """
+        llm = self.llm
+        print("Asking the question \"%s\" to %s (wait, it can take some time...)" % (question, self.model_path))
+        self._restore_prefix()
+        tokens = self._prompt_tokens(question)
+        
+        #number of prompt tokens that are already in the context and do not have to be evaluated again
+        cached_tokens = 0
+        for cached, token in zip(llm.input_ids[:llm.n_tokens], tokens):
+            if cached != token:
+                break
+            cached_tokens += 1
+        
+        settings = {'max_tokens': self.max_tokens, 'stop': self.stop, 'temperature': self.temperature, 'echo': False}
+        if self.seed is not None:
+            settings['seed'] = self.seed
+        
+        text = ''
+        completion_tokens = 0
+        with span('llm.ask', prompt_tokens=len(tokens), cached_prompt_tokens=cached_tokens) as current:
+            count('model_calls.llm')
+            start = time.perf_counter()
+            first_token = None
+            for chunk in llm(tokens, stream=True, **settings):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                text += chunk['choices'][0]['text']
+                completion_tokens += 1
+            end = time.perf_counter()
+            current.set(completion_tokens=completion_tokens)
+        if first_token is None:
+            first_token = end
+        
+        self.report.append({'question': question,
+                            'prompt_tokens': len(tokens),
+                            'cached_prompt_tokens': cached_tokens,
+                            'completion_tokens': completion_tokens,
+                            'prompt_eval_seconds': first_token - start,
+                            'generation_seconds': end - first_token})
+        return text
+    
+    def ask_many(self, questions):
+        """
+        Answers a list of questions. They are asked in sorted order, so questions that start the same way
+        follow each other and reuse each other's KV state, the answers are returned in input order.
+
+        Returns:
+            list: The generated text for every question.
+        """
+        answers = [None] * len(questions)
+        for i in sorted(range(len(questions)), key=lambda i: questions[i]):
+            answers[i] = self.ask(questions[i])
+        return answers
+    
+    def write_report(self, path):
+        """
+        Writes the timing report as JSON lines, one line per question.
+        """
+        with open(path, 'w') as outfile:
+            for entry in self.report:
+                outfile.write(json.dumps(entry) + '\n')
+    
+    def report_summary(self):
+        """
+        Returns:
+            dict: Number of questions and the total prompt evaluation and generation time.
+        """
+        return {'questions': len(self.report),
+                'prompt_tokens': sum(entry['prompt_tokens'] for entry in self.report),
+                'cached_prompt_tokens': sum(entry['cached_prompt_tokens'] for entry in self.report),
+                'prompt_eval_seconds': sum(entry['prompt_eval_seconds'] for entry in self.report),
+                'generation_seconds': sum(entry['generation_seconds'] for entry in self.report)}
+
+_engine = None
+
+def configure_engine(**settings):
+    """
+    Replaces the engine used by ask_question, the settings are passed on to LlamaEngine.
+    """
+    global _engine
+    _engine = LlamaEngine(**settings)
+    return _engine
+
+def set_engine(engine):
+    """
+    Replaces the engine with any object with the LlamaEngine interface (ask_many, warm_up, report, report_summary),
+    e.g. recorded answers in benchmarks.
+    """
+    global _engine
+    _engine = engine
+    return _engine
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = LlamaEngine()
+    return _engine
+
+def ask_question(question, model_path = None):
+    
+    engine = get_engine()
+    if model_path is not None and model_path != getattr(engine, 'model_path', None):
+        #a one-off engine with the same settings, the shared engine (and its preamble state) is left alone
+        engine = LlamaEngine(model_path=model_path, preamble=getattr(engine, 'preamble', ''),
+                             max_tokens=getattr(engine, 'max_tokens', 32), stop=getattr(engine, 'stop', ("Q:", "\n")),
+                             temperature=getattr(engine, 'temperature', 0.8), seed=getattr(engine, 'seed', None),
+                             n_threads=getattr(engine, 'n_threads', None), n_ctx=getattr(engine, 'n_ctx', 512))
+    return engine.ask(question)
          
 def classify_question(doc):
     """
@@ -37,29 +218,153 @@ def classify_question(doc):
     # Default to YES/NO if no specific rules match
     return "YES/NO"    
 
-def extract_yes_no(answer):
-    
-    #First try to extract simple answers without having to use the complex classifier to save time and resources.
-    if answer.strip().lower().startswith('yes'):
+# the yes/no classifier is a cascade, the cheapest tier that is confident settles the answer
+NO_YES_NO_ANSWER = 'answer makes no sense. (couldnt find an affirmative or negative statement)'
+SMALL_YES_NO_MODEL = 'typeform/distilbert-base-uncased-mnli'
+SMALL_YES_NO_CONFIDENCE = 0.9
+LARGE_YES_NO_MODEL = 'facebook/bart-large-mnli'
+LARGE_YES_NO_CONFIDENCE = 0.6
+MAX_MEMOIZED_ANSWERS = 100000
+# answers an NLI model classifies per forward pass
+NLI_BATCH_SIZE = 16
+
+#answers that open with an affirmation or denial, e.g. "Yes, ...", "Nope.", "False: ..."
+#words that also open unrelated phrases ("not only", "right now", "sure enough", "never mind", "correct me if")
+#only count on their own, an emphasis followed by "not" ("absolutely not") is a denial and "no doubt" is not one
+YES_START = re.compile(r"^(yes|yeah|yep|yup|affirmative)\b"
+                       r"|^(exactly|precisely|indeed|absolutely|certainly|definitely|of course)\b(?!\s+not\b)"
+                       r"|^(true|right|sure|correct)([.,!]|$)")
+NO_START = re.compile(r"^(no(?!\s+(doubt|question)\b)|nope|nah|false|incorrect|wrong|negative)\b"
+                      r"|^(exactly|precisely|indeed|absolutely|certainly|definitely|of course) not\b"
+                      r"|^(not|never)([.,!]|$)")
+#statements anywhere in the answer, the negated ones are checked first because "is not true" contains "true"
+NO_PHRASE = re.compile(r"\b(is|was|are|were|that's|it's|does|do|did)( not|n't) (true|correct|right|accurate|the case)\b"
+                       r"|\b(that|this|it|which|statement|claim) (is|was) (false|incorrect|wrong|a myth|a misconception)\b"
+                       r"|\b(that's|it's) (false|incorrect|wrong)\b")
+YES_PHRASE = re.compile(r"\b(that|this|it|which|statement|claim) (is|was) (true|correct|right|accurate|the case)\b"
+                        r"|\b(that's|it's) (true|correct|right)\b")
+
+yes_no_stats = {'memoized': 0, 'lexical': 0, 'small_nli': 0, 'large_nli': 0}
+_yes_no_memo = dict()
+
+def normalize_answer(answer):
+    return ' '.join(answer.lower().replace('\u2019', "'").split())
+
+def lexical_yes_no(text):
+    """
+    Settles clear answers with regular expressions.
+
+    Args:
+        text (str): The normalized answer.
+
+    Returns:
+        str: 'yes', 'no' or None when the answer is unclear (no match or contradicting matches).
+    """
+    if YES_START.match(text):
         return 'yes'
-    if answer.strip().lower().startswith('no'):
+    if NO_START.match(text):
         return 'no'
+    negative = NO_PHRASE.search(text) is not None
+    positive = YES_PHRASE.search(text) is not None
+    if negative != positive:
+        return 'no' if negative else 'yes'
+    return None
+
+def nli_yes_no_batch(answers, model_name):
+    """
+    Classifies answers as yes or no with one call of the zero-shot pipeline.
+
+    Returns:
+        list: (label, score) of every answer.
+    """
+    count('model_calls.nli')
+    results = get_model('zero_shot', model_name=model_name)(list(answers), ["yes", "no"], batch_size=NLI_BATCH_SIZE)
+    if isinstance(results, dict):
+        results = [results]
+    return [(result["labels"][0], result["scores"][0]) for result in results]
+
+def nli_yes_no(answer, model_name):
     
-    #if not, use the zer-shot classifier
+    return nli_yes_no_batch([answer], model_name)[0]
+
+def classify_yes_no_batch(answers):
+    """
+    Runs answers through the classifier tiers, every NLI model classifies all answers that reach it at once.
+
+    Returns:
+        list: (label, tier) of every answer.
+    """
+    labels = [None] * len(answers)
+    unclear = []
+    for i, answer in enumerate(answers):
+        label = lexical_yes_no(normalize_answer(answer))
+        if label is not None:
+            labels[i] = (label, 'lexical')
+        else:
+            unclear.append(i)
+    if not unclear:
+        return labels
+
+    unsure = []
+    for i, (label, score) in zip(unclear, nli_yes_no_batch([answers[i] for i in unclear], SMALL_YES_NO_MODEL)):
+        if score >= SMALL_YES_NO_CONFIDENCE:
+            labels[i] = (label, 'small_nli')
+        else:
+            unsure.append(i)
+    if not unsure:
+        return labels
+
+    for i, (label, score) in zip(unsure, nli_yes_no_batch([answers[i] for i in unsure], LARGE_YES_NO_MODEL)):
+        # Add a threshold for confidence
+        labels[i] = (label if score > LARGE_YES_NO_CONFIDENCE else NO_YES_NO_ANSWER), 'large_nli'
+    return labels
+
+def classify_yes_no(answer):
     
-    classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
-    labels = ["yes", "no"]
-    result = classifier(answer, labels)
+    return classify_yes_no_batch([answer])[0]
+
+def extract_yes_no_batch(answers):
+    """
+    Extracts 'yes' or 'no' from every answer.
+
+    The answers go through tiers that are ever more expensive: regular expressions for clear affirmations,
+    denials and (negated) statements like "that is correct", then a small distilled NLI model, and only when that
+    one is not confident the large NLI model. Every NLI tier classifies the answers of the whole batch in one call.
+    Results are memoized by the normalized answer text and yes_no_stats counts how many answers every tier settled.
+
+    Returns:
+        list: 'yes', 'no' or NO_YES_NO_ANSWER (when the large model is not confident either) for every answer.
+    """
+    keys = [normalize_answer(answer) for answer in answers]
+    #answers that are not memoized yet, the same answer twice in a batch is classified once
+    new = dict()
+    for key, answer in zip(keys, answers):
+        if key not in _yes_no_memo and key not in new:
+            new[key] = answer
     
-    # Extract scores
-    scores = result["scores"]
-    labels = result["labels"]
-    best_label = labels[0]
-    best_score = scores[0]
+    classified = dict()
+    for key, (label, tier) in zip(new, classify_yes_no_batch(list(new.values()))):
+        yes_no_stats[tier] += 1
+        count('yes_no.' + tier)
+        classified[key] = label
     
-    # Add a threshold for confidence
-    if best_score > 0.6:  # Confidence threshold
-        return best_label
+    labels = []
+    for key in keys:
+        if key in new:
+            #the first time a new answer comes up it was counted above, repeats count as memoized
+            del new[key]
+        else:
+            yes_no_stats['memoized'] += 1
+            count('yes_no.memoized')
+        labels.append(classified[key] if key in classified else _yes_no_memo[key])
     
-    else:
-        return 'answer makes no sense. (couldnt find an affirmative or negative statement)'
\ No newline at end of file
+    if len(_yes_no_memo) + len(classified) > MAX_MEMOIZED_ANSWERS:
+        _yes_no_memo.clear()
+    _yes_no_memo.update(classified)
+    return labels
+
+def extract_yes_no(answer):
+    """
+    Extracts 'yes' or 'no' from an answer, see extract_yes_no_batch.
+    """
+    return extract_yes_no_batch([answer])[0]
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+from entity_extractor import (MAX_IDS_PER_REQUEST, cache_summaries, fetch_entities_summary,
+                              generate_candidates_api, get_cached_summaries, get_local_candidates,
+                              mention_context, select_candidates)
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_REQUESTS_PER_SECOND = 20
+
+
+class AsyncRateLimiter:
+    """
+    Token bucket that lets at most `rate` requests start per second (with bursts up to `burst`).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncLinker:
+    """
+    Links the mentions of many texts at once: all candidate searches run concurrently, followed by
+    concurrent batched wbgetentities requests for every candidate that is not cached yet.
+
+    The blocking lookups from entity_extractor run in worker threads, so they keep using the wikidata cache.
+    Mentions and entities in the offline label index are resolved without any request.
+
+    Args:
+        max_in_flight (int): Maximum number of requests running at the same time.
+        requests_per_second (float): Maximum number of requests started per second, 0 disables the limit.
+        languages (str): Language of the returned labels.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                 languages='en'):
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.languages = languages
+
+    async def _call(self, semaphore, limiter, function, *args):
+        async with semaphore:
+            await limiter.acquire()
+            return await asyncio.to_thread(function, *args)
+
+    async def link_groups(self, groups, contexts=None):
+        """
+        Link several lists of mentions (e.g. the question and the answer entities).
+
+        Args:
+            groups (list): Lists of mentions (str).
+            contexts (list): The text (or parsed doc) of every group, used by the embedding linker.
+
+        Returns:
+            list: For every group a list of (mention, label, url) tuples, like entity_extractor.link_entities.
+        """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        limiter = AsyncRateLimiter(self.requests_per_second)
+
+        mentions = list(dict.fromkeys(mention for group in groups for mention in group))
+
+        #mentions found in the offline label index do not need a search request
+        candidates_per_mention = {mention: get_local_candidates(mention) for mention in mentions}
+        remote_mentions = [mention for mention in mentions if not candidates_per_mention[mention]]
+        candidate_lists = await asyncio.gather(
+            *[self._call(semaphore, limiter, generate_candidates_api, mention) for mention in remote_mentions])
+        candidates_per_mention.update(zip(remote_mentions, candidate_lists))
+
+        all_candidates = [c for candidates in candidates_per_mention.values() for c in candidates]
+        entity_infos, missing = get_cached_summaries(all_candidates, self.languages)
+        batches = [missing[start:start + MAX_IDS_PER_REQUEST] for start in range(0, len(missing), MAX_IDS_PER_REQUEST)]
+        fetched_batches = await asyncio.gather(
+            *[self._call(semaphore, limiter, fetch_entities_summary, batch, self.languages) for batch in batches])
+        for batch, fetched in zip(batches, fetched_batches):
+            cache_summaries(batch, fetched, self.languages)
+            entity_infos.update(fetched)
+
+        #the mentions of all groups are resolved together, so the embedding linker encodes once per call
+        contexts = contexts or [None] * len(groups)
+        all_mentions = [mention for group in groups for mention in group]
+        best_candidates = iter(select_candidates(
+            all_mentions, [mention_context(mention, context) for group, context in zip(groups, contexts)
+                           for mention in group],
+            candidates_per_mention, entity_infos))
+
+        linked_groups = []
+        for group in groups:
+            linked_entities = []
+            for mention in group:
+                best_candidate = next(best_candidates)
+                if best_candidate:
+                    linked_entities.append((mention, best_candidate['label'], best_candidate['url']))
+                else:
+                    linked_entities.append((mention, None, None))
+            linked_groups.append(linked_entities)
+        return linked_groups
+
+
+async def link_entity_groups_async(groups, contexts=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                                   requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """
+    Links several lists of mentions concurrently, see AsyncLinker.link_groups. Await this from async code.
+    """
+    linker = AsyncLinker(max_in_flight=max_in_flight, requests_per_second=requests_per_second)
+    return await linker.link_groups(groups, contexts)
+
+
+def link_entity_groups(groups, contexts=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                       requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """
+    Synchronous wrapper around link_entity_groups_async for callers without an event loop, async code has to
+    await link_entity_groups_async instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(link_entity_groups_async(groups, contexts, max_in_flight=max_in_flight,
+                                                    requests_per_second=requests_per_second))
+    raise RuntimeError('link_entity_groups cannot be called from a running event loop, '
+                       'await link_entity_groups_async instead')
+
+
+def link_entities_concurrent(entities, **kwargs):
+    """
+    Drop-in replacement for entity_extractor.link_entities that links all mentions concurrently.
+    """
+    return link_entity_groups([entities], **kwargs)[0]
@@ -0,0 +1,461 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from wikidata_index import iter_dump_entities
+from wikidata_standin import WikidataStandIn, synthetic_questions, synthetic_world
+
+DEFAULT_DATASETS = ['qa', 'example', 'synthetic:200']
+PERCENTILES = (50, 95, 99)
+
+# functions of main.py that are timed, stage name -> function name
+STAGES = {'llm': 'generate_answers',
+          'analyse': 'analyse_answers',
+          'link': 'link_entity_groups',
+          'yes_no': 'extract_yes_no_batch',
+          'fact_check': 'check_facts',
+          'triplets': 'extract_triplets_batch',
+          'entailment': 'check_statements'}
+
+# seconds main.py may take for --help, invalid arguments and runs with nothing to do
+DEFAULT_STARTUP_BUDGET = 0.5
+# libraries main.py must not import at startup, only the stages that use them do
+HEAVY_MODULES = ('spacy', 'transformers', 'torch', 'llama_cpp', 'sentence_transformers', 'SPARQLWrapper',
+                 'pandas', 'numpy', 'requests')
+
+
+class RecordedEngine:
+    """
+    Stand-in for the llm engine that answers with recorded answers, so benchmarks measure everything but the llm.
+
+    Args:
+        answers (dict): question text -> recorded answer, unknown questions get an empty answer.
+    """
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.report = []
+
+    def warm_up(self):
+        pass
+
+    def ask_many(self, questions):
+        return [self.answers.get(question, '') for question in questions]
+
+    def report_summary(self):
+        return {'questions': 0}
+
+
+def read_expected(path):
+    """
+    Reads 'q_id<TAB>correct|incorrect' lines, the expected correctness labels of a dataset.
+    """
+    expected = dict()
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                if '\t' in line:
+                    q_id, label = line.rstrip('\n').split('\t', 1)
+                    expected[q_id] = label.strip()
+    return expected
+
+
+def load_qa_dataset(path='QuestionsAndAnswers.txt'):
+    """
+    Questions with recorded answers, one 'question:/:answer' per line.
+    """
+    questions = []
+    answers = dict()
+    with open(path, 'r', encoding='utf-8') as infile:
+        for line in infile:
+            if ':/:' not in line:
+                continue
+            question, answer = line.rstrip('\n').split(':/:', 1)
+            questions.append((f'question-{len(questions) + 1:03d}', question))
+            answers[question] = answer
+    return {'questions': questions, 'answers': answers, 'expected': read_expected(path + '.expected')}
+
+
+def load_input_dataset(path, recorded_output=None):
+    """
+    Questions in the input format of main.py, the recorded answers are the R"..." lines of an earlier output file.
+    """
+    questions = []
+    with open(path, 'r', encoding='utf-8') as infile:
+        for line in infile:
+            if line.startswith('question-') and '\t' in line:
+                q_id, q_text = line.rstrip('\n').split('\t', 1)
+                questions.append((q_id, q_text))
+
+    answers = dict()
+    if recorded_output and os.path.exists(recorded_output):
+        texts = dict(questions)
+        with open(recorded_output, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                q_id, _, field = line.rstrip('\n').partition('\t')
+                if field.startswith('R"') and q_id in texts:
+                    answers[texts[q_id]] = field[2:-1]
+    return {'questions': questions, 'answers': answers, 'expected': read_expected(path + '.expected')}
+
+
+def load_dataset(spec, countries):
+    """
+    Args:
+        spec (str): 'qa', 'example', 'synthetic:N' (N made-up questions with known correctness) or the path of an
+            input file in the format of main.py.
+        countries (list): The countries of the synthetic world served by the stand-in.
+    """
+    if spec == 'qa':
+        return load_qa_dataset()
+    if spec == 'example':
+        return load_input_dataset('example_input2.txt', recorded_output='output2.txt')
+    if spec.startswith('synthetic:'):
+        generated = synthetic_questions(countries, int(spec.split(':', 1)[1]))
+        return {'questions': [(q_id, question) for q_id, question, _, _ in generated],
+                'answers': {question: answer for _, question, answer, _ in generated},
+                'expected': {q_id: expected for q_id, _, _, expected in generated}}
+    return load_input_dataset(spec)
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of values, 0.0 for no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize_timings(values):
+    summary = {'calls': len(values), 'total_seconds': sum(values),
+               'mean_seconds': sum(values) / len(values) if values else 0.0}
+    for q in PERCENTILES:
+        summary[f'p{q}_seconds'] = percentile(values, q)
+    return summary
+
+
+def accuracy(results, expected):
+    """
+    Compares the correctness labels of the results with the expected ones, questions without a label
+    (errors, N/A) count as wrong.
+    """
+    labelled = [result for result in results if result['q_id'] in expected]
+    right = sum(1 for result in labelled if result.get('correctness') == expected[result['q_id']])
+    return {'labelled': len(labelled), 'right': right, 'accuracy': right / len(labelled) if labelled else None}
+
+
+def instrument(module, timings):
+    """
+    Wraps the STAGES functions of module so every call is timed into timings[stage]. main.py calls all of them
+    through its own globals, so wrapping them there is enough.
+    """
+    for stage, name in STAGES.items():
+        function = getattr(module, name)
+        timings[stage] = []
+
+        def timed(*args, _function=function, _stage=stage, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                timings[_stage].append(time.perf_counter() - start)
+
+        setattr(module, name, timed)
+
+
+def run_dataset(dataset, settings, main_argv):
+    """
+    Runs the pipeline of main.py over a dataset in this process and measures it.
+
+    Returns:
+        dict: Questions, seconds, questions per second, per stage and per batch latencies, peak RSS,
+        HTTP calls and accuracy.
+    """
+    if settings['api_url']:
+        os.environ['WIKIDATA_API_URL'] = settings['api_url']
+        os.environ['WIKIDATA_SPARQL_URL'] = settings['sparql_url']
+    import main as pipeline
+    from answer_processing import set_engine
+    from http_client import get_client
+    from util import ResultWriter
+
+    timings = dict()
+    instrument(pipeline, timings)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args = pipeline.build_parser().parse_args(['-of', os.path.join(tmp, 'output.txt'),
+                                                  '--cache-path', os.path.join(tmp, 'cache.sqlite'), *main_argv])
+        pipeline.configure_run(args)
+        if settings['llm'] == 'stub':
+            set_engine(RecordedEngine(dataset['answers']))
+        else:
+            pipeline.configure_llm(args)
+
+        results = []
+        batch_seconds = []
+        start = time.perf_counter()
+        batch_start = start
+        with ResultWriter(args.outfile) as writer:
+            for batch_results in pipeline.process_batches(iter(dataset['questions']), args):
+                pipeline.write_results(batch_results, writer)
+                results.extend(batch_results)
+                now = time.perf_counter()
+                batch_seconds.append(now - batch_start)
+                batch_start = now
+        seconds = time.perf_counter() - start
+
+    #ru_maxrss is in kilobytes on linux and in bytes on macos
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return {'questions': len(results),
+            'seconds': seconds,
+            'questions_per_second': len(results) / seconds if seconds else 0.0,
+            'stages': {stage: summarize_timings(values) for stage, values in timings.items()},
+            'batches': summarize_timings(batch_seconds),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20,
+            'http': get_client().stats(),
+            'accuracy': accuracy(results, dataset['expected'])}
+
+
+def _run_in_child(dataset, settings, main_argv, queue):
+    try:
+        queue.put(run_dataset(dataset, settings, main_argv))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run_isolated(dataset, settings, main_argv):
+    """
+    Runs a dataset in a fresh process, so the peak RSS, caches and HTTP counts belong to that dataset only.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(dataset, settings, main_argv, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def compare_runs(baseline, current, max_slowdown=0.1, max_accuracy_drop=0.0):
+    """
+    Flags datasets that got slower, less accurate or make more HTTP calls than in the baseline run.
+
+    Args:
+        baseline (dict): An earlier benchmark result.
+        current (dict): The new benchmark result.
+        max_slowdown (float): Allowed relative drop in questions per second and rise in p95 stage latency.
+        max_accuracy_drop (float): Allowed absolute drop in accuracy.
+
+    Returns:
+        list: A message per regression.
+    """
+    regressions = []
+    for name, result in current['datasets'].items():
+        base = baseline.get('datasets', {}).get(name)
+        if not base or 'error' in base or 'error' in result:
+            continue
+
+        if result['questions_per_second'] < base['questions_per_second'] * (1 - max_slowdown):
+            regressions.append(f"{name}: {result['questions_per_second']:.2f} questions/s, "
+                               f"was {base['questions_per_second']:.2f}")
+
+        for stage, stats in result['stages'].items():
+            base_p95 = base['stages'].get(stage, {}).get('p95_seconds', 0.0)
+            #sub-millisecond stages are too noisy to compare
+            if stats['p95_seconds'] > 0.001 and stats['p95_seconds'] > base_p95 * (1 + max_slowdown) and base_p95:
+                regressions.append(f"{name}: stage {stage} p95 {stats['p95_seconds'] * 1000:.1f} ms, "
+                                   f"was {base_p95 * 1000:.1f} ms")
+
+        new_accuracy, old_accuracy = result['accuracy']['accuracy'], base['accuracy']['accuracy']
+        if new_accuracy is not None and old_accuracy is not None and new_accuracy < old_accuracy - max_accuracy_drop:
+            regressions.append(f'{name}: accuracy {new_accuracy:.3f}, was {old_accuracy:.3f}')
+
+        new_requests = sum(stats['requests'] for stats in result['http'].values())
+        old_requests = sum(stats['requests'] for stats in base['http'].values())
+        if new_requests > old_requests * (1 + max_slowdown):
+            regressions.append(f'{name}: {new_requests} HTTP requests, was {old_requests}')
+    return regressions
+
+
+def _startup_commands(directory):
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    infile = os.path.join(directory, 'input.txt')
+    outfile = os.path.join(directory, 'output.txt')
+    with open(infile, 'w') as f:
+        f.write('question-1\tIs Rome the capital of Italy?\n')
+    #an output with a journal that lists every question, so --resume has nothing to do
+    record = 'question-1\tR"yes"\nquestion-1\tA"yes"\nquestion-1\tC"correct"\n'
+    with open(outfile, 'w') as f:
+        f.write(record)
+    with open(outfile + '.journal', 'w') as f:
+        f.write(f'question-1\t{len(record.encode())}\n')
+    return {'import': [sys.executable, '-c', 'import main'],
+            'help': [sys.executable, main_path, '--help'],
+            'missing_input': [sys.executable, main_path, '-if', os.path.join(directory, 'missing.txt'),
+                              '-of', outfile],
+            'resume_done': [sys.executable, main_path, '-if', infile, '-of', outfile, '--resume']}
+
+
+def measure_startup(repeat=5, top=10):
+    """
+    Times the main.py commands that have to return before any model is loaded (best of repeat runs) and
+    checks which heavy libraries importing main.py pulls in.
+
+    Returns:
+        dict: 'seconds' per command, the 'heavy_modules' imported by main.py and its 'slowest_imports'
+        (module, cumulative seconds) from python -X importtime.
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    seconds = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, command in _startup_commands(directory).items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                subprocess.run(command, cwd=cwd, capture_output=True)
+                times.append(time.perf_counter() - start)
+            seconds[name] = min(times)
+
+    check = f'import json, sys, main; print(json.dumps(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)))'
+    heavy = json.loads(subprocess.run([sys.executable, '-c', check], cwd=cwd, capture_output=True, text=True,
+                                      check=True).stdout)
+
+    imports = []
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=cwd,
+                            capture_output=True, text=True).stderr
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((parts[2].strip(), int(parts[1]) / 1e6))
+    imports.sort(key=lambda item: -item[1])
+    return {'seconds': seconds, 'heavy_modules': heavy, 'slowest_imports': imports[:top]}
+
+
+def check_startup(startup, budget=DEFAULT_STARTUP_BUDGET):
+    """
+    Returns:
+        list: A message per startup command over the budget and per heavy module imported at startup.
+    """
+    problems = [f'{name}: {seconds:.3f} s, the budget is {budget:.3f} s'
+                for name, seconds in startup['seconds'].items() if seconds > budget]
+    problems += [f'importing main.py imports {module}' for module in startup['heavy_modules']]
+    return problems
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the question answering and fact checking pipeline. '
+                    'Arguments after -- are passed on to main.py, e.g. -- --batch-size 8 --pipeline')
+    parser.add_argument('--datasets', nargs='+', default=DEFAULT_DATASETS,
+                        help="'qa', 'example', 'synthetic:N' or input files in the format of main.py")
+    parser.add_argument('--llm', choices=['stub', 'real'], default='stub',
+                        help='answer with the recorded answers of the datasets or run the llm')
+    parser.add_argument('--wikidata', choices=['standin', 'live'], default='standin',
+                        help='serve wikidata from a local stand-in or use the real endpoints')
+    parser.add_argument('--dump', help='JSON dump (subset) served by the stand-in next to the synthetic world')
+    parser.add_argument('--countries', type=int, default=50, help='size of the synthetic world')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in delays every response')
+    parser.add_argument('--output', default='benchmark_results.json', help='where the JSON results are written')
+    parser.add_argument('--compare', help='earlier results to check for regressions')
+    parser.add_argument('--max-slowdown', type=float, default=0.1,
+                        help='allowed relative slowdown before a regression is flagged')
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.0,
+                        help='allowed absolute accuracy drop before a regression is flagged')
+    parser.add_argument('--startup', action='store_true',
+                        help='only check that main.py starts (--help, invalid input, nothing to resume) within the budget '
+                             'without importing heavy libraries')
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET,
+                        help='seconds every startup command may take')
+    return parser
+
+
+def main():
+    argv = sys.argv[1:]
+    main_argv = []
+    if '--' in argv:
+        argv, main_argv = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = build_parser().parse_args(argv)
+
+    if args.startup:
+        startup = measure_startup()
+        for name, seconds in startup['seconds'].items():
+            print(f'{name}: {seconds * 1000:.0f} ms')
+        print('Slowest imports: ' + ', '.join(f'{module} {seconds * 1000:.0f} ms'
+                                              for module, seconds in startup['slowest_imports']))
+        problems = check_startup(startup, args.startup_budget)
+        for problem in problems:
+            print(f'REGRESSION {problem}')
+        if problems:
+            sys.exit(1)
+        print(f'Startup is within {args.startup_budget:.3f} s.')
+        return
+
+    entities, countries = synthetic_world(args.countries)
+    standin = None
+    settings = {'llm': args.llm, 'api_url': None, 'sparql_url': None}
+    if args.wikidata == 'standin':
+        if args.dump:
+            entities = entities + list(iter_dump_entities(args.dump))
+        standin = WikidataStandIn(entities, latency=args.latency).start()
+        settings.update(api_url=standin.api_url, sparql_url=standin.sparql_url)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+              'main_args': main_argv,
+              'datasets': dict()}
+    try:
+        for spec in args.datasets:
+            dataset = load_dataset(spec, countries)
+            print(f"Benchmarking {spec} ({len(dataset['questions'])} questions)...")
+            if standin is not None:
+                standin.reset_stats()
+            result = run_isolated(dataset, settings, main_argv)
+            if standin is not None:
+                result['standin_requests'] = standin.stats()
+            report['datasets'][spec] = result
+            if 'error' in result:
+                print(f"{spec} failed:\n{result['error']}")
+            else:
+                print(f"{spec}: {result['questions_per_second']:.2f} questions/s, "
+                      f"peak RSS {result['peak_rss_mb']:.0f} MB, accuracy {result['accuracy']['accuracy']}")
+    finally:
+        if standin is not None:
+            standin.stop()
+
+    with open(args.output, 'w', encoding='utf-8') as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as infile:
+            baseline = json.load(infile)
+        regressions = compare_runs(baseline, report, max_slowdown=args.max_slowdown,
+                                   max_accuracy_drop=args.max_accuracy_drop)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions compared to {args.compare}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+from urllib.parse import urlparse
+
+DEFAULT_CASSETTE_PATH = 'wikidata.cassette'
+
+# parameters that do not change the answer and are left out of the request key
+IGNORED_PARAMS = {'maxlag'}
+
+
+def request_key(url, params=None):
+    """
+    Key of a GET request: a hash of the url path and the sorted parameters. The host is left out so a
+    cassette can be replayed against a mirror or a stand-in on another port.
+
+    Returns:
+        bytes: 16 byte digest.
+    """
+    parsed = urlparse(url)
+    canonical = [parsed.path,
+                 sorted((str(key), str(value)) for key, value in (params or {}).items() if key not in IGNORED_PARAMS)]
+    return hashlib.sha256(json.dumps(canonical).encode('utf-8')).digest()[:16]
+
+
+class Cassette:
+    """
+    Recorded wikidata responses, a SQLite table indexed by request key with the zlib compressed JSON response
+    and the time the request took.
+
+    Several processes can record into the same cassette (WAL mode).
+
+    Args:
+        path (str): The cassette file.
+        readonly (bool): Open for replaying only.
+    """
+
+    def __init__(self, path=DEFAULT_CASSETTE_PATH, readonly=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if readonly:
+            self.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                            'key BLOB PRIMARY KEY, endpoint TEXT, body BLOB, seconds REAL) WITHOUT ROWID')
+            self.db.commit()
+
+    def put(self, key, endpoint, data, seconds):
+        body = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, endpoint, body, seconds))
+            self.db.commit()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (response, recorded seconds) or None when the request was not recorded.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT body, seconds FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0])), row[1]
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of recorded responses per endpoint.
+        """
+        with self.lock:
+            return dict(self.db.execute('SELECT endpoint, COUNT(*) FROM responses GROUP BY endpoint').fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
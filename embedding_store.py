@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+import numpy as np
+
+from model_registry import get_model
+from tracing import count
+
+DEFAULT_EMBED_MODEL = 'sentence-transformers/all-mpnet-base-v2'
+DEFAULT_STORE_DIR = os.environ.get('EMBEDDING_STORE', 'embeddings')
+DTYPES = ('float32', 'float16')
+# vectors a VectorCache keeps in memory before it starts over (they stay on disk)
+MAX_MEMORY_VECTORS = 100000
+# keys per SQL query, below the SQLite variable limit
+SQL_CHUNK = 500
+
+
+def store_key(model_name, texts, dtype='float32'):
+    """
+    Key of a store: a hash of the model name, the dtype and every text, so a changed model or relation list
+    never serves stale vectors.
+    """
+    digest = hashlib.sha256()
+    for part in [model_name, dtype, *texts]:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:20]
+
+
+def normalize_rows(vectors):
+    """
+    Returns the rows of vectors scaled to unit length as float32 (zero rows stay zero).
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _save_atomic(path, write):
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(handle, 'wb') as outfile:
+        write(outfile)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore:
+    """
+    Unit length embeddings (one row per text) with a vectorized cosine top-k search.
+
+    Args:
+        vectors (np.ndarray): (n, dim) float32/float16 rows of unit length, usually memory-mapped.
+        ids (list): Optional id per row (e.g. property ids), the row numbers are used otherwise.
+    """
+
+    def __init__(self, vectors, ids=None):
+        self.vectors = vectors
+        self.ids = list(ids) if ids is not None else list(range(len(vectors)))
+
+    @classmethod
+    def open(cls, directory, key):
+        """
+        Memory-maps the store saved under key in directory.
+        """
+        with open(os.path.join(directory, key + '.json'), 'r', encoding='utf-8') as infile:
+            meta = json.load(infile)
+        vectors = np.load(os.path.join(directory, key + '.npy'), mmap_mode='r')
+        return cls(vectors, meta['ids'])
+
+    @classmethod
+    def save(cls, directory, key, vectors, ids, model_name, dtype='float32'):
+        """
+        Normalizes vectors, writes them as directory/key.npy with a key.json metadata file and opens the result.
+        """
+        os.makedirs(directory, exist_ok=True)
+        vectors = normalize_rows(vectors).astype(dtype)
+        meta = {'model': model_name, 'dtype': dtype, 'count': len(vectors), 'dim': int(vectors.shape[1]),
+                'ids': list(ids)}
+        _save_atomic(os.path.join(directory, key + '.npy'), lambda f: np.save(f, vectors))
+        _save_atomic(os.path.join(directory, key + '.json'), lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        return cls.open(directory, key)
+
+    def top_k(self, queries, k=10, chunk_size=8192):
+        """
+        Cosine top-k search for a batch of query vectors.
+
+        The store is scanned in chunks of chunk_size rows, so float16 stores are only converted chunk by chunk.
+
+        Args:
+            queries (np.ndarray): (dim,) or (n, dim) query vectors, they are normalized here.
+            k (int): Number of results per query.
+            chunk_size (int): Number of store rows scored at once.
+
+        Returns:
+            tuple: (indices, scores), both (n, k) arrays with the best match first.
+        """
+        queries = normalize_rows(queries)
+        k = min(k, len(self.vectors))
+        if k <= 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.vectors), chunk_size):
+            chunk = np.asarray(self.vectors[start:start + chunk_size], dtype=np.float32)
+            scores = np.concatenate([best_scores, queries @ chunk.T], axis=1)
+            indices = np.concatenate([best_indices, np.broadcast_to(np.arange(start, start + len(chunk)),
+                                                                     (len(queries), len(chunk)))], axis=1)
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k] if scores.shape[1] > k else \
+                np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_indices = np.take_along_axis(indices, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def search(self, queries, k=10):
+        """
+        Like top_k, but returns the ids.
+
+        Returns:
+            list: Per query a list of (id, score) tuples, best match first.
+        """
+        indices, scores = self.top_k(queries, k=k)
+        return [[(self.ids[i], float(score)) for i, score in zip(row_indices, row_scores)]
+                for row_indices, row_scores in zip(indices, scores)]
+
+    def __len__(self):
+        return len(self.vectors)
+
+
+def encode_texts(texts, model_name=DEFAULT_EMBED_MODEL, batch_size=64):
+    """
+    Embeds texts with the shared sentence-transformers model.
+
+    Returns:
+        np.ndarray: (len(texts), dim) float32 unit length rows.
+    """
+    model = get_model('sentence_embedder', model_name=model_name)
+    return model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+
+
+def load_or_build_store(texts, ids=None, model_name=DEFAULT_EMBED_MODEL, directory=DEFAULT_STORE_DIR,
+                        dtype='float32', encode=encode_texts):
+    """
+    Opens the store for these texts and model, embedding and saving them first if it does not exist yet.
+
+    Args:
+        texts (list): The texts to embed, one row each.
+        ids (list): Optional id per text.
+        model_name (str): The sentence-transformers model.
+        directory (str): Where the stores are kept.
+        dtype (str): 'float32' or 'float16' (half the size on disk and in the page cache).
+        encode (callable): encode(texts, model_name=...) -> (n, dim) array.
+
+    Returns:
+        EmbeddingStore: The memory-mapped store.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f'dtype must be one of {DTYPES}')
+    key = store_key(model_name, texts, dtype)
+    if os.path.exists(os.path.join(directory, key + '.json')):
+        return EmbeddingStore.open(directory, key)
+
+    print(f"Embedding {len(texts)} texts with '{model_name}'...")
+    vectors = encode(texts, model_name=model_name)
+    return EmbeddingStore.save(directory, key, vectors, ids if ids is not None else range(len(texts)),
+                               model_name, dtype=dtype)
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()[:8]
+
+
+class VectorCache:
+    """
+    Persistent key -> embedding cache in SQLite, e.g. wikidata id -> vector of its label and description.
+
+    Every vector is stored with a digest of the text it embeds, so it is embedded again when the text changes
+    (e.g. an edited description). Vectors are stored as float16 and returned as float32 unit length rows.
+
+    Args:
+        path (str): The SQLite file, None keeps the vectors in memory only.
+        model_name (str): The sentence-transformers model, vectors of other models are not mixed up.
+    """
+
+    def __init__(self, path, model_name=DEFAULT_EMBED_MODEL):
+        self.path = path
+        self.model_name = model_name
+        self.memory = dict()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path or ':memory:', timeout=30, check_same_thread=False)
+        if path:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS vectors ('
+                        'model TEXT, key TEXT, digest BLOB, vector BLOB, PRIMARY KEY (model, key)) WITHOUT ROWID')
+        self.db.commit()
+
+    def get_many(self, texts):
+        """
+        Args:
+            texts (dict): key -> text.
+
+        Returns:
+            dict: key -> vector for the keys whose vector of the same text is cached.
+        """
+        digests = {key: text_digest(text) for key, text in texts.items()}
+        found = dict()
+        with self.lock:
+            for key, digest in digests.items():
+                entry = self.memory.get(key)
+                if entry is not None and entry[0] == digest:
+                    found[key] = entry[1]
+            missing = [key for key in digests if key not in found]
+            for start in range(0, len(missing), SQL_CHUNK):
+                chunk = missing[start:start + SQL_CHUNK]
+                rows = self.db.execute(f'SELECT key, digest, vector FROM vectors WHERE model = ? AND key IN '
+                                       f'({",".join("?" * len(chunk))})', [self.model_name, *chunk]).fetchall()
+                for key, digest, vector in rows:
+                    if digest == digests[key]:
+                        found[key] = np.frombuffer(vector, dtype=np.float16).astype(np.float32)
+                        self._remember(key, digest, found[key])
+        return found
+
+    def put_many(self, texts, vectors):
+        """
+        Stores the vectors of texts (key -> text), in the same order.
+        """
+        rows = []
+        with self.lock:
+            for (key, text), vector in zip(texts.items(), normalize_rows(vectors)):
+                digest = text_digest(text)
+                self._remember(key, digest, vector)
+                rows.append((self.model_name, key, digest, vector.astype(np.float16).tobytes()))
+            self.db.executemany('INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def _remember(self, key, digest, vector):
+        if len(self.memory) >= MAX_MEMORY_VECTORS:
+            self.memory.clear()
+        self.memory[key] = (digest, vector)
+
+    def embed(self, texts, encode=encode_texts):
+        """
+        Returns the vectors of texts (key -> text), the ones that are not cached are encoded together in one call.
+
+        Returns:
+            np.ndarray: (len(texts), dim) float32 unit length rows in the order of texts.
+        """
+        found = self.get_many(texts)
+        missing = {key: text for key, text in texts.items() if key not in found}
+        count('vector_cache.hits', len(found))
+        if missing:
+            count('vector_cache.misses', len(missing))
+            vectors = encode(list(missing.values()), model_name=self.model_name)
+            self.put_many(missing, vectors)
+            found.update(zip(missing, normalize_rows(vectors)))
+        return np.stack([found[key] for key in texts]) if texts else np.zeros((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM vectors WHERE model = ?', (self.model_name,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
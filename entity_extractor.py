@@ -1,15 +1,70 @@
-import requests
-import spacy
+import os
 
+from http_client import get_json
+from model_registry import get_model
+from wikidata_cache import cached, get_cache
+from wikidata_index import DEFAULT_LABEL_INDEX, LabelIndex
+from tracing import count
 
-def extract_answer_entity(answer, linked_entities):
-    # Process the sentence with spaCy
-    nlp=spacy.load('en_core_web_md')
-    doc = nlp(answer)
+WIKIDATA_API_URL = os.environ.get('WIKIDATA_API_URL', 'https://www.wikidata.org/w/api.php')
+
+# wbgetentities accepts at most 50 ids per request (for clients without the apihighlimits right)
+MAX_IDS_PER_REQUEST = 50
+
+# spaCy components every stage can do without:
+# answers only need the dependency parse (subjects, sentences) and the entities, not the tags and lemmas,
+# questions need everything because classify_question looks at the pos and lemma of the root
+ANSWER_DISABLE = ['tagger', 'attribute_ruler', 'lemmatizer']
+QUESTION_DISABLE = []
+
+# offline label index (see wikidata_index.py), used before the API when configured
+_label_index = None
+_label_index_path = DEFAULT_LABEL_INDEX
+
+# how a mention picks one of its candidates: the most sitelinks, or the candidate whose label and description
+# are most similar to the sentence of the mention
+LINKERS = ('popularity', 'embedding')
+DEFAULT_LINKER_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+DEFAULT_ENTITY_VECTOR_CACHE = os.environ.get('ENTITY_VECTOR_CACHE', 'entity_vectors.sqlite')
+# weight of the sitelink prior in the embedding linker, it settles candidates with near identical descriptions
+POPULARITY_WEIGHT = 0.1
+# about the number of wikipedias, log(1 + sitelinks) is scaled by log(1 + MAX_SITELINKS)
+MAX_SITELINKS = 350
+
+_linker = 'popularity'
+_linker_model = DEFAULT_LINKER_MODEL
+_vector_cache = None
+_vector_cache_path = DEFAULT_ENTITY_VECTOR_CACHE
+
+
+def parse_texts(texts, disable=(), batch_size=64, n_process=1):
+    """
+    Parse many texts with spaCy in one nlp.pipe call.
+
+    Args:
+        texts (list): The texts to parse.
+        disable (list): Pipeline components that are not needed (e.g. ANSWER_DISABLE).
+        batch_size (int): Number of texts spaCy processes per batch.
+        n_process (int): Number of processes spaCy uses.
+
+    Returns:
+        list: A spacy.tokens.Doc for every text.
+    """
+    nlp = get_model('spacy')
+    count('model_calls.spacy', len(texts))
+    return list(nlp.pipe(texts, disable=disable, batch_size=batch_size, n_process=n_process))
+
+def extract_answer_entity(answer, linked_entities, doc=None):
+    # Process the sentence with spaCy, unless the caller already parsed it
+    if doc is None:
+        nlp = get_model('spacy')
+        with nlp.select_pipes(disable=ANSWER_DISABLE):
+            doc = nlp(answer)
     
-    #check if the answer has several sentences and prioritize the first senctence 
-    if len(list(doc.sents)) >=2:
-        output = extract_answer_entity(next(doc.sents).text, linked_entities)
+    #check if the answer has several sentences and prioritize the first senctence, the parsed sentence is reused
+    sentences = list(doc.sents)
+    if len(sentences) >=2:
+        output = extract_answer_entity(sentences[0].text, linked_entities, doc=sentences[0])
         if isinstance(output, tuple):
             return output
         
@@ -83,41 +138,197 @@ def get_filtered_entities(doc):
     filter = ['DATE', 'TIME', 'PERCENT', 'MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL']
     return [ent for ent in doc.ents if ent.label_ not in filter]
 
-def recognize_entities(text):
+def recognize_entities(text=None, doc=None):
     """
     Perform Named Entity Recognition (NER) on the given text using spaCy.
 
     Args:
-        text (str): The input text.
+        text (str): The input text, only parsed when no doc is given.
+        doc (spacy.tokens.Doc): The already parsed text.
 
     Returns:
         list: A list of recognized entities with their labels.
     """
     
-    nlp = spacy.load("en_core_web_md")
-    doc = nlp(text)
+    if doc is None:
+        nlp = get_model('spacy')
+        with nlp.select_pipes(enable=['tok2vec', 'ner']):
+            doc = nlp(text)
     
     return [ent.text for ent in get_filtered_entities(doc)]
 
-def link_entities(entities):
+def link_entities(entities, context=None):
+    """
+    Link every mention to a candidate with the configured linker (see configure_linker).
+
+    The candidates of all mentions are fetched together with as few wbgetentities requests as possible.
+
+    Args:
+        entities (list): The entity mentions (str) to link.
+        context (str or spacy.tokens.Doc): The text the mentions come from, used by the embedding linker.
+
+    Returns:
+        list: (mention, label, url) tuples, label and url are None when there are no candidates.
+    """
+    candidates_per_mention = {entity: generate_candidates(entity) for entity in entities}
+    entity_infos = get_entities_summary([c for candidates in candidates_per_mention.values() for c in candidates])
+
+    best_candidates = select_candidates(entities, [mention_context(entity, context) for entity in entities],
+                                        candidates_per_mention, entity_infos)
     linked_entities = []
-    for entity in entities:
-        candidates = generate_candidates_api(entity)
-        if candidates:
-            best_candidate = None
-            max_sitelinks = -1
-            for candidate in candidates:
-                entity_info = get_entity_info(candidate)
-                if entity_info['sitelinks'] > max_sitelinks:
-                    best_candidate = entity_info
-                    max_sitelinks = entity_info['sitelinks']
+    for entity, best_candidate in zip(entities, best_candidates):
+        if best_candidate:
             linked_entities.append((entity, best_candidate['label'], best_candidate['url']))
         else:
             linked_entities.append((entity, None, None))
     return linked_entities
 
+def mention_context(mention, context):
+    """
+    Returns the sentence of context (a text or a parsed doc) that contains the mention, the whole text when no
+    sentence does and the mention itself without context.
+    """
+    if context is None:
+        return mention
+    if not hasattr(context, 'sents'):
+        return str(context)
+    sentences = [sentence.text for sentence in context.sents]
+    return next((sentence for sentence in sentences if mention in sentence), context.text)
+
+def select_candidates(mentions, contexts, candidates_per_mention, entity_infos):
+    """
+    Picks the best candidate of every mention with the configured linker.
+
+    Args:
+        mentions (list): The mentions, the same mention can come up with different contexts.
+        contexts (list): The context (see mention_context) of every mention.
+        candidates_per_mention (dict): mention -> candidate ids.
+        entity_infos (dict): id -> summary of the candidates.
+
+    Returns:
+        list: The summary of the chosen candidate of every mention, None when it has no candidates.
+    """
+    if _linker == 'embedding':
+        return select_by_embedding(mentions, contexts, candidates_per_mention, entity_infos)
+    return [select_most_popular(candidates_per_mention[mention], entity_infos) for mention in mentions]
+
+def candidate_text(entity_info):
+    
+    description = entity_info.get('description')
+    if not description or description == 'No description available':
+        return entity_info['label']
+    return f"{entity_info['label']}, {description}"
+
+def select_by_embedding(mentions, contexts, candidates_per_mention, entity_infos):
+    """
+    Picks for every mention the candidate whose label and description are most similar to the mention's
+    sentence, with a small sitelink prior.
+
+    The candidate vectors come from the entity vector cache, the ones that are not cached are encoded together
+    in one call and so are the distinct sentences. All candidates of all mentions are scored with a single
+    similarity matrix, candidates of other mentions are masked out.
+
+    Returns:
+        list: The summary of the chosen candidate of every mention, None when it has no candidates.
+    """
+    import numpy as np
+    from embedding_store import encode_texts
+
+    candidate_ids = list(dict.fromkeys(candidate for mention in mentions
+                                       for candidate in candidates_per_mention[mention] if candidate in entity_infos))
+    if not candidate_ids:
+        return [None] * len(mentions)
+
+    candidate_vectors = get_vector_cache().embed({candidate: candidate_text(entity_infos[candidate])
+                                                  for candidate in candidate_ids})
+    sentences = list(dict.fromkeys(contexts))
+    count('model_calls.embedder')
+    sentence_vectors = encode_texts(sentences, model_name=_linker_model)
+    rows = {sentence: i for i, sentence in enumerate(sentences)}
+    scores = sentence_vectors[[rows[context] for context in contexts]] @ candidate_vectors.T
+
+    sitelinks = np.array([entity_infos[candidate]['sitelinks'] for candidate in candidate_ids], dtype=np.float32)
+    scores += POPULARITY_WEIGHT * np.log1p(sitelinks) / np.log1p(MAX_SITELINKS)
+
+    columns = {candidate: j for j, candidate in enumerate(candidate_ids)}
+    allowed = np.zeros(scores.shape, dtype=bool)
+    for i, mention in enumerate(mentions):
+        allowed[i, [columns[candidate] for candidate in candidates_per_mention[mention] if candidate in columns]] = True
+    scores[~allowed] = -np.inf
+
+    best = scores.argmax(axis=1)
+    return [entity_infos[candidate_ids[j]] if allowed[i, j] else None for i, j in enumerate(best)]
+
+def configure_linker(name='popularity', model_name=DEFAULT_LINKER_MODEL, vector_cache_path=DEFAULT_ENTITY_VECTOR_CACHE):
+    """
+    Chooses the linker ('popularity' or 'embedding'), the sentence-transformers model of the embedding linker and
+    the SQLite file its candidate vectors are cached in (None keeps them in memory only).
+    """
+    global _linker, _linker_model, _vector_cache, _vector_cache_path
+    if name not in LINKERS:
+        raise ValueError(f'linker must be one of {LINKERS}')
+    if _vector_cache is not None:
+        _vector_cache.close()
+    _linker = name
+    _linker_model = model_name
+    _vector_cache = None
+    _vector_cache_path = vector_cache_path
+
+def get_vector_cache():
+    global _vector_cache
+    if _vector_cache is None:
+        from embedding_store import VectorCache
+        _vector_cache = VectorCache(_vector_cache_path, model_name=_linker_model)
+    return _vector_cache
+
+def select_most_popular(candidates, entity_infos):
+    """
+    Returns the info of the candidate with the most sitelinks (the first one on ties), or None.
+    """
+    best_candidate = None
+    max_sitelinks = -1
+    for candidate in candidates:
+        entity_info = entity_infos.get(candidate)
+        if entity_info and entity_info['sitelinks'] > max_sitelinks:
+            best_candidate = entity_info
+            max_sitelinks = entity_info['sitelinks']
+    return best_candidate
+
+def configure_label_index(path):
+    """
+    Use the offline label index at path for candidate generation and entity summaries, None disables it.
+    """
+    global _label_index, _label_index_path
+    if _label_index is not None:
+        _label_index.close()
+    _label_index = None
+    _label_index_path = path
+
+def get_label_index():
+    global _label_index
+    if _label_index is None and _label_index_path:
+        _label_index = LabelIndex(_label_index_path)
+    return _label_index
+
+def get_local_candidates(mention, limit=10):
+    """
+    Returns the candidate ids for a mention from the offline label index, most sitelinks first.
+    Returns an empty list when there is no index or the mention is not in it.
+    """
+    index = get_label_index()
+    if index is None:
+        return []
+    return [entity_id for entity_id, _ in index.lookup(mention, limit=limit)]
+
+def generate_candidates(mention, language="en", limit=10):
+    """
+    Returns the candidate ids for a mention, from the offline label index when possible and from the API otherwise.
+    """
+    return get_local_candidates(mention, limit=limit) or generate_candidates_api(mention, language=language, limit=limit)
+
+@cached('candidates')
 def generate_candidates_api(mention, language="en", limit=10):
-    url = "https://www.wikidata.org/w/api.php"
+    url = WIKIDATA_API_URL
 
     params = {
         "action": "wbsearchentities",
@@ -127,8 +338,7 @@ def generate_candidates_api(mention, language="en", limit=10):
         "limit": limit,
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = get_json(url, params=params)
 
     candidates = []
 
@@ -136,8 +346,9 @@ def generate_candidates_api(mention, language="en", limit=10):
         candidates.append(entity["id"])
     return candidates
 
+@cached('entity')
 def get_entity_info(id, languages='en'):
-    url = "https://www.wikidata.org/w/api.php"
+    url = WIKIDATA_API_URL
 
     params = {
         "action": "wbgetentities",
@@ -146,8 +357,7 @@ def get_entity_info(id, languages='en'):
         "format": "json",
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = get_json(url, params=params)
 
     label = data['entities'][id]['labels'].get('en', {}).get('value', 'No label available')
     description = data['entities'][id]['descriptions'].get('en', {}).get('value', 'No description available')
@@ -160,4 +370,109 @@ def get_entity_info(id, languages='en'):
         base_url = 'https://en.wikipedia.org/wiki/'
         url = base_url + data['entities'][id]['sitelinks']['enwiki']['title'].replace(' ', '_')
 
-    return {'label': label, 'description': description, 'claims': claims, 'sitelinks': sitelinks, 'url': url}
\ No newline at end of file
+    return {'label': label, 'description': description, 'claims': claims, 'sitelinks': sitelinks, 'url': url}
+
+def summarize_entity(entity, languages='en'):
+    """
+    Extracts label, description, sitelink count and english wikipedia url from a wbgetentities entity.
+    """
+    label = entity.get('labels', {}).get(languages, {}).get('value', 'No label available')
+    description = entity.get('descriptions', {}).get(languages, {}).get('value', 'No description available')
+    sitelinks = entity.get('sitelinks', {})
+
+    url = ''
+
+    if sitelinks.get('enwiki'):
+        base_url = 'https://en.wikipedia.org/wiki/'
+        url = base_url + sitelinks['enwiki']['title'].replace(' ', '_')
+
+    return {'label': label, 'description': description, 'sitelinks': len(sitelinks), 'url': url}
+
+def fetch_entities_summary(ids, languages='en'):
+    """
+    Fetches the summaries of at most MAX_IDS_PER_REQUEST ids with a single wbgetentities request.
+
+    Only labels, descriptions and sitelinks are requested, claims are left out to keep the response small.
+
+    Returns:
+        dict: id -> summary, ids that do not exist are left out.
+    """
+    params = {
+        "action": "wbgetentities",
+        "ids": '|'.join(ids),
+        "props": "labels|descriptions|sitelinks",
+        "languages": languages,
+        "format": "json",
+    }
+
+    data = get_json(WIKIDATA_API_URL, params=params)
+
+    summaries = dict()
+    for entity_id, entity in data['entities'].items():
+        if 'missing' in entity:
+            continue
+        #redirected ids are returned under the id of the target entity
+        requested_id = entity.get('redirects', {}).get('from', entity_id)
+        summaries[requested_id] = summarize_entity(entity, languages)
+    return summaries
+
+def get_entities_summary(ids, languages='en'):
+    """
+    Returns the summaries (label, description, sitelinks, url) of many entities.
+
+    Cached entities are served from the wikidata cache, the rest is fetched in batches of MAX_IDS_PER_REQUEST.
+
+    Args:
+        ids (list): Wikidata ids, duplicates are fetched only once.
+        languages (str): Language of the label and description.
+
+    Returns:
+        dict: id -> summary dict, ids that do not exist are left out.
+    """
+    summaries, missing = get_cached_summaries(ids, languages)
+
+    for start in range(0, len(missing), MAX_IDS_PER_REQUEST):
+        batch = missing[start:start + MAX_IDS_PER_REQUEST]
+        fetched = fetch_entities_summary(batch, languages)
+        cache_summaries(batch, fetched, languages)
+        summaries.update(fetched)
+
+    return summaries
+
+def get_cached_summaries(ids, languages='en'):
+    """
+    Looks up entity summaries in the offline label index (english only) and the wikidata cache.
+
+    Returns:
+        tuple: (summaries, missing) with a dict of the known summaries and a list of the unique ids that still have to be fetched.
+    """
+    cache = get_cache()
+    index = get_label_index() if languages == 'en' else None
+    summaries = dict()
+    missing = []
+
+    for entity_id in dict.fromkeys(ids):
+        if index is not None:
+            summary = index.entity(entity_id)
+            if summary:
+                summaries[entity_id] = summary
+                continue
+        if cache is not None:
+            found, summary = cache.get('entity', f'summary:{languages}:{entity_id}')
+            if found:
+                if summary:
+                    summaries[entity_id] = summary
+                continue
+        missing.append(entity_id)
+
+    return summaries, missing
+
+def cache_summaries(ids, fetched, languages='en'):
+    """
+    Stores fetched summaries, ids without a summary are cached as not existing.
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    for entity_id in ids:
+        cache.set('entity', f'summary:{languages}:{entity_id}', fetched.get(entity_id))
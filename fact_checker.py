@@ -1,16 +1,53 @@
-import requests
-from SPARQLWrapper import SPARQLWrapper, JSON
-from transformers import pipeline
-from entity_extractor import extract_answer_entity
+import json
+import re
+
+from entity_extractor import WIKIDATA_API_URL, extract_answer_entity, get_local_candidates
+from http_client import get_json, sparql_query
+from model_registry import get_model
+from tracing import count, span
+from property_index import get_property_index
+from wikidata_cache import cached, get_cache
+
+# limits of one batched VALUES query, the query goes into the URL of a GET request so its length is bounded too
+MAX_TRIPLES_PER_QUERY = 200
+MAX_QUERY_CHARS = 6000
+ENTITY_ID = re.compile(r'^Q\d+$')
+PROPERTY_ID = re.compile(r'^P\d+$')
 
-# Function to parse the generated text and extract the triplets
 def extract_triplets(input_text):
-    
-    triplet_extractor = pipeline('text2text-generation', model='Babelscape/rebel-large', tokenizer='Babelscape/rebel-large')
-    # We need to use the tokenizer manually since we need special tokens.
-    extracted_text = triplet_extractor.tokenizer.batch_decode([triplet_extractor(input_text, return_tensors=True, return_text=False)[0]["generated_token_ids"]])
+    """
+    Extracts (head, type, tail) triplets from a text with REBEL.
+    """
+    return extract_triplets_batch([input_text])[0]
+
+def extract_triplets_batch(texts, batch_size=8):
+    """
+    Extracts triplets from many texts with REBEL, generating for a whole batch of texts at once.
+
+    Args:
+        texts (list): The input texts.
+        batch_size (int): Number of texts that are padded together and generated in one pass.
+
+    Returns:
+        list: For every text a list of {'head', 'type', 'tail'} dicts.
+    """
+    triplet_extractor = get_model('rebel')
+    tokenizer, model = triplet_extractor.tokenizer, triplet_extractor.model
 
-    text = extracted_text[0]
+    triplets = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        inputs = tokenizer(batch, padding=True, truncation=True, return_tensors='pt').to(model.device)
+        generated = model.generate(**inputs)
+        count('model_calls.rebel')
+        # We need to decode manually since we need the special tokens.
+        for extracted_text in tokenizer.batch_decode(generated):
+            triplets.append(parse_triplets(extracted_text))
+    return triplets
+
+# Function to parse the generated text and extract the triplets
+def parse_triplets(text):
+    
     triplets = []
     relation, subject, relation, object_ = '', '', '', ''
     text = text.strip()
@@ -41,6 +78,26 @@ def extract_triplets(input_text):
         triplets.append({'head': subject.strip(), 'type': relation.strip(),'tail': object_.strip()})
     return triplets
 
+@cached('search_id')
+def search_first_id(label: str, search_type: str = 'item') -> str:
+    """
+    Returns the ID of the first wbsearchentities result for label, or None when there are no results.
+    Errors are raised (and therefore not cached).
+    """
+    params = {
+        "action": "wbsearchentities",
+        "type": search_type,
+        "language": "en",
+        "format": "json",
+        "search": label
+    }
+
+    results = get_json(WIKIDATA_API_URL, params=params).get("search", [])
+
+    if results:
+        return results[0]["id"]
+    return None
+
 def get_wikidata_id(label: str) -> str:
     """
     Retrieves the Wikidata ID for an entity or property based on its label.
@@ -51,28 +108,60 @@ def get_wikidata_id(label: str) -> str:
     Returns:
         str: The Wikidata ID (e.g., "Q5" for Human, "P31" for Instance of), or None if not found.
     """
-    url = "https://www.wikidata.org/w/api.php"
-    params = {
-        "action": "wbsearchentities",
-        "language": "en",
-        "format": "json",
-        "search": label
-    }
-
+    #the offline label index returns the most popular item with this label, the API is the fallback
+    local_candidates = get_local_candidates(label, limit=1)
+    if local_candidates:
+        return local_candidates[0]
+    
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        results = response.json().get("search", [])
-        
-        if results:
-            return results[0]["id"]
-        else:
-            print(f"No results found for label: {label}")
-            return None
+        result = search_first_id(label)
     except Exception as e:
         print(f"Error retrieving Wikidata ID: {e}")
         return None
 
+    if result is None:
+        print(f"No results found for label: {label}")
+    return result
+
+# optional semantic fallback for relation labels without an exact match in the property index:
+# (embedding store of the property labels, model name, minimum cosine similarity), see configure_relation_index
+_relation_index = None
+_semantic_property_ids = dict()
+
+def configure_relation_index(store_dir=None, model_name='sentence-transformers/all-mpnet-base-v2', min_score=0.8):
+    """
+    Map relation labels that are not in the property index to the property with the most similar label embedding.
+    The property label embeddings are kept in an embedding store in store_dir, None turns the mapping off.
+    """
+    global _relation_index
+    _semantic_property_ids.clear()
+    property_index = get_property_index()
+    if not store_dir or property_index is None:
+        _relation_index = None
+        return None
+
+    from embedding_store import load_or_build_store
+    ids = sorted(property_index.properties, key=lambda pid: int(pid[1:]))
+    labels = [property_index.properties[pid]['label'] for pid in ids]
+    store = load_or_build_store(labels, ids=ids, model_name=model_name, directory=store_dir)
+    _relation_index = (store, model_name, min_score)
+    return store
+
+def semantic_property_id(label):
+    """
+    Returns:
+        str: The id of the property whose label embedding is most similar to label, or None when it is not
+        similar enough or no relation index is configured.
+    """
+    if _relation_index is None:
+        return None
+    if label not in _semantic_property_ids:
+        from embedding_store import encode_texts
+        store, model_name, min_score = _relation_index
+        matches = store.search(encode_texts([label], model_name=model_name), k=1)[0]
+        _semantic_property_ids[label] = matches[0][0] if matches and matches[0][1] >= min_score else None
+    return _semantic_property_ids[label]
+
 def get_property_id(label: str) -> str:
     """
     Retrieves the Wikidata ID for an entity or property based on its label.
@@ -83,29 +172,192 @@ def get_property_id(label: str) -> str:
     Returns:
         str: The Wikidata ID (e.g., "Q5" for Human, "P31" for Instance of), or None if not found.
     """
-    url = "https://www.wikidata.org/w/api.php"
-    params = {
-        "action": "wbsearchentities",
-        "type": "property",
-        "language": "en",
-        "format": "json",
-        "search": label
-    }
+    #the compiled property index returns the most used property with this label, then the (optional) most similar
+    #property label is tried and the API is the last fallback
+    property_index = get_property_index()
+    local_id = property_index.lookup(label) if property_index else None
+    if local_id:
+        return local_id
+    local_id = semantic_property_id(label)
+    if local_id:
+        return local_id
 
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        results = response.json().get("search", [])
-        
-        if results:
-            return results[0]["id"]
-        else:
-            print(f"No results found for label: {label}")
-            return None
+        result = search_first_id(label, search_type='property')
     except Exception as e:
         print(f"Error retrieving Wikidata ID: {e}")
         return None
 
+    if result is None:
+        print(f"No results found for label: {label}")
+    return result
+
+@cached('ask')
+def ask_triple(entity_id1: str, property_id: str, entity_id2: str) -> bool:
+    """
+    Runs a SPARQL ASK query for the statement (entity_id1, property_id, entity_id2) against the wikidata endpoint.
+    """
+    # Define the SPARQL query
+    query = f"""
+    ASK {{
+      wd:{entity_id1} wdt:{property_id} wd:{entity_id2} .
+    }}
+    """
+
+    response = sparql_query(query)
+    return response.get("boolean", False)
+
+def ask_cache_key(entity_id1, property_id, entity_id2):
+    
+    #the key the cached decorator gives ask_triple, so single and batched checks share their cache entries
+    return json.dumps(['ask_triple', [entity_id1, property_id, entity_id2], []])
+
+def values_query(triples):
+    
+    rows = ' '.join(f'(wd:{s} wdt:{p} wd:{o})' for s, p, o in triples)
+    return f'SELECT ?s ?p ?o WHERE {{ VALUES (?s ?p ?o) {{ {rows} }} ?s ?p ?o . }}'
+
+def split_triples(triples, max_triples=MAX_TRIPLES_PER_QUERY, max_chars=MAX_QUERY_CHARS):
+    """
+    Splits triples into batches that fit in one VALUES query.
+    """
+    batch, size = [], 0
+    for triple in triples:
+        row_size = sum(len(part) for part in triple) + 16
+        if batch and (len(batch) >= max_triples or size + row_size > max_chars):
+            yield batch
+            batch, size = [], 0
+        batch.append(triple)
+        size += row_size
+    if batch:
+        yield batch
+
+def ask_triples(triples):
+    """
+    Checks many (entity id, property id, entity id) statements against the wikidata endpoint with a few
+    SELECT queries that list the statements in a VALUES block, instead of an ASK query per statement.
+
+    Cached answers are reused and new ones are cached under the same keys as ask_triple.
+    Malformed ids are never sent and count as false.
+
+    Returns:
+        list: True or False for every triple, in order.
+    """
+    triples = [tuple(triple) for triple in triples]
+    cache = get_cache()
+    answers = dict()
+    unknown = []
+    for triple in dict.fromkeys(triples):
+        s, p, o = triple
+        if not (ENTITY_ID.match(s) and PROPERTY_ID.match(p) and ENTITY_ID.match(o)):
+            answers[triple] = False
+            continue
+        if cache is not None:
+            found, value = cache.get('ask', ask_cache_key(*triple))
+            if found:
+                answers[triple] = bool(value)
+                continue
+        unknown.append(triple)
+
+    for batch in split_triples(unknown):
+        count('sparql_values_queries')
+        response = sparql_query(values_query(batch))
+        #the bindings are full URIs like http://www.wikidata.org/entity/Q90, the ids are their last part
+        found = {tuple(binding[var]['value'].rsplit('/', 1)[-1] for var in ('s', 'p', 'o'))
+                 for binding in response.get('results', {}).get('bindings', [])}
+        for triple in batch:
+            answers[triple] = triple in found
+            if cache is not None:
+                cache.set('ask', ask_cache_key(*triple), answers[triple])
+
+    return [answers[triple] for triple in triples]
+
+class RemoteSparqlBackend:
+    """
+    Answers entailment checks with (cached) ASK queries against the wikidata SPARQL endpoint,
+    or batched VALUES queries for many checks at once.
+    """
+    
+    def ask(self, entity_id1, property_id, entity_id2):
+        return ask_triple(entity_id1, property_id, entity_id2)
+    
+    def ask_many(self, triples):
+        return ask_triples(triples)
+
+# the backend is_property_entailed uses, anything with an ask(subject, property, object) method works,
+# e.g. a triple_store.TripleStore built from a dump subset
+_entailment_backend = RemoteSparqlBackend()
+
+def configure_entailment_backend(triple_store=None):
+    """
+    Use the local triple store in the given directory for entailment checks, or the SPARQL endpoint when it is None.
+    """
+    global _entailment_backend
+    if triple_store:
+        from triple_store import TripleStore
+        _entailment_backend = TripleStore(triple_store)
+    else:
+        _entailment_backend = RemoteSparqlBackend()
+    return _entailment_backend
+
+def get_entailment_backend():
+    return _entailment_backend
+
+def check_triples(triples):
+    """
+    Checks many (entity id, property id, entity id) statements with the entailment backend, in one go when the
+    backend has an ask_many method and one by one otherwise.
+
+    Returns:
+        list: True or False for every triple, in order.
+    """
+    ask_many = getattr(_entailment_backend, 'ask_many', None)
+    if ask_many is not None:
+        return [bool(answer) for answer in ask_many(triples)]
+    return [bool(_entailment_backend.ask(*triple)) for triple in triples]
+
+def resolve_fact(entity_label1, entity_label2, property_label):
+    """
+    Returns:
+        tuple: (entity id, property id, entity id) of a fact, or None when a label cannot be resolved.
+    """
+    with span('resolve'):
+        entity1 = get_wikidata_id(entity_label1)
+        entity2 = get_wikidata_id(entity_label2)
+        property_id = get_property_id(property_label)
+    if not entity1 or not entity2 or not property_id:
+        return None
+    return entity1, property_id, entity2
+
+def check_facts_batch(facts):
+    """
+    Checks many facts at once, the labels are resolved per fact and all resolved statements are checked
+    together (a few VALUES queries against the SPARQL endpoint instead of an ASK query per fact).
+
+    Args:
+        facts (list): (entity label 1, entity label 2, property label) tuples, like the arguments of
+            is_property_entailed.
+
+    Returns:
+        list: True if the statement of the fact exists, for every fact in order. Facts with labels that
+        cannot be resolved are False.
+    """
+    return check_statements([resolve_fact(*fact) for fact in facts])
+
+def check_statements(triples):
+    """
+    Checks resolved facts (see resolve_fact) together with check_triples, None entries are False.
+    Errors of the backend are printed and make every fact False, like in is_property_entailed.
+    """
+    resolved = [triple for triple in triples if triple is not None]
+    try:
+        with span('entailment', backend=type(_entailment_backend).__name__, statements=len(resolved)):
+            answers = iter(check_triples(resolved))
+    except Exception as e:
+        print(f"Error querying SPARQL: {e}")
+        return [False] * len(triples)
+    return [next(answers) if triple is not None else False for triple in triples]
+
 def is_property_entailed(entity_label1: str, entity_label2: str, property_label: str) -> bool:
     """
     Checks if a given Wikidata property entails a relationship between two entities.
@@ -122,9 +374,10 @@ def is_property_entailed(entity_label1: str, entity_label2: str, property_label:
     print(entity_label2)
     print(property_label)
     # Get the IDs for the entities and property
-    entity1 = get_wikidata_id(entity_label1)
-    entity2 = get_wikidata_id(entity_label2)
-    property_id = get_property_id(property_label)
+    with span('resolve'):
+        entity1 = get_wikidata_id(entity_label1)
+        entity2 = get_wikidata_id(entity_label2)
+        property_id = get_property_id(property_label)
     
     print(entity1)
     print(entity2)
@@ -134,22 +387,10 @@ def is_property_entailed(entity_label1: str, entity_label2: str, property_label:
         print("Could not resolve one or more labels to Wikidata IDs.")
         return False
 
-    # Define the SPARQL query
-    sparql_query = f"""
-    ASK {{
-      wd:{entity1} wdt:{property_id} wd:{entity2} .
-    }}
-    """
-
-    # Set up the SPARQL endpoint
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
-    sparql.setQuery(sparql_query)
-    sparql.setReturnFormat(JSON)
-
     try:
         # Execute the query
-        response = sparql.query().convert()
-        return response.get("boolean", False)
+        with span('entailment', backend=type(_entailment_backend).__name__):
+            return bool(_entailment_backend.ask(entity1, property_id, entity2))
     except Exception as e:
         print(f"Error querying SPARQL: {e}")
         return False
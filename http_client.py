@@ -0,0 +1,287 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from cassette import DEFAULT_CASSETTE_PATH, Cassette, request_key
+from tracing import count, span
+
+SPARQL_URL = os.environ.get('WIKIDATA_SPARQL_URL', 'https://query.wikidata.org/sparql')
+USER_AGENT = 'WDPS-Assignment/1.0 (question answering and fact checking pipeline; python-requests)'
+
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) in seconds
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_REQUESTS_PER_SECOND = 20
+DEFAULT_POOL_SIZE = 16
+
+# wikidata asks bots to back off when replication lag is above this many seconds
+DEFAULT_MAXLAG = 5
+
+# live: only the network, record: the network and every response is saved to a cassette,
+# replay: only the responses saved in the cassette, without network access
+WIKIDATA_MODES = ('live', 'record', 'replay')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+# longest Retry-After delay that is honoured, a larger one would stall a worker for minutes
+MAX_RETRY_AFTER = 60
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket, at most `rate` requests start per second (bursts up to `burst`).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class WikidataHTTPError(Exception):
+    pass
+
+
+def retry_after_seconds(response):
+    """
+    Returns the delay asked for by a Retry-After header (seconds or HTTP date) capped at MAX_RETRY_AFTER, or None.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return min(MAX_RETRY_AFTER, max(0.0, float(value)))
+    except ValueError:
+        pass
+    try:
+        return min(MAX_RETRY_AFTER, max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_seconds(attempt):
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class HTTPClient:
+    """
+    Shared HTTP client for all wikidata traffic.
+
+    Keeps connections alive in a pool, applies timeouts and a global rate limit, retries transient
+    failures (connection errors, 429/5xx and wikidata maxlag errors) with exponential backoff and
+    keeps latency and error statistics per endpoint.
+
+    In record mode every response is also saved to a cassette, in replay mode the responses come from the
+    cassette only (requests that were not recorded fail), optionally delayed by replay_latency: a number of
+    seconds or 'recorded' for the time the request took when it was recorded.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, pool_size=DEFAULT_POOL_SIZE,
+                 maxlag=DEFAULT_MAXLAG, mode='live', cassette_path=DEFAULT_CASSETTE_PATH, replay_latency=None):
+        if mode not in WIKIDATA_MODES:
+            raise ValueError(f'mode must be one of {WIKIDATA_MODES}')
+        self.mode = mode
+        self.replay_latency = replay_latency
+        #a read-only sqlite connection to a missing file only fails with 'unable to open database file'
+        if mode == 'replay' and not os.path.exists(cassette_path):
+            raise FileNotFoundError(f'cassette {cassette_path} does not exist, record it first with '
+                                    '--wikidata-mode record or pass the recorded one with --cassette')
+        self.cassette = Cassette(cassette_path, readonly=mode == 'replay') if mode != 'live' else None
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.maxlag = maxlag
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+        #requests is imported with the first client, so the CLI starts without it
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        #errors of a single attempt that are worth retrying
+        self.transient_errors = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.endpoint_stats = dict()
+        self.stats_lock = threading.Lock()
+
+    def _record(self, endpoint, seconds=None, error=False, retry=False):
+        if seconds is not None:
+            count('http_requests')
+        if error:
+            count('http_errors')
+        if retry:
+            count('http_retries')
+        with self.stats_lock:
+            stats = self.endpoint_stats.setdefault(
+                endpoint, {'requests': 0, 'errors': 0, 'retries': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            if seconds is not None:
+                stats['requests'] += 1
+                stats['total_seconds'] += seconds
+                stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            if error:
+                stats['errors'] += 1
+            if retry:
+                stats['retries'] += 1
+
+    def get_json(self, url, params=None, headers=None):
+        """
+        GET url and decode the JSON response, retrying transient failures.
+
+        Requests to the MediaWiki api (those with an 'action' parameter) get the maxlag parameter.
+
+        Raises:
+            WikidataHTTPError: When the request still fails after all retries.
+        """
+        params = dict(params or {})
+        endpoint = urlparse(url).netloc + urlparse(url).path
+        if 'action' in params:
+            endpoint += '?action=' + str(params['action'])
+            if self.maxlag:
+                params.setdefault('maxlag', self.maxlag)
+
+        with span('http', endpoint=endpoint):
+            if self.mode == 'replay':
+                return self._replay(url, params, endpoint)
+            start = time.perf_counter()
+            data = self._get_with_retries(url, params, headers, endpoint)
+            if self.mode == 'record':
+                self.cassette.put(request_key(url, params), endpoint, data, time.perf_counter() - start)
+            return data
+
+    def _replay(self, url, params, endpoint):
+        recorded = self.cassette.get(request_key(url, params))
+        if recorded is None:
+            self._record(endpoint, 0.0, error=True)
+            raise WikidataHTTPError(f'{endpoint} request is not in the cassette {self.cassette.path}')
+        data, recorded_seconds = recorded
+        delay = recorded_seconds if self.replay_latency == 'recorded' else float(self.replay_latency or 0.0)
+        if delay:
+            time.sleep(delay)
+        self._record(endpoint, delay)
+        return data
+
+    def _wait(self, attempt, delay=None):
+        #after the last attempt the error is raised right away
+        if attempt < self.max_retries:
+            time.sleep(delay if delay is not None else backoff_seconds(attempt))
+
+    def _get_with_retries(self, url, params, headers, endpoint):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._record(endpoint, retry=True)
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except self.transient_errors as e:
+                self._record(endpoint, time.perf_counter() - start, error=True)
+                last_error = e
+                self._wait(attempt)
+                continue
+            seconds = time.perf_counter() - start
+
+            if response.status_code in RETRY_STATUSES:
+                self._record(endpoint, seconds, error=True)
+                last_error = WikidataHTTPError(f'{endpoint} returned HTTP {response.status_code}')
+                self._wait(attempt, retry_after_seconds(response))
+                continue
+
+            if response.status_code >= 400:
+                self._record(endpoint, seconds, error=True)
+                raise WikidataHTTPError(f'{endpoint} returned HTTP {response.status_code}')
+
+            try:
+                data = response.json()
+            except ValueError as e:
+                self._record(endpoint, seconds, error=True)
+                raise WikidataHTTPError(f'{endpoint} returned invalid JSON') from e
+
+            #the api answers maxlag with a 200 response and an error object
+            error = data.get('error') if isinstance(data, dict) else None
+            if error and error.get('code') == 'maxlag':
+                self._record(endpoint, seconds, error=True)
+                last_error = WikidataHTTPError(f'{endpoint} is lagged: {error.get("info")}')
+                self._wait(attempt, retry_after_seconds(response))
+                continue
+
+            self._record(endpoint, seconds)
+            return data
+
+        raise WikidataHTTPError(f'{endpoint} failed after {self.max_retries + 1} attempts: {last_error}')
+
+    def sparql(self, query, endpoint=None):
+        """
+        Run a SPARQL query and return the decoded JSON result.
+        """
+        return self.get_json(endpoint or SPARQL_URL, params={'query': query, 'format': 'json'},
+                             headers={'Accept': 'application/sparql-results+json'})
+
+    def stats(self):
+        """
+        Returns:
+            dict: Per endpoint the number of requests, errors, retries and the total/mean/max latency.
+        """
+        with self.stats_lock:
+            stats = dict()
+            for endpoint, counts in self.endpoint_stats.items():
+                stats[endpoint] = dict(counts)
+                stats[endpoint]['mean_seconds'] = counts['total_seconds'] / counts['requests'] if counts['requests'] else 0.0
+            return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure_client(**kwargs):
+    """
+    Replace the shared client, keyword arguments are passed on to HTTPClient.
+    """
+    global _client
+    with _client_lock:
+        _client = HTTPClient(**kwargs)
+    return _client
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HTTPClient()
+    return _client
+
+
+def get_json(url, params=None, headers=None):
+    return get_client().get_json(url, params=params, headers=headers)
+
+
+def sparql_query(query, endpoint=None):
+    return get_client().sparql(query, endpoint=endpoint)
@@ -1,108 +1,483 @@
-import spacy
+import os
 import argparse
-import subprocess
-import requests
-
-from transformers import pipeline
-import requests
-from SPARQLWrapper import SPARQLWrapper, JSON
+import itertools
+import multiprocessing
+from collections import deque
 
+#only light modules are imported here, the models (spacy, transformers, llama_cpp) are imported by the
+#model registry when a stage first needs them, so --help and argument errors return right away
 from fact_checker import *
 from entity_extractor import *
 from answer_processing import *
 from util import *
+from model_registry import get_model, loaded_models, warm_up
+from wikidata_cache import DEFAULT_CACHE_PATH, configure_cache, get_cache
+from http_client import WIKIDATA_MODES, configure_client, get_client
+from cassette import DEFAULT_CASSETTE_PATH
+from async_linker import DEFAULT_MAX_IN_FLIGHT, DEFAULT_REQUESTS_PER_SECOND, link_entity_groups
+from pipeline import StagedExecutor
+from tracing import DEFAULT_METRICS_HOST, close_tracing, configure_tracing, span
+
+DEFAULT_TRIPLE_STORE = os.environ.get('WIKIDATA_TRIPLE_STORE')
     
    
          
-def main():
+def replay_latency(value):
+    """
+    Parses --replay-latency: seconds or 'recorded'.
+    """
+    return value if value == 'recorded' else float(value)
+
+def build_parser():
     
     parser = argparse.ArgumentParser(
                         prog='ProgramName',
                         epilog='Text at the bottom of help')
     parser.add_argument('-infile','-if')
     parser.add_argument('-outfile','-of')
-    args = parser.parse_args()
-    
-    #check if the required model is installed and if not, download it
-    ensure_model_installed()
-    questions = read_input(args.infile)
+    parser.add_argument('--cache-path', default=DEFAULT_CACHE_PATH,
+                        help='SQLite file used to cache wikidata lookups between runs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not cache wikidata lookups')
+    parser.add_argument('--wikidata-mode', choices=WIKIDATA_MODES, default='live',
+                        help='live: use the wikidata endpoints, record: also save every response to the cassette, '
+                             'replay: only use the responses in the cassette (no network access)')
+    parser.add_argument('--cassette', default=DEFAULT_CASSETTE_PATH,
+                        help='file the wikidata responses are recorded to and replayed from')
+    parser.add_argument('--replay-latency', type=replay_latency,
+                        help="seconds every replayed response is delayed, or 'recorded' for the recorded latency")
+    parser.add_argument('--label-index', default=DEFAULT_LABEL_INDEX,
+                        help='offline wikidata label index (built with wikidata_index.py) used before the API')
+    parser.add_argument('--triple-store', default=DEFAULT_TRIPLE_STORE,
+                        help='local triple store (built with triple_store.py) used instead of the SPARQL endpoint for fact checking')
+    parser.add_argument('--relation-embeddings',
+                        help='directory of the embedding store used to map relation labels without an exact property match to the most similar property')
+    parser.add_argument('--relation-min-score', type=float, default=0.8,
+                        help='minimum cosine similarity for the semantic relation to property mapping')
+    parser.add_argument('--trace',
+                        help='JSONL file the spans of every pipeline stage (per question) are appended to')
+    parser.add_argument('--metrics-file',
+                        help='file the stage latencies, HTTP calls, cache hits and model calls are written to in the Prometheus text format')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve the same metrics on http://localhost:PORT/metrics')
+    parser.add_argument('--metrics-host', default=DEFAULT_METRICS_HOST,
+                        help='address the metrics port is bound to, 0.0.0.0 serves them on every interface')
+    parser.add_argument('--linker', choices=LINKERS, default='popularity',
+                        help='popularity: link mentions to the candidate with the most sitelinks, embedding: to the candidate '
+                             'whose label and description are most similar to the sentence of the mention')
+    parser.add_argument('--linker-model', default=DEFAULT_LINKER_MODEL,
+                        help='sentence-transformers model of the embedding linker')
+    parser.add_argument('--linker-vector-cache', default=DEFAULT_ENTITY_VECTOR_CACHE,
+                        help='SQLite file the candidate vectors of the embedding linker are cached in between runs')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help='maximum number of concurrent wikidata requests while linking')
+    parser.add_argument('--requests-per-second', type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help='maximum number of wikidata requests started per second while linking (0 = unlimited)')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='number of questions that are fact checked together')
+    parser.add_argument('--rebel-batch-size', type=int, default=8,
+                        help='number of texts REBEL generates triplets for in one pass')
+    parser.add_argument('--spacy-batch-size', type=int, default=64,
+                        help='number of texts spaCy parses per batch')
+    parser.add_argument('--spacy-n-process', type=int, default=1,
+                        help='number of processes spaCy uses for parsing')
+    parser.add_argument('--llm-model-path', default=DEFAULT_MODEL_PATH,
+                        help='gguf model used to answer the questions')
+    parser.add_argument('--llm-preamble',
+                        help='file with text (e.g. few-shot examples) put in front of every question, its KV state is computed once')
+    parser.add_argument('--llm-max-tokens', type=int, default=32,
+                        help='maximum number of tokens generated per answer')
+    parser.add_argument('--llm-stop', action='append',
+                        help='string that stops the generation, can be repeated (default: "Q:" and a newline)')
+    parser.add_argument('--llm-temperature', type=float, default=0.8,
+                        help='sampling temperature')
+    parser.add_argument('--llm-seed', type=int,
+                        help='sampling seed, makes the answers reproducible')
+    parser.add_argument('--llm-threads', type=int,
+                        help='number of threads llama uses')
+    parser.add_argument('--llm-ctx', type=int, default=512,
+                        help='llama context size in tokens')
+    parser.add_argument('--llm-report',
+                        help='write the prompt evaluation and generation time of every question to this JSON lines file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each loads its own models (takes precedence over --pipeline)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='overlap llm generation, linking and fact checking of consecutive batches')
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help='maximum number of batches waiting in front of every pipeline stage')
+    parser.add_argument('--resume', action='store_true',
+                        help='keep the existing output file and only process the questions that are not in it yet')
+    parser.add_argument('--flush-bytes', type=int, default=1 << 20,
+                        help='write buffered results to the output file once this many characters are buffered')
+    parser.add_argument('--flush-seconds', type=float, default=5.0,
+                        help='write buffered results to the output file at least this often')
+    return parser
+
+def answer_questions(batch, args):
+    """
+    Asks the llm every question of a batch and analyses the answers.
+    Every question and answer is parsed once, all of them together with nlp.pipe.
+
+    Args:
+        batch (list): (q_id, q_text) tuples.
+
+    Returns:
+        list: The intermediate results of every question, see analyse_answer.
+    """
+    return analyse_answers(*generate_answers(batch), args)
+
+def generate_answers(batch):
+    """
+    Asks the llm every question of a batch.
+
+    Returns:
+        tuple: (batch, raw_answers)
+    """
+    #fetch llm output
+    with span('llm', questions=len(batch)):
+        raw_answers = [raw_answer.lstrip(': ') for raw_answer in get_engine().ask_many([q_text for _, q_text in batch])]
+    return batch, raw_answers
+
+def analyse_answers(batch, raw_answers, args):
+    """
+    Parses the questions and llm answers of a batch together with nlp.pipe and analyses every answer.
+    """
+    with span('ner', texts=2 * len(batch)):
+        question_docs = parse_texts([q_text for _, q_text in batch], disable=QUESTION_DISABLE,
+                                    batch_size=args.spacy_batch_size, n_process=args.spacy_n_process)
+        answer_docs = parse_texts(raw_answers, disable=ANSWER_DISABLE,
+                                  batch_size=args.spacy_batch_size, n_process=args.spacy_n_process)
     
-    #create or wipe the output file
-    with open(args.outfile, 'w') as f:
-        pass
+    results = []
+    for (q_id, q_text), question_doc, raw_answer, answer_doc in zip(batch, question_docs, raw_answers, answer_docs):
+        with span('analyse', q_id=q_id):
+            results.append(analyse_answer(q_id, q_text, question_doc, raw_answer, answer_doc, args))
     
-    #process the questions
-    for q_id, q_text in questions.items():
+    #the yes/no answers of the batch are classified together, every NLI model runs once per batch
+    yes_no = [result for result in results if result.get('expected_answer_type') == 'YES/NO']
+    if yes_no:
+        with span('yes_no', answers=len(yes_no)):
+            for result, label in zip(yes_no, extract_yes_no_batch([result['raw_answer'] for result in yes_no])):
+                result['extracted_answer'] = label
+    return results
 
-        nlp=spacy.load('en_core_web_md')
-        doc = nlp(q_text)
-        
-        #fetch llm output
-        raw_answer = ask_question(q_text)
-        raw_answer = raw_answer.lstrip(': ')
-        
-        if raw_answer.strip() == '':
-            write_error(q_id=q_id,
-                        msg='ERROR: response is empty / makes no sense',
-                        path=args.outfile,
-                        raw_response = raw_answer)
-            continue
-        
-        #classify question
-        expected_answer_type = classify_question(doc)
+def analyse_answer(q_id, q_text, question_doc, raw_answer, answer_doc, args):
+    """
+    Extracts the answer from the llm response and links the entities of the question and answer.
+    The yes/no answers are extracted afterwards for the whole batch, see analyse_answers.
 
-        #extract entities and disambiguate
-        answer_entities = recognize_entities(text=raw_answer)
-        answer_linked_entities = link_entities(entities=answer_entities)
-        
-        #extract entities and disambiguate
-        question_entities = recognize_entities(text=q_text)
-        question_linked_entities = link_entities(entities=question_entities)
-        
-        combined_linked_entities = question_linked_entities + answer_linked_entities
-        
-        #process answer
+    Returns:
+        dict: The intermediate results of the question, 'error' is set when the llm response is unusable.
+    """
+    result = {'q_id': q_id, 'q_text': q_text, 'raw_answer': raw_answer}
+    
+    if raw_answer.strip() == '':
+        result['error'] = 'ERROR: response is empty / makes no sense'
+        return result
+    
+    #classify question
+    with span('classify'):
+        expected_answer_type = classify_question(question_doc)
+
+    #extract entities and disambiguate, the question and answer entities are linked concurrently
+    with span('link'):
+        answer_entities = recognize_entities(doc=answer_doc)
+        question_entities = recognize_entities(doc=question_doc)
+        answer_linked_entities, question_linked_entities = link_entity_groups(
+            [answer_entities, question_entities],
+            contexts=[answer_doc, question_doc],
+            max_in_flight=args.max_in_flight,
+            requests_per_second=args.requests_per_second)
+    
+    result['expected_answer_type'] = expected_answer_type
+    result['answer_linked_entities'] = answer_linked_entities
+    result['combined_linked_entities'] = question_linked_entities + answer_linked_entities
+    
+    #process answer, the fact text is what the fact checker extracts triplets from
+    with span('extract_answer', answer_type=expected_answer_type):
         if expected_answer_type == 'YES/NO':
-            extracted_answer= extract_yes_no(raw_answer)
-            
-            #perform fact checking
-            extracted_triplets = extract_triplets(q_text)
-            fact = extract_candidate_fact(extracted_triplets, 
-                                          entities = combined_linked_entities, 
-                                          text = q_text)
- 
-            fact_true = is_property_entailed(fact['head'], fact['tail'], fact['type'])
-            
-            if fact_true and extracted_answer == 'yes':
-                correctness = 'correct'
-            else:
-                correctness = 'incorrect'
+            result['fact_text'] = q_text
                 
         if expected_answer_type == 'ENTITY':
-            extracted_answer_text, extracted_answer = extract_answer_entity(raw_answer, answer_linked_entities)
-            
-            #perform fact checking
-            extracted_triplets = extract_triplets(q_text + ' ' + extracted_answer_text)
+            extracted_answer_text, result['extracted_answer'] = extract_answer_entity(raw_answer, answer_linked_entities,
+                                                                                      doc=answer_doc)
+            result['fact_text'] = q_text + ' ' + extracted_answer_text
+    
+    return result
+
+def check_facts(results, args):
+    """
+    Fact checks a batch of answered questions, the triplets of all questions are extracted in bulk and their
+    statements are checked together.
+    Sets 'correctness' on every result without an error.
+    """
+    to_check = [result for result in results if 'error' not in result]
+    with span('triplets', texts=len(to_check)):
+        all_triplets = extract_triplets_batch([result['fact_text'] for result in to_check],
+                                              batch_size=args.rebel_batch_size)
+    
+    statements = []
+    for result, extracted_triplets in zip(to_check, all_triplets):
+        with span('fact_check', q_id=result['q_id']):
             fact = extract_candidate_fact(extracted_triplets, 
-                                          entities = combined_linked_entities, 
-                                          text = q_text + ' ' + extracted_answer_text)
-    
-            fact_true = is_property_entailed(fact['head'], fact['tail'], fact['type'])
-            if fact_true:
-                correctness = 'correct'
-            else:
-                correctness = 'incorrect'
-      
-        #append results to outfile
-        append_outfile(path=args.outfile,
-                       q_id=q_id,
-                       raw_response=raw_answer,
-                       answer=extracted_answer,
-                       entities=answer_linked_entities,
-                       correctness=correctness)
+                                          entities = result['combined_linked_entities'], 
+                                          text = result['fact_text'])
+     
+            statements.append(resolve_fact(fact['head'], fact['tail'], fact['type']))
+    
+    #the statements of the whole batch are checked together, a few VALUES queries instead of an ASK query each
+    for result, fact_true in zip(to_check, check_statements(statements)):
+        if result['expected_answer_type'] == 'YES/NO':
+            correct = fact_true and result['extracted_answer'] == 'yes'
+        else:
+            correct = fact_true
+        result['correctness'] = 'correct' if correct else 'incorrect'
+    
+    return results
+
+def format_result(result):
+    """
+    Returns:
+        str: The output file records (R/A/C/E lines) of an answered question.
+    """
+    if 'error' in result:
+        return format_error(q_id=result['q_id'],
+                            msg=result['error'],
+                            raw_response=result['raw_answer'])
+    
+    return format_record(q_id=result['q_id'],
+                         raw_response=result['raw_answer'],
+                         answer=result['extracted_answer'],
+                         entities=result['answer_linked_entities'],
+                         correctness=result['correctness'])
+
+def write_results(results, writer):
+    
+    #append results to outfile
+    for result in results:
+        writer.write(format_result(result), q_id=result['q_id'])
+
+def chunked(items, size):
+    
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def configure_llm(args):
+    
+    preamble = ''
+    if args.llm_preamble:
+        with open(args.llm_preamble, 'r') as infile:
+            preamble = infile.read()
+    
+    return configure_engine(model_path=args.llm_model_path,
+                            preamble=preamble,
+                            max_tokens=args.llm_max_tokens,
+                            stop=args.llm_stop or ['Q:', '\n'],
+                            temperature=args.llm_temperature,
+                            seed=args.llm_seed,
+                            n_threads=args.llm_threads,
+                            n_ctx=args.llm_ctx)
+
+def pipeline_metrics():
+    """
+    The HTTP, cache, yes/no and model statistics of the run as metrics for the tracer.
+    """
+    http_stats = get_client().stats()
+    metrics = [('http_requests_total', 'counter', 'Wikidata HTTP requests per endpoint.',
+                [({'endpoint': endpoint}, stats['requests']) for endpoint, stats in http_stats.items()]),
+               ('http_errors_total', 'counter', 'Failed wikidata HTTP requests per endpoint.',
+                [({'endpoint': endpoint}, stats['errors']) for endpoint, stats in http_stats.items()]),
+               ('http_retries_total', 'counter', 'Retried wikidata HTTP requests per endpoint.',
+                [({'endpoint': endpoint}, stats['retries']) for endpoint, stats in http_stats.items()]),
+               ('yes_no_answers_total', 'counter', 'Yes/no answers settled per classifier tier.',
+                [({'tier': tier}, settled) for tier, settled in yes_no_stats.items()]),
+               ('models_loaded', 'gauge', 'Number of loaded models.', [({}, len(loaded_models()))])]
+    cache = get_cache()
+    if cache is not None:
+        kinds = {kind: counts for kind, counts in cache.stats().items() if kind != 'total'}
+        for event in ('memory_hits', 'disk_hits', 'negative_hits', 'misses'):
+            metrics.append((f'cache_{event}_total', 'counter', f'Wikidata cache {event.replace("_", " ")} per kind.',
+                            [({'kind': kind}, counts[event]) for kind, counts in kinds.items()]))
+    return metrics
+
+def configure_observability(args, suffix=''):
+    """
+    Turns tracing on when --trace, --metrics-file or --metrics-port is given. Worker processes pass a suffix
+    so they write their own files, only the main process serves the metrics port.
+    """
+    tracer = configure_tracing(spans_path=args.trace + suffix if args.trace else None,
+                               metrics_path=args.metrics_file + suffix if args.metrics_file else None,
+                               metrics_port=None if suffix else args.metrics_port, metrics_host=args.metrics_host)
+    if tracer is not None:
+        tracer.add_collector(pipeline_metrics)
+    return tracer
+
+def configure_run(args):
+    """
+    Sets up the wikidata cache, label index, entailment backend and relation index of a run.
+    """
+    configure_client(mode=args.wikidata_mode, cassette_path=args.cassette, replay_latency=args.replay_latency)
+    #while recording every lookup has to reach the client to end up in the cassette, and a replayed run must only
+    #see the cassette, so outside live mode nothing is read from (or written to) the on-disk cache
+    configure_cache(path=None if args.wikidata_mode != 'live' else args.cache_path, enabled=not args.no_cache)
+    configure_label_index(args.label_index)
+    configure_linker(args.linker, model_name=args.linker_model, vector_cache_path=args.linker_vector_cache)
+    configure_entailment_backend(args.triple_store)
+    configure_relation_index(args.relation_embeddings, min_score=args.relation_min_score)
+
+def warm_up_models(args):
+    """
+    Loads the models of the run up front, they are reused for every question.
+    """
+    warm_up('spacy', 'rebel')
+    if args.linker == 'embedding':
+        warm_up('sentence_embedder', sentence_embedder={'model_name': args.linker_model})
+    get_engine().warm_up()
+
+def process_batches(questions, args):
+    """
+    Answers and fact checks the questions in batches.
+
+    With --pipeline the llm, analysis and fact checking stages run in their own threads, so the llm can
+    answer the next batch while the previous one is linked and checked.
+
+    Yields:
+        list: The results of every batch, in input order.
+    """
+    batches = chunked(questions, args.batch_size)
+    
+    if args.workers > 1:
+        yield from process_batches_in_workers(batches, args)
+        return
+    
+    #load the models once up front, they are reused for every question
+    warm_up_models(args)
+    
+    if not args.pipeline:
+        for batch in batches:
+            yield check_facts(answer_questions(batch, args), args)
+        return
+    
+    executor = StagedExecutor([('llm', generate_answers, 1),
+                               ('analyse', lambda item: analyse_answers(*item, args), 1),
+                               ('fact_check', lambda results: check_facts(results, args), 1)],
+                              queue_size=args.queue_size)
+    yield from executor.run(batches)
+    
+    for stage, stats in executor.stats().items():
+        print(f"Stage {stage}: {stats}")
+
+#the arguments of the run, set in every worker process by init_worker
+_worker_args = None
+
+def init_worker(args):
+    """
+    Initializer of the worker processes: every worker opens its own cache connection and loads its models once.
+    """
+    global _worker_args
+    _worker_args = args
+    configure_observability(args, suffix=f'.{os.getpid()}')
+    configure_llm(args)
+    configure_run(args)
+    warm_up_models(args)
+
+def process_batch_in_worker(batch):
+    
+    return check_facts(answer_questions(batch, _worker_args), _worker_args)
+
+def process_batches_in_workers(batches, args):
+    """
+    Processes the batches in args.workers processes.
+
+    The workers take the next batch from a shared queue as soon as they are done with one, so slow questions
+    only hold up a single worker. Only a few batches per worker are queued at a time, so the input is still
+    read lazily.
+
+    Yields:
+        list: The results of every batch, in input order.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=args.workers, initializer=init_worker, initargs=(args,)) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(process_batch_in_worker, (batch,)))
+            if len(pending) >= 2 * args.workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+         
+def validate_args(parser, args):
+    """
+    Checks the arguments before anything is loaded, errors exit through the parser.
+    """
+    if not args.infile or not args.outfile:
+        parser.error('the input file (-if) and the output file (-of) are required')
+    if not os.path.isfile(args.infile):
+        parser.error(f'input file {args.infile} does not exist')
+    outdir = os.path.dirname(os.path.abspath(args.outfile))
+    if not os.path.isdir(outdir):
+        parser.error(f'output directory {outdir} does not exist')
+    if args.batch_size < 1 or args.workers < 1:
+        parser.error('--batch-size and --workers must be at least 1')
+
+def main():
+    
+    parser = build_parser()
+    args = parser.parse_args()
+    validate_args(parser, args)
+
+    questions = iter_input(args.infile)
+    
+    #when resuming, skip the questions that were completely written by an earlier run
+    mode = 'w'
+    if args.resume and os.path.exists(args.outfile):
+        completed = load_checkpoint(args.outfile)
+        print(f"Resuming: {len(completed)} questions are already answered.")
+        questions = ((q_id, q_text) for q_id, q_text in questions if q_id not in completed)
+        mode = 'a'
+    
+    #nothing left to answer, stop before any model or index is loaded
+    first = next(questions, None)
+    if first is None:
+        if mode == 'w':
+            ResultWriter(args.outfile).close()
+        print("No questions to answer.")
+        return
+    questions = itertools.chain([first], questions)
+
+    configure_observability(args)
+    configure_run(args)
+    configure_llm(args)
+    
+    #check if the required model is installed and if not, download it
+    ensure_model_installed()
+
+    #create or wipe the output file (or append when resuming), it stays open for the whole run
+    with ResultWriter(args.outfile, mode=mode, max_buffer_bytes=args.flush_bytes, max_delay=args.flush_seconds) as writer:
+        
+        #process the questions in batches so the triplet extraction can run in bulk
+        for results in process_batches(questions, args):
+            write_results(results, writer)
+
+    if get_engine().report:
+        print(f"LLM timings: {get_engine().report_summary()}")
+        if args.llm_report:
+            get_engine().write_report(args.llm_report)
+    if any(yes_no_stats.values()):
+        print(f"Yes/no answers settled per tier: {yes_no_stats}")
+    if get_cache() is not None:
+        print(f"Wikidata cache stats: {get_cache().stats()['total']}")
+    for endpoint, stats in get_client().stats().items():
+        print(f"HTTP {endpoint}: {stats}")
+    close_tracing()
  
         
 if __name__ == '__main__':
     
     main()
-    
\ No newline at end of file
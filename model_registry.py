@@ -0,0 +1,110 @@
+import inspect
+import threading
+
+# loaders are registered by name and only called the first time a model is requested,
+# after that the same instance is returned for the rest of the process
+_loaders = dict()
+_models = dict()
+_lock = threading.RLock()
+
+
+def register_model(name, loader):
+    """
+    Register a loader function for a model.
+
+    Args:
+        name (str): Name used to request the model (e.g. 'spacy').
+        loader (callable): Function that builds the model, it receives the keyword arguments passed to get_model.
+    """
+    with _lock:
+        _loaders[name] = loader
+
+
+def get_model(name, **kwargs):
+    """
+    Return the model registered under name, loading it on first use.
+
+    Models loaded with different keyword arguments (e.g. another model_path) are kept separately.
+
+    Args:
+        name (str): Name of the registered model.
+        **kwargs: Arguments passed on to the loader.
+
+    Returns:
+        The loaded model.
+    """
+    if name not in _loaders:
+        raise KeyError(f"No loader registered for model '{name}'")
+
+    #fill in the loader defaults so get_model('spacy') and get_model('spacy', model_name='en_core_web_md') share one instance
+    arguments = inspect.signature(_loaders[name]).bind(**kwargs)
+    arguments.apply_defaults()
+    key = (name, tuple(sorted(arguments.arguments.items())))
+
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _lock:
+        #check again, another thread might have loaded it while we were waiting
+        if key not in _models:
+            print(f"Loading model '{name}'...")
+            _models[key] = _loaders[name](**kwargs)
+        return _models[key]
+
+
+def warm_up(*names, **kwargs):
+    """
+    Load the given models up front so the first question does not pay the loading cost.
+
+    Args:
+        *names (str): Names of the registered models to load.
+        **kwargs: Per-model loader arguments, e.g. llm={'model_path': '...'}.
+    """
+    for name in names:
+        get_model(name, **kwargs.get(name, {}))
+
+
+def loaded_models():
+    """
+    Returns:
+        list: Names of the models that are currently loaded.
+    """
+    return [name for name, _ in _models]
+
+
+def _load_spacy(model_name='en_core_web_md'):
+    import spacy
+    return spacy.load(model_name)
+
+
+def _load_rebel(model_name='Babelscape/rebel-large'):
+    from transformers import pipeline
+    return pipeline('text2text-generation', model=model_name, tokenizer=model_name)
+
+
+def _load_llm(model_path='models/llama-2-7b.Q4_K_M.gguf', n_ctx=512, n_threads=None, seed=None):
+    from llama_cpp import Llama
+    settings = {'n_ctx': n_ctx}
+    if n_threads is not None:
+        settings['n_threads'] = n_threads
+    if seed is not None:
+        settings['seed'] = seed
+    return Llama(model_path=model_path, verbose=False, **settings)
+
+
+def _load_zero_shot(model_name='facebook/bart-large-mnli'):
+    from transformers import pipeline
+    return pipeline('zero-shot-classification', model=model_name)
+
+
+def _load_sentence_embedder(model_name='sentence-transformers/all-mpnet-base-v2'):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+register_model('spacy', _load_spacy)
+register_model('rebel', _load_rebel)
+register_model('llm', _load_llm)
+register_model('zero_shot', _load_zero_shot)
+register_model('sentence_embedder', _load_sentence_embedder)
@@ -0,0 +1,162 @@
+import queue
+import threading
+import time
+
+# marks the end of the input in the stage queues
+_DONE = object()
+# seconds a blocked thread waits before it checks again whether the run was stopped
+POLL_SECONDS = 0.05
+
+
+class _Failure:
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _put(q, entry, stop):
+    """
+    Puts entry into the bounded queue q unless the run is stopped first, returns whether it was put.
+    """
+    while not stop.is_set():
+        try:
+            q.put(entry, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    """
+    Takes the next entry from q, or returns _DONE when the run is stopped first.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+class StagedExecutor:
+    """
+    Runs items through a chain of stages, every stage in its own thread(s) with bounded queues in between.
+
+    While one item is in a later stage the next item can already be in an earlier stage, e.g. the llm
+    generates the answers of batch N+1 while batch N is being linked and fact checked.
+    Results come out in input order.
+
+    Args:
+        stages (list): (name, function, workers) tuples, every function takes the output of the previous stage.
+        queue_size (int): Maximum number of items waiting in front of every stage.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.metrics = {name: {'items': 0, 'busy_seconds': 0.0, 'queue_depth_sum': 0, 'queue_depth_max': 0}
+                        for name, _, _ in stages}
+
+    def _record(self, name, depth, seconds):
+        with self.lock:
+            metrics = self.metrics[name]
+            metrics['items'] += 1
+            metrics['busy_seconds'] += seconds
+            metrics['queue_depth_sum'] += depth
+            metrics['queue_depth_max'] = max(metrics['queue_depth_max'], depth)
+
+    def _worker(self, name, function, inbox, outbox, remaining, stop):
+        while True:
+            entry = _get(inbox, stop)
+            if stop.is_set():
+                return
+            if entry is _DONE:
+                #the last worker of a stage tells the next stage that the input is finished
+                with self.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                _put(outbox if last else inbox, _DONE, stop)
+                return
+
+            seq, item = entry
+            depth = inbox.qsize()
+            if not isinstance(item, _Failure):
+                start = time.perf_counter()
+                try:
+                    item = function(item)
+                except Exception as e:
+                    item = _Failure(e)
+                self._record(name, depth, time.perf_counter() - start)
+            if not _put(outbox, (seq, item), stop):
+                return
+
+    def _feed(self, items, inbox, stop):
+        try:
+            for seq, item in enumerate(items):
+                if not _put(inbox, (seq, item), stop):
+                    return
+        except Exception as e:
+            _put(inbox, (-1, _Failure(e)), stop)
+        _put(inbox, _DONE, stop)
+
+    def run(self, items):
+        """
+        Process items through all stages.
+
+        Args:
+            items (iterable): The input items, consumed lazily.
+
+        Yields:
+            The output of the last stage for every item, in input order.
+
+        Raises:
+            Exception: The first exception raised by a stage (or by the input iterable).
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop), daemon=True)]
+        for i, (name, function, workers) in enumerate(self.stages):
+            remaining = [workers]
+            for _ in range(workers):
+                threads.append(threading.Thread(target=self._worker, daemon=True,
+                                                args=(name, function, queues[i], queues[i + 1], remaining, stop)))
+        for thread in threads:
+            thread.start()
+
+        #stages with several workers can finish out of order, so results wait here until it is their turn
+        waiting = dict()
+        next_seq = 0
+        try:
+            while True:
+                entry = queues[-1].get()
+                if entry is _DONE:
+                    break
+                seq, result = entry
+                if isinstance(result, _Failure):
+                    raise result.exception
+                waiting[seq] = result
+                while next_seq in waiting:
+                    yield waiting.pop(next_seq)
+                    next_seq += 1
+        finally:
+            #when the caller stops early or a stage failed, the threads blocked on a queue see this within
+            #POLL_SECONDS and exit, a stage function that is running finishes its item first
+            stop.set()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Per stage the number of items, busy time and the mean/max number of items waiting in its input queue.
+        """
+        with self.lock:
+            stats = dict()
+            for name, metrics in self.metrics.items():
+                items = metrics['items']
+                stats[name] = {'items': items,
+                               'busy_seconds': metrics['busy_seconds'],
+                               'queue_depth_mean': metrics['queue_depth_sum'] / items if items else 0.0,
+                               'queue_depth_max': metrics['queue_depth_max']}
+            return stats
@@ -0,0 +1,200 @@
+import argparse
+import csv
+import os
+import pickle
+import re
+import tempfile
+
+from wikidata_index import normalize_label
+
+# next to this file, so the defaults work from any working directory
+DEFAULT_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relations.csv')]
+DEFAULT_PROPERTY_INDEX = os.environ.get('WIKIDATA_PROPERTY_INDEX',
+                                        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relations.idx.pkl'))
+INDEX_VERSION = 2
+
+# usage counts in the property lists look like "46,674 M\n76 N": main values, qualifiers, references and
+# other uses (N)
+COUNT_KINDS = {'M': 'main', 'Q': 'qualifier', 'R': 'reference', 'N': 'other'}
+
+
+def parse_counts(text):
+    """
+    Parses a usage count cell, e.g. "18,326,702 M\\n128,120 Q\\n41,952 N".
+
+    Returns:
+        dict: Counts per kind ('main', 'qualifier', 'reference', 'other'), missing kinds are 0.
+    """
+    counts = {kind: 0 for kind in COUNT_KINDS.values()}
+    for number, kind in re.findall(r'([\d,]+)\s*([MQRN])', str(text or '').replace('_x000D_', '')):
+        counts[COUNT_KINDS[kind]] = int(number.replace(',', ''))
+    return counts
+
+
+def count_digits(text):
+    """
+    Reproduces the 'count' column of wikidata_relation_types.xlsx: the number of digits in a usage count cell
+    before its main (M) count, 0 without main statements. "2,924 Q\n308 M" gives 7, "46,674 M\n76 N" gives 5.
+    """
+    text = str(text or '').replace('_x000D_', '')
+    end = text.find('M')
+    return sum(c.isdigit() for c in text[:end]) if end >= 0 else 0
+
+
+def iter_relations_csv(path):
+    """
+    Yields the properties of a semicolon separated list with the columns ID;label;description;Data type;Counts.
+    """
+    with open(path, 'r', encoding='utf-8-sig', newline='') as infile:
+        for row in csv.DictReader(infile, delimiter=';'):
+            if not row.get('ID', '').startswith('P'):
+                continue
+            yield {'id': row['ID'], 'label': row.get('label') or '', 'description': row.get('description') or '',
+                   'datatype': row.get('Data type') or '', 'count': count_digits(row.get('Counts')),
+                   **parse_counts(row.get('Counts'))}
+
+
+def iter_relations_xlsx(path):
+    """
+    Yields the properties of wikidata_relation_types.xlsx (needs pandas with an xlsx reader).
+    """
+    import pandas as pd
+    relations_df = pd.read_excel(path)
+    for _, row in relations_df.iterrows():
+        if not str(row.get('ID', '')).startswith('P'):
+            continue
+        yield {'id': row['ID'], 'label': str(row.get('relation_label') or ''),
+               'description': str(row.get('relation_description') or ''),
+               'datatype': str(row.get('Data type[1]') or ''), 'count': count_digits(row.get('Counts[2]')),
+               **parse_counts(row.get('Counts[2]'))}
+
+
+def iter_relations(path):
+    if path.endswith('.xlsx'):
+        return iter_relations_xlsx(path)
+    return iter_relations_csv(path)
+
+
+def build_property_index(sources=DEFAULT_SOURCES, index_path=DEFAULT_PROPERTY_INDEX, aliases_path=None):
+    """
+    Compiles property lists into a pickled index keyed by normalized label and alias.
+
+    Args:
+        sources (list): relations.csv style files and/or wikidata_relation_types.xlsx, later files win.
+        index_path (str): Where to write the index.
+        aliases_path (str): Optional tab separated file with 'P123<TAB>alias' lines.
+
+    Returns:
+        dict: The index.
+    """
+    properties = dict()
+    for source in sources:
+        for relation in iter_relations(source):
+            properties[relation.pop('id')] = relation
+
+    names = {pid: [relation['label']] for pid, relation in properties.items()}
+    if aliases_path:
+        with open(aliases_path, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                pid, _, alias = line.rstrip('\n').partition('\t')
+                if pid in names and alias:
+                    names[pid].append(alias)
+
+    keys = dict()
+    for pid, labels in names.items():
+        for label in labels:
+            key = normalize_label(label)
+            if key:
+                keys.setdefault(key, []).append(pid)
+    #most used property first
+    for key, pids in keys.items():
+        pids.sort(key=lambda pid: (-properties[pid]['main'], int(pid[1:])))
+
+    index = {'version': INDEX_VERSION, 'sources': list(sources), 'properties': properties, 'keys': keys}
+    #written next to the target and renamed, so concurrent processes never load a half written index
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(index_path)))
+    with os.fdopen(handle, 'wb') as outfile:
+        pickle.dump(index, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+class PropertyIndex:
+    """
+    Lookup of wikidata property ids by label, loaded from an index built by build_property_index.
+    """
+
+    def __init__(self, index):
+        self.properties = index['properties']
+        self.keys = index['keys']
+
+    @classmethod
+    def load(cls, path=DEFAULT_PROPERTY_INDEX):
+        with open(path, 'rb') as infile:
+            index = pickle.load(infile)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError(f'{path} was built by another version, rebuild it')
+        return cls(index)
+
+    def candidates(self, label):
+        """
+        Returns:
+            list: The ids of all properties with this label or alias, most used first.
+        """
+        return list(self.keys.get(normalize_label(label), []))
+
+    def lookup(self, label):
+        """
+        Returns:
+            str: The id of the most used property with this label or alias, or None.
+        """
+        candidates = self.keys.get(normalize_label(label))
+        return candidates[0] if candidates else None
+
+
+_property_index = None
+
+
+def get_property_index(path=DEFAULT_PROPERTY_INDEX, sources=DEFAULT_SOURCES):
+    """
+    Returns the process-wide property index. It is (re)built first when it is missing or older than its sources,
+    and None is returned when neither the index nor the sources exist.
+    """
+    global _property_index
+    if _property_index is None:
+        existing = [source for source in sources if os.path.exists(source)]
+        stale = not os.path.exists(path) or any(os.path.getmtime(source) > os.path.getmtime(path) for source in existing)
+        if stale and existing:
+            _property_index = PropertyIndex(build_property_index(existing, path))
+        elif os.path.exists(path):
+            try:
+                _property_index = PropertyIndex.load(path)
+            except ValueError:
+                #built by another version, rebuilt when the sources are there
+                if not existing:
+                    raise
+                _property_index = PropertyIndex(build_property_index(existing, path))
+    return _property_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the property lists into a fast property label index.')
+    parser.add_argument('sources', nargs='*', default=DEFAULT_SOURCES,
+                        help='relations.csv style files and/or wikidata_relation_types.xlsx')
+    parser.add_argument('--index', default=DEFAULT_PROPERTY_INDEX)
+    parser.add_argument('--aliases', help="tab separated file with 'P123<TAB>alias' lines")
+    parser.add_argument('--lookup', help='look up a label in the built index')
+    args = parser.parse_args()
+
+    if args.lookup:
+        index = PropertyIndex.load(args.index)
+        for pid in index.candidates(args.lookup):
+            print(pid, index.properties[pid])
+        return
+
+    index = build_property_index(args.sources, args.index, aliases_path=args.aliases)
+    print(f"Indexed {len(index['properties'])} properties under {len(index['keys'])} labels.")
+
+
+if __name__ == '__main__':
+    main()
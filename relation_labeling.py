@@ -1,59 +1,130 @@
 import pandas as pd
-from sentence_transformers import SentenceTransformer, util
-from transformers import pipeline
-import torch
-import pickle
-import os
-
-def load_relations():
-    relations_df = pd.read_excel('wikidata_relation_types.xlsx')
-    relations_df = relations_df[relations_df['count'] > 3]
+
+from embedding_store import DEFAULT_EMBED_MODEL, DEFAULT_STORE_DIR, load_or_build_store
+from model_registry import get_model
+from property_index import DEFAULT_PROPERTY_INDEX, DEFAULT_SOURCES, get_property_index
+
+def load_relations(min_count=3):
+    #the compiled property index loads much faster than the xlsx, its 'count' is the xlsx column of the same name
+    #(digits before the main count, see count_digits) so 'count' > 3 keeps the same properties as before
+    property_index = get_property_index()
+    if property_index is None:
+        raise FileNotFoundError(f'no property index at {DEFAULT_PROPERTY_INDEX} and none of {DEFAULT_SOURCES} exist '
+                                'to build it from, run property_index.py with relations.csv or wikidata_relation_types.xlsx')
+    properties = property_index.properties
+    relations_df = pd.DataFrame([{'ID': pid, 'relation_label': relation['label'], 'relation_description': relation['description']}
+                                 for pid, relation in properties.items() if relation['count'] > min_count])
     print(len(relations_df), "relations loaded.")
-    relations_df = relations_df[['relation_label', 'relation_description']]
+    relations_df = relations_df[['ID', 'relation_label', 'relation_description']]
     relations_df['relation_text'] = relations_df['relation_label'].fillna('') + ' - ' + relations_df['relation_description'].fillna('')
     return relations_df
 
-def compute_relation_embeddings(embed_model, relation_descriptions, cache_path='relation_embeddings.pkl'):
-    if os.path.exists(cache_path):
-        with open(cache_path, 'rb') as f:
-            relation_embeddings = pickle.load(f)
-        print("Loaded cached embeddings.")
-    else:
-        relation_embeddings = embed_model.encode(relation_descriptions, convert_to_tensor=True, show_progress_bar=True)
-        with open(cache_path, 'wb') as f:
-            pickle.dump(relation_embeddings, f)
-        print("Computed and cached embeddings.")
+def compute_relation_embeddings(model_name, relation_descriptions, relation_ids=None, store_dir=DEFAULT_STORE_DIR, dtype='float32'):
+    #the store is keyed by a hash of the model name and the descriptions, so a changed model or relation list is re-embedded
+    relation_embeddings = load_or_build_store(relation_descriptions, ids=relation_ids, model_name=model_name,
+                                              directory=store_dir, dtype=dtype)
+    print(len(relation_embeddings), "relation embeddings loaded.")
     return relation_embeddings
 
-def find_relation(embed_model, zero_shot, relation_embeddings, relation_labels, e1, e2, context, TOP_N):
-    context_emb = embed_model.encode(context, convert_to_tensor=True)
-    cos_scores = util.cos_sim(context_emb, relation_embeddings)[0]
-    top_indices = torch.topk(cos_scores, k=TOP_N).indices
-    candidate_labels = [relation_labels[i] for i in top_indices]
-    result = zero_shot(sequences=context, candidate_labels=candidate_labels, multi_label=False)
-    top_relation, top_score = result['labels'][0], result['scores'][0]
-    return top_relation, top_score
+# cascade defaults: every stage only looks at the candidates that survived the previous, cheaper one
+EMBEDDING_TOP_K = 100
+# the small NLI model costs a forward pass per (context, relation) pair, so it only scores the best embedding
+# candidates: 25 instead of 100 passes per context with the default embedding_top_k
+SMALL_NLI_SHORTLIST = 25
+SMALL_NLI_MODEL = 'typeform/distilbert-base-uncased-mnli'
+SMALL_NLI_TOP_K = 10
+FULL_NLI_MODEL = 'valhalla/distilbart-mnli-12-1'
+EARLY_EXIT_SCORE = 0.9
+
+# number of contexts decided by every stage of the cascade
+cascade_stats = {'embedding': 0, 'small_nli': 0, 'full_nli': 0}
+
+def classify_relation(classifier, context, candidate_labels, batch_size=32):
+    result = classifier(sequences=context, candidate_labels=candidate_labels, multi_label=False, batch_size=batch_size)
+    return result['labels'], result['scores']
+
+def find_relations_batch(embed_model, relation_embeddings, relation_labels, contexts, embedding_top_k=EMBEDDING_TOP_K,
+                         small_shortlist=SMALL_NLI_SHORTLIST, small_model=SMALL_NLI_MODEL, small_top_k=SMALL_NLI_TOP_K, full_model=FULL_NLI_MODEL,
+                         early_exit_score=EARLY_EXIT_SCORE, nli_batch_size=32):
+    """
+    Predicts the relation expressed in every context with a cascade of increasingly expensive stages:
+    the embedding top-k relations, a small zero-shot NLI model over the small_shortlist best of those and the full
+    NLI model only over the small_top_k best ones of the small model. Contexts the small model is sure about (top score >= early_exit_score)
+    skip the full model. Every unique context is embedded (in one encode call) and classified once.
+
+    Args:
+        embed_model: The sentence-transformers model the relation embeddings were made with.
+        relation_embeddings (EmbeddingStore): The relation description embeddings.
+        relation_labels (list): The label of every row of relation_embeddings.
+        contexts (list): The texts to classify.
+        embedding_top_k (int): Number of relations passed from the embedding search to the NLI stages.
+        small_shortlist (int): Number of the best embedding candidates the small NLI model scores, None scores all.
+        small_model (str): Zero-shot model of the first NLI stage, None skips it.
+        small_top_k (int): Number of relations passed from the small to the full NLI model.
+        full_model (str): Zero-shot model of the last stage, None skips it.
+        early_exit_score (float): Small model score from which its prediction is used as is.
+        nli_batch_size (int): Number of (context, relation) pairs per NLI forward pass.
+
+    Returns:
+        list: A (relation label, score) tuple for every context, in input order.
+    """
+    unique_contexts = list(dict.fromkeys(contexts))
+    context_embs = embed_model.encode(unique_contexts, convert_to_numpy=True)
+    top_indices, top_scores = relation_embeddings.top_k(context_embs, k=embedding_top_k)
+
+    small = get_model('zero_shot', model_name=small_model) if small_model else None
+    full = get_model('zero_shot', model_name=full_model) if full_model else None
+
+    predictions = dict()
+    for context, indices, scores in zip(unique_contexts, top_indices, top_scores):
+        candidate_labels = list(dict.fromkeys(relation_labels[i] for i in indices))
+        if small is None and full is None:
+            predictions[context] = (relation_labels[indices[0]], float(scores[0]))
+            cascade_stats['embedding'] += 1
+            continue
+
+        if small is not None:
+            #the embedding candidates are ordered by similarity, the small model only scores the first ones
+            labels, nli_scores = classify_relation(small, context, candidate_labels[:small_shortlist],
+                                                   batch_size=nli_batch_size)
+            if full is None or nli_scores[0] >= early_exit_score:
+                predictions[context] = (labels[0], nli_scores[0])
+                cascade_stats['small_nli'] += 1
+                continue
+            candidate_labels = labels[:small_top_k]
+
+        labels, nli_scores = classify_relation(full, context, candidate_labels, batch_size=nli_batch_size)
+        predictions[context] = (labels[0], nli_scores[0])
+        cascade_stats['full_nli'] += 1
+
+    return [predictions[context] for context in contexts]
+
+def find_relation(embed_model, relation_embeddings, relation_labels, context, **cascade):
+    return find_relations_batch(embed_model, relation_embeddings, relation_labels, [context], **cascade)[0]
 
-def process_texts(texts, entities_list, embed_model, zero_shot, relation_embeddings, relation_labels, TOP_N):
+def process_texts(texts, entities_list, embed_model, relation_embeddings, relation_labels, **cascade):
+    #the prediction only depends on the text, so every text is classified once for all of its entity pairs
+    texts_with_pairs = [text for text, entities in zip(texts, entities_list) if len(entities) >= 2]
+    predictions = dict(zip(texts_with_pairs, find_relations_batch(embed_model, relation_embeddings, relation_labels,
+                                                                  texts_with_pairs, **cascade)))
     for text, entities in zip(texts, entities_list):
         if len(entities) < 2:
             print(f"Text: '{text}'\nNo entity pairs found.\n")
             continue
         print(f"Text: '{text}'")
+        top_relation, top_score = predictions[text]
         for i in range(len(entities) - 1):
             e1, e2 = entities[i], entities[i + 1]
-            top_relation, top_score = find_relation(embed_model, zero_shot, relation_embeddings, relation_labels, e1, e2, text, TOP_N)
             print(f"  Entities: {e1} - {e2} -> Predicted Relation: {top_relation} (Score: {top_score:.4f})")
         print("\n")
+    print("Decided per cascade stage:", cascade_stats)
 
 # Initialization
 relations_df = load_relations()
 relation_labels = relations_df['relation_label'].tolist()
-relation_descriptions = relations_df['relation_description'].tolist()
-embed_model = SentenceTransformer('sentence-transformers/all-mpnet-base-v2')
-relation_embeddings = compute_relation_embeddings(embed_model, relation_descriptions)
-zero_shot = pipeline("zero-shot-classification", model="valhalla/distilbart-mnli-12-1")
-TOP_N = 100
+relation_descriptions = relations_df['relation_description'].fillna('').tolist()
+embed_model = get_model('sentence_embedder', model_name=DEFAULT_EMBED_MODEL)
+relation_embeddings = compute_relation_embeddings(DEFAULT_EMBED_MODEL, relation_descriptions, relations_df['ID'].tolist())
 
 # Example usage
 texts = [
@@ -212,4 +283,4 @@ entities_list = [
     ["author", "The Odyssey"]
 ]
 
-process_texts(texts, entities_list, embed_model, zero_shot, relation_embeddings, relation_labels, TOP_N)
\ No newline at end of file
+process_texts(texts, entities_list, embed_model, relation_embeddings, relation_labels)
\ No newline at end of file
@@ -0,0 +1,370 @@
+import itertools
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main
+
+DEFAULT_PORT = 8090
+DEFAULT_MAX_WAIT = 0.05
+DEFAULT_MAX_QUEUE = 1024
+DEFAULT_REQUEST_TIMEOUT = 300.0
+MAX_BODY_BYTES = 1 << 20
+
+# tells the batching thread to stop
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Gathers the items that many threads submit into batches for one processing thread.
+
+    A batch starts with the first waiting item and takes everything that arrives within max_wait seconds,
+    up to max_batch_size items. Items that come in while a batch is processed form the next batch, so under
+    load the batches fill up without waiting.
+
+    Args:
+        process_batch (callable): Takes a list of items and returns their results in the same order.
+        max_batch_size (int): Maximum number of items per batch.
+        max_wait (float): Seconds a batch waits for more items after its first one.
+        max_queue (int): Maximum number of waiting items, submit raises queue.Full beyond that.
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait=DEFAULT_MAX_WAIT, max_queue=DEFAULT_MAX_QUEUE):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.metrics = {'batches': 0, 'items': 0, 'failed_batches': 0, 'rejected': 0, 'max_batch_size': 0,
+                        'busy_seconds': 0.0, 'wait_seconds': 0.0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """
+        Returns:
+            Future: Resolves to the result of the item, or raises the exception of its batch.
+        """
+        future = Future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            with self.lock:
+                self.metrics['rejected'] += 1
+            raise
+        return future
+
+    def _next_batch(self):
+        entry = self.queue.get()
+        if entry is _STOP:
+            return None, True
+        batch = [entry]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                entry = self.queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                results = self.process_batch([item for item, _, _ in batch])
+            except Exception as e:
+                results = None
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+            with self.lock:
+                metrics = self.metrics
+                metrics['batches'] += 1
+                metrics['items'] += len(batch)
+                metrics['failed_batches'] += results is None
+                metrics['max_batch_size'] = max(metrics['max_batch_size'], len(batch))
+                metrics['busy_seconds'] += time.perf_counter() - start
+                metrics['wait_seconds'] += sum(start - submitted for _, _, submitted in batch)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.metrics)
+        stats['queued'] = self.queue.qsize()
+        stats['mean_batch_size'] = stats['items'] / stats['batches'] if stats['batches'] else 0.0
+        stats['mean_wait_seconds'] = stats['wait_seconds'] / stats['items'] if stats['items'] else 0.0
+        return stats
+
+    def stop(self):
+        """
+        Processes the items that are already waiting and stops the batching thread.
+        """
+        self.queue.put(_STOP)
+        self.thread.join()
+
+
+def result_json(result):
+    """
+    The response for one answered question: the records main.py writes to the output file and their fields.
+    """
+    response = {'q_id': result['q_id'], 'records': main.format_result(result), 'raw_answer': result['raw_answer']}
+    if 'error' in result:
+        response['error'] = result['error']
+    else:
+        response.update(answer=result['extracted_answer'], correctness=result['correctness'],
+                        entities=[{'mention': mention, 'label': label, 'url': url}
+                                  for mention, label, url in result['answer_linked_entities']])
+    return response
+
+
+class QuestionService:
+    """
+    Answers questions with the models of main.py loaded once, concurrent questions are answered in micro-batches
+    so spaCy, REBEL and the NLI classifiers each run once per batch.
+
+    Args:
+        args: Parsed arguments of main.py (plus the server options).
+        answer_batch (callable): Turns a list of (q_id, question) tuples into main.py results, the full pipeline
+            by default.
+    """
+
+    def __init__(self, args, answer_batch=None):
+        self.args = args
+        self.answer_batch = answer_batch or self._answer_batch
+        self.ready = threading.Event()
+        self.started = time.time()
+        self.ids = itertools.count(1)
+        self.batcher = MicroBatcher(self._process, max_batch_size=args.batch_size, max_wait=args.max_wait,
+                                    max_queue=args.max_queue)
+
+    def _answer_batch(self, batch):
+        return main.check_facts(main.answer_questions(batch, self.args), self.args)
+
+    def _process(self, batch):
+        return [result_json(result) for result in self.answer_batch(batch)]
+
+    def warm_up(self):
+        """
+        Sets up the caches and indexes and loads the models, health reports ready afterwards.
+        """
+        main.configure_run(self.args)
+        main.configure_llm(self.args)
+        main.ensure_model_installed()
+        main.warm_up_models(self.args)
+        main.warm_up('zero_shot', zero_shot={'model_name': main.SMALL_YES_NO_MODEL})
+        self.ready.set()
+
+    def ask(self, questions, timeout=DEFAULT_REQUEST_TIMEOUT):
+        """
+        Answers (q_id, question) tuples, q_id None gets a generated id.
+
+        Returns:
+            list: The result_json of every question, in order.
+        """
+        futures = [self.batcher.submit((q_id or f'question-{next(self.ids)}', question))
+                   for q_id, question in questions]
+        deadline = time.perf_counter() + timeout
+        return [future.result(timeout=max(0.0, deadline - time.perf_counter())) for future in futures]
+
+    def health(self):
+        return {'status': 'ok' if self.ready.is_set() else 'starting',
+                'uptime_seconds': time.time() - self.started,
+                'models_loaded': main.loaded_models()}
+
+    def stats(self):
+        stats = {'uptime_seconds': time.time() - self.started,
+                 'batching': self.batcher.stats(),
+                 'yes_no': dict(main.yes_no_stats),
+                 'http': main.get_client().stats()}
+        if main.get_cache() is not None:
+            stats['cache'] = main.get_cache().stats()['total']
+        if main.get_engine().report:
+            stats['llm'] = main.get_engine().report_summary()
+        return stats
+
+    def close(self):
+        self.batcher.stop()
+
+
+def parse_questions(body):
+    """
+    Reads the questions of a request: {"question": "..."} or {"questions": [...]}, where every question
+    is a string or {"id": ..., "question": ...}.
+
+    Returns:
+        list: (q_id, question) tuples.
+    """
+    request = json.loads(body)
+    if not isinstance(request, dict):
+        raise ValueError('the request must be a JSON object')
+    items = request['questions'] if 'questions' in request else [request]
+    questions = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'question': item}
+        question = item.get('question') if isinstance(item, dict) else None
+        if not isinstance(question, str) or not question.strip():
+            raise ValueError('every question needs a non-empty "question" text')
+        #ids end up in the tab separated records, so they cannot contain tabs or newlines
+        q_id = item.get('id')
+        if q_id is not None and (not isinstance(q_id, str) or any(c in q_id for c in '\t\n')):
+            raise ValueError('question ids must be strings without tabs or newlines')
+        questions.append((q_id, ' '.join(question.split())))
+    return questions
+
+
+def make_handler(service, request_timeout=DEFAULT_REQUEST_TIMEOUT):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/health':
+                health = service.health()
+                self._send(200 if health['status'] == 'ok' else 503, health)
+            elif path == '/stats':
+                self._send(200, service.stats())
+            else:
+                self._send(404, {'error': f'unknown path {path}'})
+
+        def do_POST(self):
+            path = self.path.split('?')[0]
+            if path != '/answer':
+                self._send(404, {'error': f'unknown path {path}'})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY_BYTES:
+                self._send(413, {'error': f'the request is larger than {MAX_BODY_BYTES} bytes'})
+                return
+            try:
+                questions = parse_questions(self.rfile.read(length))
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {'error': f'invalid request: {e}'})
+                return
+            if not service.ready.is_set():
+                self._send(503, {'error': 'the models are still loading'})
+                return
+
+            try:
+                results = service.ask(questions, timeout=request_timeout)
+            except queue.Full:
+                self._send(503, {'error': 'too many questions are waiting, try again later'})
+            except TimeoutError:
+                self._send(504, {'error': f'no answer within {request_timeout} seconds'})
+            except Exception as e:
+                self._send(500, {'error': f'{type(e).__name__}: {e}'})
+            else:
+                self._send(200, {'results': results})
+
+    return Handler
+
+
+class QuestionHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    #concurrent callers connect at once, the default backlog of 5 makes the others retry after a second
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def get_request(self):
+        request, _ = super().get_request()
+        #BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+def start_server(service, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT):
+    """
+    Serves the service from a background thread, on a unix socket when socket_path is given and on
+    host:port otherwise.
+    """
+    handler = make_handler(service, request_timeout)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+    else:
+        server = QuestionHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def build_parser():
+    parser = main.build_parser()
+    parser.prog = 'server.py'
+    parser.description = ('Keeps the models of main.py loaded and answers questions over HTTP: POST /answer, '
+                          'GET /health and GET /stats.')
+    parser.epilog = None
+    group = parser.add_argument_group('server')
+    group.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    group.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    group.add_argument('--socket', help='listen on this unix socket instead of host and port')
+    group.add_argument('--max-wait', type=float, default=DEFAULT_MAX_WAIT,
+                       help='seconds a batch waits for more questions after its first one '
+                            '(the batch size is --batch-size)')
+    group.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                       help='maximum number of waiting questions, requests beyond that get HTTP 503')
+    group.add_argument('--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                       help='seconds a request waits for its answers')
+    return parser
+
+
+def serve():
+    args = build_parser().parse_args()
+
+    main.configure_observability(args)
+    service = QuestionService(args)
+    server = start_server(service, host=args.host, port=args.port, socket_path=args.socket,
+                          request_timeout=args.request_timeout)
+    print(f"Listening on {args.socket or f'http://{args.host}:{args.port}'}, loading the models...")
+    service.warm_up()
+    print("Ready.")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+    print("Shutting down...")
+    server.shutdown()
+    server.server_close()
+    if args.socket and os.path.exists(args.socket):
+        os.remove(args.socket)
+    service.close()
+    main.close_tracing()
+
+
+if __name__ == '__main__':
+    serve()
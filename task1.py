@@ -3,9 +3,11 @@ from nltk.corpus import wordnet as wn
 import spacy
 from pprint import pprint
 import numpy as np
-import requests
 from sentence_transformers import SentenceTransformer, util
 
+from async_linker import link_entity_groups
+from http_client import get_json
+
 nltk.download('wordnet')
 
 # Load NER model
@@ -54,8 +56,7 @@ def generate_candidates_api(mention, language="en", limit=10):
         "limit": limit,
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = get_json(url, params=params)
 
     candidates = []
 
@@ -73,8 +74,7 @@ def get_entity_info(id, languages='en'):
         "format": "json",
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = get_json(url, params=params)
 
     label = data['entities'][id]['labels'].get('en', {}).get('value', 'No label available')
     description = data['entities'][id]['descriptions'].get('en', {}).get('value', 'No description available')
@@ -145,8 +145,7 @@ for qa in QaA:
     #linked_q_entities = link_entities_with_embeddings(q_entities, q_doc)
     #linked_a_entities = link_entities_with_embeddings(a_entities, a_doc)
 
-    linked_q_entities = link_entities(q_entities)
-    linked_a_entities = link_entities(a_entities)
+    linked_q_entities, linked_a_entities = link_entity_groups([q_entities, a_entities])
 
     print(f"Question: {qa['question']}")
     print(f"Linked Entities in Question: {linked_q_entities}")
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wikidata_standin import WikidataStandIn, synthetic_world
+
+
+class CountingStandIn(WikidataStandIn):
+    """
+    Stand-in that keeps every request busy for a while and records how many ran at the same time.
+    """
+
+    def __init__(self, entities, busy_seconds=0.02):
+        super().__init__(entities)
+        self.busy_seconds = busy_seconds
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def handle(self, path, params):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.busy_seconds)
+            return super().handle(path, params)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def world():
+    return synthetic_world(5)
+
+
+@pytest.fixture
+def standin(world, monkeypatch):
+    """
+    A running stand-in for the synthetic world, with the pipeline pointed at it and caching off.
+    """
+    import entity_extractor
+    import http_client
+    import wikidata_cache
+
+    server = CountingStandIn(world[0]).start()
+    monkeypatch.setattr(entity_extractor, 'WIKIDATA_API_URL', server.api_url)
+    monkeypatch.setattr(http_client, 'SPARQL_URL', server.sparql_url)
+    http_client.configure_client(requests_per_second=0)
+    wikidata_cache.configure_cache(path=None, enabled=False)
+    entity_extractor.configure_label_index(None)
+    yield server
+    server.stop()
+    http_client.configure_client()
@@ -0,0 +1,37 @@
+import answer_processing
+from answer_processing import LlamaEngine, ask_question, configure_engine, get_engine, lexical_yes_no, normalize_answer
+
+
+def test_one_off_model_path_keeps_the_shared_engine(monkeypatch):
+    monkeypatch.setattr(LlamaEngine, 'ask', lambda self, question: (self.model_path, self.preamble, self.seed))
+    monkeypatch.setattr(answer_processing, '_engine', None)
+    shared = configure_engine(preamble='Q: Is water wet?\nA: yes\n', seed=7)
+
+    assert ask_question('Is Paris in France?', model_path='other.gguf') == ('other.gguf', shared.preamble, 7)
+    assert get_engine() is shared
+    assert ask_question('Is Paris in France?') == (answer_processing.DEFAULT_MODEL_PATH, shared.preamble, 7)
+
+
+def test_lexical_yes_no_openers():
+    assert lexical_yes_no(normalize_answer('Yes, Paris is the capital of France.')) == 'yes'
+    assert lexical_yes_no(normalize_answer('Nope.')) == 'no'
+    assert lexical_yes_no(normalize_answer('True!')) == 'yes'
+    assert lexical_yes_no(normalize_answer('Sure')) == 'yes'
+    assert lexical_yes_no(normalize_answer('Never.')) == 'no'
+    #openers of unrelated phrases are left to the NLI models
+    assert lexical_yes_no(normalize_answer('Not only is it the capital of France, it is also its largest city.')) is None
+    assert lexical_yes_no(normalize_answer('Right now, Paris is the capital of France.')) is None
+    assert lexical_yes_no(normalize_answer('Sure enough, no.')) is None
+    assert lexical_yes_no(normalize_answer('Never mind, yes it is')) is None
+    assert lexical_yes_no(normalize_answer('True to its name, it is not the capital.')) is None
+    assert lexical_yes_no(normalize_answer('Correct me if I am wrong, but no')) is None
+    assert lexical_yes_no(normalize_answer('Correct, it is.')) == 'yes'
+    assert lexical_yes_no(normalize_answer('Absolutely, Paris is the capital of France.')) == 'yes'
+    #emphasized denials
+    for answer in ('Absolutely not.', 'Of course not!', 'Certainly not, Paris is in France.', 'Definitely not',
+                   'Indeed not', 'Exactly not'):
+        assert lexical_yes_no(normalize_answer(answer)) == 'no', answer
+    #"no doubt" and "no question" are no denials
+    assert lexical_yes_no(normalize_answer('No doubt, it is.')) is None
+    assert lexical_yes_no(normalize_answer('No doubt about it')) is None
+    assert lexical_yes_no(normalize_answer('No question, that is true.')) == 'yes'
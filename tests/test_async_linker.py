@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from async_linker import link_entity_groups, link_entity_groups_async
+from entity_extractor import link_entities
+
+
+def mentions(world):
+    _, countries = world
+    names = [country for _, country, _, _, _ in countries]
+    names += [capital for _, _, _, capital, _ in countries]
+    return names + ['Nowhere at all']
+
+
+def test_matches_synchronous_linker(standin, world):
+    names = mentions(world)
+    linked = link_entity_groups([names[:5], names[5:]], max_in_flight=4, requests_per_second=0)
+    assert linked[0] + linked[1] == link_entities(names)
+    assert linked[1][-1] == ('Nowhere at all', None, None)
+    assert all(label is not None for _, label, _ in linked[0])
+
+
+def test_respects_concurrency_limit(standin, world):
+    link_entity_groups([mentions(world)], max_in_flight=3, requests_per_second=0)
+    assert 1 < standin.max_in_flight <= 3
+
+
+def test_async_api_inside_event_loop(standin, world):
+    names = mentions(world)
+
+    async def run():
+        with pytest.raises(RuntimeError, match='link_entity_groups_async'):
+            link_entity_groups([names])
+        return await link_entity_groups_async([names], max_in_flight=2, requests_per_second=0)
+
+    assert asyncio.run(run())[0] == link_entities(names)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStore, load_or_build_store, normalize_rows
+
+
+def _brute_force(vectors, queries, k):
+    scores = normalize_rows(queries) @ normalize_rows(vectors).T
+    order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    return order, np.take_along_axis(scores, order, axis=1)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 8192])
+@pytest.mark.parametrize('k', [1, 5, 300])
+def test_top_k_matches_brute_force(tmp_path, chunk_size, k):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 16))
+    queries = rng.normal(size=(9, 16)) * 3
+    store = EmbeddingStore.save(str(tmp_path), 'key', vectors, [f'P{i}' for i in range(200)], 'test-model')
+
+    indices, scores = store.top_k(queries, k=k, chunk_size=chunk_size)
+    expected_indices, expected_scores = _brute_force(vectors, queries, min(k, 200))
+    assert indices.shape == scores.shape == (9, min(k, 200))
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-6)
+
+    #a single query vector and the ids of the rows
+    best, best_scores = _brute_force(vectors, queries[:1], 2)
+    assert store.search(queries[0], k=2)[0] == [(f'P{i}', pytest.approx(float(score), abs=1e-6))
+                                               for i, score in zip(best[0], best_scores[0])]
+
+
+def test_float16_store_and_reuse(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(50, 8))
+    texts = [f'relation {i}' for i in range(50)]
+    calls = []
+
+    def encode(texts, model_name):
+        calls.append(model_name)
+        return vectors
+
+    store = load_or_build_store(texts, model_name='test-model', directory=str(tmp_path), dtype='float16', encode=encode)
+    assert store.vectors.dtype == np.float16
+    indices, _ = store.top_k(vectors[:5], k=1, chunk_size=16)
+    assert indices[:, 0].tolist() == [0, 1, 2, 3, 4]
+
+    #the same texts and model are served from disk, other texts are embedded again
+    load_or_build_store(texts, model_name='test-model', directory=str(tmp_path), dtype='float16', encode=encode)
+    assert calls == ['test-model']
+    load_or_build_store(texts[:-1], model_name='test-model', directory=str(tmp_path), dtype='float16',
+                        encode=lambda texts, model_name: encode(texts, model_name)[:-1])
+    assert calls == ['test-model'] * 2
+    with pytest.raises(ValueError):
+        load_or_build_store(texts, directory=str(tmp_path), dtype='int8', encode=encode)
+
+
+def test_empty_top_k(tmp_path):
+    store = EmbeddingStore(np.zeros((0, 4), dtype=np.float32))
+    indices, scores = store.top_k(np.ones((3, 4)), k=5)
+    assert indices.shape == scores.shape == (3, 0)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import embedding_store
+import entity_extractor
+from embedding_store import VectorCache
+from entity_extractor import configure_linker, select_by_embedding
+
+WORDS = ['capital', 'france', 'texas', 'city', 'river', 'bank', 'money', 'paris']
+
+
+def bag_of_words(texts, model_name=None):
+    vectors = np.array([[text.lower().replace(',', ' ').split().count(word) for word in WORDS] for text in texts],
+                       dtype=np.float32)
+    return embedding_store.normalize_rows(vectors)
+
+
+@pytest.fixture
+def embedding_linker(monkeypatch):
+    encoded = []
+
+    def encode(texts, model_name=None):
+        encoded.append(list(texts))
+        return bag_of_words(texts)
+
+    monkeypatch.setattr(embedding_store, 'encode_texts', encode)
+    #the vector cache binds its encoder when it is defined
+    monkeypatch.setattr(VectorCache.embed, '__defaults__', (encode,))
+    configure_linker('embedding', model_name='bag-of-words', vector_cache_path=None)
+    yield encoded
+    configure_linker()
+
+
+ENTITY_INFOS = {
+    'Q90': {'label': 'Paris', 'description': 'capital of France', 'sitelinks': 300, 'url': 'paris-france'},
+    'Q830149': {'label': 'Paris', 'description': 'city in Texas', 'sitelinks': 20, 'url': 'paris-texas'},
+    'Q1': {'label': 'Bank', 'description': 'river bank', 'sitelinks': 10, 'url': 'river-bank'},
+    'Q2': {'label': 'Bank', 'description': 'money institution', 'sitelinks': 100, 'url': 'money-bank'},
+}
+CANDIDATES = {'Paris': ['Q90', 'Q830149'], 'bank': ['Q2', 'Q1'], 'Nowhere': [], 'Ghost': ['Q404']}
+
+
+def _urls(selected):
+    return [info['url'] if info else None for info in selected]
+
+
+def test_the_sentence_decides_over_popularity(embedding_linker):
+    mentions = ['Paris', 'Paris', 'bank', 'bank', 'Nowhere', 'Ghost']
+    contexts = ['Paris is a city in Texas', 'Paris is the capital of France', 'the river bank',
+                'the bank has money', 'Nowhere', 'Ghost']
+    assert _urls(select_by_embedding(mentions, contexts, CANDIDATES, ENTITY_INFOS)) == \
+        ['paris-texas', 'paris-france', 'river-bank', 'money-bank', None, None]
+
+
+def test_sitelinks_break_ties_and_other_candidates_are_masked(embedding_linker):
+    #nothing in the sentence points to either candidate, the one with more sitelinks wins
+    assert _urls(select_by_embedding(['Paris', 'bank'], ['over there', 'something else'], CANDIDATES, ENTITY_INFOS)) == \
+        ['paris-france', 'money-bank']
+    #the sentence is closest to a candidate of another mention, which is not an option
+    assert _urls(select_by_embedding(['bank'], ['capital of France'], CANDIDATES, ENTITY_INFOS)) == ['money-bank']
+    assert select_by_embedding(['Nowhere'], ['Nowhere'], CANDIDATES, ENTITY_INFOS) == [None]
+
+
+def test_candidate_vectors_are_cached(embedding_linker):
+    select_by_embedding(['Paris', 'Paris'], ['a city in Texas', 'a city in Texas'], CANDIDATES, ENTITY_INFOS)
+    #one call for the candidates and one for the distinct sentences
+    assert embedding_linker == [['Paris, capital of France', 'Paris, city in Texas'], ['a city in Texas']]
+    embedding_linker.clear()
+    select_by_embedding(['Paris'], ['the capital of France'], CANDIDATES, ENTITY_INFOS)
+    assert embedding_linker == [['the capital of France']]
+    assert len(entity_extractor.get_vector_cache()) == 2
@@ -0,0 +1,78 @@
+import pytest
+
+import fact_checker
+import wikidata_cache
+from fact_checker import MAX_QUERY_CHARS, MAX_TRIPLES_PER_QUERY, ask_triples, check_triples
+from wikidata_standin import CAPITAL, CAPITAL_OF, COUNTRY
+
+
+@pytest.fixture
+def facts(world):
+    """
+    Statements of the synthetic world that are true and ones that are false, interleaved.
+    """
+    _, countries = world
+    triples, expected = [], []
+    for country_id, _, capital_id, _, cities in countries:
+        city_id = cities[0][0]
+        for triple, answer in (((capital_id, CAPITAL_OF, country_id), True), ((city_id, CAPITAL_OF, country_id), False),
+                               ((country_id, CAPITAL, capital_id), True), ((country_id, CAPITAL, city_id), False),
+                               ((city_id, COUNTRY, country_id), True), ((country_id, COUNTRY, city_id), False)):
+            triples.append(triple)
+            expected.append(answer)
+    return triples, expected
+
+
+def test_answers_map_back_to_their_triples(standin, facts):
+    triples, expected = facts
+    fact_checker.configure_entailment_backend(None)
+    #repeated triples are answered once and every position still gets its answer
+    triples = triples + triples[::-1]
+    expected = expected + expected[::-1]
+    assert ask_triples(triples) == expected
+    assert check_triples(triples) == expected
+    assert standin.stats().get('sparql_values') == 2
+    assert 'sparql' not in standin.stats()
+
+
+def test_malformed_ids_do_not_fail_the_batch(standin, facts):
+    triples, expected = facts
+    malformed = [('Q1 ', 'P17', 'Q2'), ('Q1', 'wdt:P17', 'Q2'), ('', '', ''), ('Q1} . ?s ?p ?o {', 'P17', 'Q2'),
+                 ('P17', 'P17', 'Q2'), ('Q1', 'P17', 'q2')]
+    assert ask_triples(malformed[:3] + triples + malformed[3:]) == [False] * 3 + expected + [False] * 3
+    assert standin.stats().get('sparql_values') == 1
+    #nothing to send at all
+    standin.reset_stats()
+    assert ask_triples(malformed) == [False] * len(malformed)
+    assert ask_triples([]) == []
+    assert standin.stats() == {}
+
+
+def test_large_inputs_are_split(standin):
+    #short ids, so the number of triples is the limit: 450 triples are 200 + 200 + 50
+    short = [(f'Q{i}', 'P17', f'Q{i + 1}') for i in range(450)]
+    assert ask_triples(short) == [False] * 450
+    assert standin.stats()['sparql_values'] == 3
+
+    #long ids, so the query length is the limit: a row takes the length of its ids plus 16 characters
+    standin.reset_stats()
+    long = [(f'Q{900000000 + i}', 'P17', f'Q{800000000 + i}') for i in range(400)]
+    per_query = MAX_QUERY_CHARS // (10 + 3 + 10 + 16)
+    assert per_query < MAX_TRIPLES_PER_QUERY
+    assert ask_triples(long) == [False] * 400
+    assert standin.stats()['sparql_values'] == -(-400 // per_query)
+
+
+def test_repeated_checks_come_from_the_cache(standin, facts):
+    triples, expected = facts
+    wikidata_cache.configure_cache(path=None)
+    try:
+        assert ask_triples(triples) == expected
+        assert standin.stats()['sparql_values'] == 1
+        standin.reset_stats()
+        assert ask_triples(triples) == expected
+        #single checks share the cache entries of the batched ones
+        assert fact_checker.ask_triple(*triples[0]) is expected[0]
+        assert standin.stats() == {}
+    finally:
+        wikidata_cache.configure_cache(path=None, enabled=False)
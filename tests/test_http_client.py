@@ -0,0 +1,45 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_client
+from http_client import HTTPClient, WikidataHTTPError
+
+
+@pytest.fixture
+def unavailable():
+    """
+    A server that answers every request with 503 and an hour long Retry-After.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(503)
+            self.send_header('Retry-After', '3600')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/w/api.php'
+    server.shutdown()
+    server.server_close()
+
+
+def test_retry_after_is_capped_and_last_attempt_does_not_sleep(unavailable, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(http_client.time, 'sleep', sleeps.append)
+    client = HTTPClient(max_retries=2, requests_per_second=0)
+    with pytest.raises(WikidataHTTPError, match='failed after 3 attempts'):
+        client.get_json(unavailable)
+    assert sleeps == [http_client.MAX_RETRY_AFTER] * 2
+
+
+def test_replaying_a_missing_cassette(tmp_path):
+    with pytest.raises(FileNotFoundError, match='--cassette'):
+        HTTPClient(mode='replay', cassette_path=str(tmp_path / 'missing.cassette'))
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import StagedExecutor
+
+
+def _slow_square(x):
+    #later items finish first with several workers
+    time.sleep(0.001 * (x % 5))
+    return x * x
+
+
+def _threads_left(before, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        left = [thread for thread in threading.enumerate() if thread not in before and thread.is_alive()]
+        if not left or time.monotonic() > deadline:
+            return left
+        time.sleep(0.01)
+
+
+def test_results_come_out_in_input_order():
+    before = set(threading.enumerate())
+    executor = StagedExecutor([('square', _slow_square, 3), ('add', lambda x: x + 1, 1)], queue_size=2)
+    assert list(executor.run(range(50))) == [x * x + 1 for x in range(50)]
+    stats = executor.stats()
+    assert stats['square']['items'] == stats['add']['items'] == 50
+    assert _threads_left(before) == []
+
+
+def test_early_close_stops_every_thread():
+    before = set(threading.enumerate())
+    executor = StagedExecutor([('square', _slow_square, 2), ('add', lambda x: x + 1, 2)], queue_size=1)
+    results = executor.run(iter(range(1000)))
+    assert [next(results) for _ in range(3)] == [1, 2, 5]
+    results.close()
+    assert _threads_left(before) == []
+    #the input is not consumed to the end
+    assert executor.stats()['square']['items'] < 1000
+
+
+def test_stage_failure_is_raised_and_stops_every_thread():
+    def fail_on_seven(x):
+        if x == 7:
+            raise ValueError('seven')
+        return x
+
+    before = set(threading.enumerate())
+    executor = StagedExecutor([('check', fail_on_seven, 2), ('square', _slow_square, 1)], queue_size=1)
+    results = []
+    with pytest.raises(ValueError, match='seven'):
+        for result in executor.run(range(1000)):
+            results.append(result)
+    assert results == [x * x for x in range(len(results))]
+    assert len(results) <= 7
+    assert _threads_left(before) == []
+
+
+def test_input_failure_is_raised():
+    def items():
+        yield 1
+        raise RuntimeError('broken input')
+
+    before = set(threading.enumerate())
+    with pytest.raises(RuntimeError, match='broken input'):
+        list(StagedExecutor([('same', lambda x: x, 1)]).run(items()))
+    assert _threads_left(before) == []
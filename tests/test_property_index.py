@@ -0,0 +1,58 @@
+import os
+import pickle
+
+import property_index
+from property_index import build_property_index, count_digits, get_property_index, parse_counts
+
+
+def test_default_sources_do_not_depend_on_the_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(property_index, '_property_index', None)
+    index = get_property_index(path=str(tmp_path / 'relations.idx.pkl'))
+    assert index is not None
+    assert index.lookup('capital') == 'P36'
+
+
+def test_missing_index_and_sources(tmp_path, monkeypatch):
+    monkeypatch.setattr(property_index, '_property_index', None)
+    assert get_property_index(path=str(tmp_path / 'relations.idx.pkl'), sources=[str(tmp_path / 'relations.csv')]) is None
+
+
+def test_reference_counts(tmp_path):
+    source = tmp_path / 'relations.csv'
+    source.write_text('ID;label;description;Data type;Counts\n'
+                      'P248;stated in;source of a claim;WI;"104,930,285 R\n168 Q\n16 N"\n'
+                      'P210;party chief representative;chief representative of a party;WI;"2,924 Q\n308 M\n10 N"\n',
+                      encoding='utf-8')
+    index = build_property_index([str(source)], str(tmp_path / 'relations.idx.pkl'))
+
+    stated_in = index['properties']['P248']
+    assert (stated_in['main'], stated_in['qualifier'], stated_in['reference'], stated_in['other']) == (0, 168, 104930285, 16)
+    #the 'count' column of the xlsx: digits before the main count
+    assert stated_in['count'] == 0
+    assert index['properties']['P210']['count'] == 7
+
+
+def test_parse_counts():
+    assert parse_counts('46,674 M_x000D_\n76 N') == {'main': 46674, 'qualifier': 0, 'reference': 0, 'other': 76}
+    assert parse_counts(None) == {'main': 0, 'qualifier': 0, 'reference': 0, 'other': 0}
+    assert count_digits('46,674 M\n76 N') == 5
+    assert count_digits('5,900,170 R\n8 N') == 0
+
+
+def test_index_of_another_version_is_rebuilt(tmp_path, monkeypatch):
+    source = tmp_path / 'relations.csv'
+    source.write_text('ID;label;description;Data type;Counts\nP36;capital;seat of government;WI;"1,000 M"\n',
+                      encoding='utf-8')
+    path = tmp_path / 'relations.idx.pkl'
+    build_property_index([str(source)], str(path))
+    with open(path, 'rb') as infile:
+        index = pickle.load(infile)
+    index['version'] = 0
+    with open(path, 'wb') as outfile:
+        pickle.dump(index, outfile)
+    #the stale index is newer than its source, so only the version tells it apart
+    os.utime(source, (0, 0))
+
+    monkeypatch.setattr(property_index, '_property_index', None)
+    assert get_property_index(path=str(path), sources=[str(source)]).lookup('capital') == 'P36'
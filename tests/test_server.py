@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from server import MicroBatcher
+
+
+class GatedProcessor:
+    """
+    Records the batches and holds the first one until it is released.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        self.started.set()
+        assert self.release.wait(5)
+        if 'fail' in items:
+            raise ValueError('bad batch')
+        return [item * 2 for item in items]
+
+
+def test_batches_are_limited_in_size():
+    processor = GatedProcessor()
+    batcher = MicroBatcher(processor, max_batch_size=4, max_wait=0.01)
+    first = batcher.submit(0)
+    assert processor.started.wait(5)
+    #these arrive while the first batch is processed and fill the next batches without waiting
+    futures = [batcher.submit(i) for i in range(1, 11)]
+    processor.release.set()
+    assert first.result(5) == 0
+    assert [future.result(5) for future in futures] == [2 * i for i in range(1, 11)]
+    assert processor.batches == [[0], [1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+
+    stats = batcher.stats()
+    assert (stats['batches'], stats['items'], stats['max_batch_size']) == (4, 11, 4)
+    batcher.stop()
+
+
+def test_a_batch_waits_at_most_max_wait():
+    processor = GatedProcessor()
+    processor.release.set()
+    batcher = MicroBatcher(processor, max_batch_size=100, max_wait=0.2)
+    start = time.perf_counter()
+    futures = [batcher.submit(1), batcher.submit(2)]
+    assert [future.result(5) for future in futures] == [2, 4]
+    seconds = time.perf_counter() - start
+    #the two items share a batch that waited for more until max_wait was over
+    assert processor.batches == [[1, 2]]
+    assert 0.2 <= seconds < 1.0
+    batcher.stop()
+
+
+def test_failed_batch_and_full_queue():
+    processor = GatedProcessor()
+    batcher = MicroBatcher(processor, max_batch_size=2, max_wait=0.01, max_queue=2)
+    failing = batcher.submit('fail')
+    assert processor.started.wait(5)
+    waiting = [batcher.submit(1), batcher.submit(2)]
+    with pytest.raises(queue.Full):
+        batcher.submit(3)
+    processor.release.set()
+
+    with pytest.raises(ValueError, match='bad batch'):
+        failing.result(5)
+    #the next batch is not affected by the failed one
+    assert [future.result(5) for future in waiting] == [2, 4]
+    stats = batcher.stats()
+    assert (stats['failed_batches'], stats['rejected'], stats['batches']) == (1, 1, 2)
+    batcher.stop()
+    assert not batcher.thread.is_alive()
+
+
+def test_stop_processes_the_waiting_items():
+    processor = GatedProcessor()
+    batcher = MicroBatcher(processor, max_batch_size=8, max_wait=5.0)
+    processor.release.set()
+    futures = [batcher.submit(i) for i in range(3)]
+    #stop does not wait for max_wait
+    start = time.perf_counter()
+    batcher.stop()
+    assert time.perf_counter() - start < 2.0
+    assert [future.result(0) for future in futures] == [0, 2, 4]
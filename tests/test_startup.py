@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmark import HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds the startup commands may take, above the benchmark budget so slow test machines do not fail it
+STARTUP_BUDGET = 1.0
+
+
+def _best_of(command, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_main_does_not_import_heavy_libraries():
+    check = f'import json, sys, main; print(json.dumps(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)))'
+    result = subprocess.run([sys.executable, '-c', check], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert json.loads(result.stdout) == []
+    for module in ('spacy', 'transformers', 'torch', 'llama_cpp', 'numpy', 'requests'):
+        assert module in HEAVY_MODULES
+
+
+def test_startup_time():
+    assert _best_of([sys.executable, '-c', 'import main']) < STARTUP_BUDGET
+    assert _best_of([sys.executable, 'main.py', '--help']) < STARTUP_BUDGET
@@ -0,0 +1,22 @@
+import socket
+import urllib.request
+
+from tracing import Tracer
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_metrics_port_is_bound_to_localhost():
+    port = _free_port()
+    tracer = Tracer(metrics_port=port)
+    try:
+        assert tracer.server.server_address[0] == '127.0.0.1'
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            assert response.status == 200
+            assert response.headers['Content-Type'].startswith('text/plain')
+    finally:
+        tracer.close()
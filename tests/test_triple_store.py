@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from triple_store import TripleStore, build_store
+from wikidata_standin import CAPITAL, CAPITAL_OF, COUNTRY, _item, synthetic_world
+
+
+def _claim(value, rank='normal', snaktype='value'):
+    snak = {'snaktype': snaktype}
+    if snaktype == 'value':
+        snak['datavalue'] = {'value': {'entity-type': 'item', 'numeric-id': value}}
+    return {'rank': rank, 'mainsnak': snak}
+
+
+@pytest.fixture
+def store(tmp_path):
+    entities, countries = synthetic_world(5)
+    #ranks: only the preferred statement of P6 is truthy, the deprecated P31 and the unknown value are left out,
+    #P17 has several objects and a duplicate
+    special = _item('Q7', 'Special', 'test item', 3)
+    special['claims'] = {'P6': [_claim(11), _claim(12, 'preferred'), _claim(13)],
+                         'P31': [_claim(5, 'deprecated'), _claim(6, snaktype='somevalue')],
+                         'P17': [_claim(30), _claim(20), _claim(30), _claim(10)]}
+    entities.append(special)
+    dump_path = tmp_path / 'dump.json'
+    with open(dump_path, 'w', encoding='utf-8') as dump:
+        dump.write('[\n' + ',\n'.join(json.dumps(entity) for entity in entities) + '\n]\n')
+
+    #a tiny chunk size so the statements are spilled to disk in several chunks
+    n_statements = build_store(str(dump_path), str(tmp_path / 'store'), chunk_size=4)
+    #every country has a capital, every city a country and every capital is the capital of its country
+    assert n_statements == len(countries) * (1 + 3 + 1) + 1 + 3
+    return TripleStore(str(tmp_path / 'store')), countries
+
+
+def test_ask(store):
+    triple_store, countries = store
+    for country_id, _, capital_id, _, cities in countries:
+        assert triple_store.ask(country_id, CAPITAL, capital_id)
+        assert triple_store.ask(capital_id, CAPITAL_OF, country_id)
+        for city_id, _ in cities:
+            assert triple_store.ask(city_id, COUNTRY, country_id)
+            assert not triple_store.ask(city_id, CAPITAL_OF, country_id)
+            assert not triple_store.ask(country_id, CAPITAL, city_id)
+        #reversed statements and unknown ids
+        assert not triple_store.ask(capital_id, CAPITAL, country_id)
+        assert not triple_store.ask('Q1', CAPITAL, capital_id)
+        assert not triple_store.ask(country_id, 'P999', capital_id)
+
+    assert triple_store.ask('Q7', 'P6', 'Q12')
+    assert not triple_store.ask('Q7', 'P6', 'Q11')
+    assert not triple_store.ask('Q7', 'P31', 'Q5')
+    assert not triple_store.ask(7, 31, 6)
+    assert triple_store.ask(7, 17, 20)
+
+
+def test_objects_and_subjects(store):
+    triple_store, countries = store
+    country_id, _, capital_id, _, cities = countries[0]
+    assert triple_store.objects_of(country_id, CAPITAL) == [capital_id]
+    assert triple_store.subjects_of(COUNTRY, country_id) == sorted([capital_id] + [city_id for city_id, _ in cities],
+                                                                  key=lambda entity_id: int(entity_id[1:]))
+    assert triple_store.subjects_of(CAPITAL_OF, country_id) == [capital_id]
+    #sorted and without duplicates
+    assert triple_store.objects_of('Q7', 'P17') == ['Q10', 'Q20', 'Q30']
+    assert triple_store.subjects_of('P17', 'Q30') == ['Q7']
+    assert triple_store.objects_of('Q7', 'P31') == []
+    assert triple_store.objects_of('Q8', 'P17') == []
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from util import ResultWriter, format_record, journal_path, load_checkpoint
+
+QUESTIONS = [(f'question-{i:03d}', f'Is Café {i} in Paris?') for i in range(1, 11)]
+
+
+def _write(writer, q_id, text):
+    if q_id.endswith('4'):
+        writer.write_error(q_id, 'no answer', text)
+    else:
+        writer.append(q_id, text, 'yes', 'correct', [('Paris', 'Q90', 'https://en.wikipedia.org/wiki/Paris')])
+
+
+def _run(path, questions, mode='w'):
+    with ResultWriter(str(path), mode=mode, max_buffer_bytes=1) as writer:
+        for q_id, text in questions:
+            _write(writer, q_id, text)
+
+
+@pytest.fixture
+def uninterrupted(tmp_path):
+    path = tmp_path / 'complete.txt'
+    _run(path, QUESTIONS)
+    return path.read_bytes()
+
+
+TORN = format_record(QUESTIONS[6][0], QUESTIONS[6][1], 'yes', 'correct').encode()
+FIRST_LINE = TORN.index(b'\n') + 1
+
+
+#where the records of the 7th question are cut off, and how many questions count as complete without a journal
+#(the last question with a whole line in the output might be cut off, so it is answered again)
+@pytest.mark.parametrize('cut, complete_without_journal', [(5, 5), (FIRST_LINE + 5, 6), (len(TORN) // 2, 6)])
+@pytest.mark.parametrize('keep_journal', [True, False])
+def test_resume_after_a_torn_write(tmp_path, uninterrupted, keep_journal, cut, complete_without_journal):
+    path = tmp_path / 'out.txt'
+    _run(path, QUESTIONS[:6])
+    #the crash happens while the records of the 7th question are written, its journal entry is cut off too
+    with open(path, 'ab') as outfile:
+        outfile.write(TORN[:cut])
+    with open(journal_path(str(path)), 'a') as journal:
+        journal.write(f'{QUESTIONS[6][0]}\t{os.path.getsize(path)}')
+    if not keep_journal:
+        os.remove(journal_path(str(path)))
+
+    completed = load_checkpoint(str(path))
+    assert completed == {q_id for q_id, _ in QUESTIONS[:6 if keep_journal else complete_without_journal]}
+    _run(path, [question for question in QUESTIONS if question[0] not in completed], mode='a')
+    assert path.read_bytes() == uninterrupted
+
+    #the journal matches the resumed output, so a second resume has nothing left to do
+    assert load_checkpoint(str(path)) == {q_id for q_id, _ in QUESTIONS}
+    assert path.read_bytes() == uninterrupted
@@ -0,0 +1,73 @@
+import bz2
+import json
+
+import pytest
+
+from wikidata_index import LabelIndex, build_index
+from wikidata_standin import _item, synthetic_world
+
+
+@pytest.fixture
+def index(tmp_path):
+    entities, countries = synthetic_world(5)
+    #two items with the same label and an alias shared by two capitals, to check the ranking
+    entities.append(_item('Q1', 'Springfield', 'city in Illinois', 60))
+    entities.append(_item('Q2', 'Springfield', 'city in Massachusetts', 30))
+    capitals = [entity for entity in entities if entity['id'] in {countries[0][2], countries[1][2]}]
+    for entity in capitals:
+        entity['aliases'] = {'en': [{'language': 'en', 'value': 'Old Town'}]}
+    dump_path = tmp_path / 'dump.json.bz2'
+    with bz2.open(dump_path, 'wt', encoding='utf-8') as dump:
+        dump.write('[\n' + ',\n'.join(json.dumps(entity) for entity in entities) + '\n]\n')
+
+    #a small run size so the records are merged from several sorted runs
+    n_entities, n_keys = build_index(str(dump_path), str(tmp_path / 'labels.idx'), run_size=4)
+    items = [entity for entity in entities if entity['type'] == 'item']
+    assert n_entities == len(items)
+    assert n_keys == len(items) + len(capitals)
+
+    label_index = LabelIndex(str(tmp_path / 'labels.idx'))
+    yield label_index, entities, countries, capitals
+    label_index.close()
+
+
+def test_exact_lookup(index):
+    label_index, entities, countries, _ = index
+    country_id, country_name, capital_id, capital_name, _ = countries[0]
+    sitelinks = {entity['id']: len(entity.get('sitelinks', {})) for entity in entities}
+
+    assert label_index.lookup(country_name) == [(country_id, sitelinks[country_id])]
+    #lookups are normalized (case and whitespace)
+    assert label_index.lookup(f'  {capital_name.upper()} ') == [(capital_id, sitelinks[capital_id])]
+    assert label_index.lookup(country_name[:-1]) == []
+    assert label_index.lookup('capital') == []
+
+    stored = label_index.entity(capital_id)
+    assert stored['label'] == capital_name
+    assert stored['description'] == f'city in {country_name}'
+    assert stored['url'] == 'https://en.wikipedia.org/wiki/' + capital_name
+    assert label_index.entity('Q999') is None
+
+
+def test_alias_lookup_is_ranked_by_sitelinks(index):
+    label_index, _, _, capitals = index
+    expected = sorted(((entity['id'], len(entity['sitelinks'])) for entity in capitals),
+                      key=lambda item: (-item[1], item[0]))
+    assert label_index.lookup('old town') == expected
+    assert label_index.lookup('Springfield') == [('Q1', 60), ('Q2', 30)]
+    assert label_index.lookup('Springfield', limit=1) == [('Q1', 60)]
+
+
+def test_prefix_lookup(index):
+    label_index, entities, countries, _ = index
+    names = {entity['id']: entity['labels']['en']['value'] for entity in entities if entity['type'] == 'item'}
+    sitelinks = {entity['id']: len(entity['sitelinks']) for entity in entities if entity['type'] == 'item'}
+    country_name = countries[0][1]
+    prefix = country_name[:3]
+
+    expected = sorted(((entity_id, sitelinks[entity_id]) for entity_id, name in names.items()
+                       if name.lower().startswith(prefix.lower())), key=lambda item: (-item[1], item[0]))
+    assert (countries[0][0], sitelinks[countries[0][0]]) in expected
+    assert label_index.prefix_lookup(prefix) == expected
+    assert label_index.prefix_lookup('spring') == [('Q1', 60), ('Q2', 30)]
+    assert label_index.prefix_lookup('zzz') == []
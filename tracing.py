@@ -0,0 +1,276 @@
+import contextvars
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds (seconds) of the histogram buckets of the stage durations
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_PREFIX = 'wdps'
+# the metrics endpoint is only reachable from this machine unless another host is given
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+# the tracer in use, None when tracing is off: span() and count() then return right away
+_tracer = None
+# the innermost open span of the current thread/task, asyncio.to_thread copies it into its threads
+_active_span = contextvars.ContextVar('active_span', default=None)
+
+
+class _NoSpan:
+    """
+    What span() returns when tracing is off, it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    """
+    A timed stage, written as one JSON line when it ends.
+
+    Counts (HTTP requests, cache hits, model calls, ...) made while the span is open are added to the span
+    and to all its parents.
+    """
+
+    def __init__(self, tracer, name, q_id=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.id = next(tracer.ids)
+        self.parent = _active_span.get()
+        self.q_id = q_id if q_id is not None else getattr(self.parent, 'q_id', None)
+        self.attributes = attributes or {}
+        self.counts = dict()
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.token = _active_span.set(self)
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _active_span.reset(self.token)
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        self.tracer.finish(self, seconds)
+        return False
+
+
+class Tracer:
+    """
+    Collects spans and metrics.
+
+    Args:
+        spans_path (str): JSONL file every finished span is appended to, None keeps only the metrics.
+        metrics_path (str): File the metrics are written to in the Prometheus text format (every
+            metrics_interval seconds and on close).
+        metrics_port (int): Serve the metrics on http://metrics_host:port/metrics.
+        metrics_interval (float): Seconds between writes of the metrics file.
+        metrics_host (str): Address the metrics port is bound to, '0.0.0.0' for every interface.
+    """
+
+    def __init__(self, spans_path=None, metrics_path=None, metrics_port=None, metrics_interval=10.0,
+                 metrics_host=DEFAULT_METRICS_HOST):
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        #line buffered, worker processes can end without closing the tracer
+        self.spans_file = open(spans_path, 'a', encoding='utf-8', buffering=1) if spans_path else None
+        self.metrics_path = metrics_path
+        self.histograms = dict()
+        self.counters = dict()
+        self.collectors = []
+        self.server = None
+        self.stop = threading.Event()
+
+        if metrics_port:
+            self.server = ThreadingHTTPServer((metrics_host, metrics_port), self._handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if metrics_path:
+            threading.Thread(target=self._write_periodically, args=(metrics_interval,), daemon=True).start()
+
+    def finish(self, span, seconds):
+        record = {'id': span.id, 'parent': span.parent.id if span.parent else None, 'name': span.name,
+                  'q_id': span.q_id, 'start': span.wall_start, 'seconds': seconds, 'thread': threading.get_ident()}
+        if span.attributes:
+            record['attributes'] = span.attributes
+        if span.counts:
+            record['counts'] = span.counts
+        if span.error:
+            record['error'] = span.error
+
+        with self.lock:
+            histogram = self.histograms.setdefault(span.name, {'buckets': [0] * len(BUCKETS), 'sum': 0.0,
+                                                               'count': 0, 'errors': 0})
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            if span.error:
+                histogram['errors'] += 1
+            if self.spans_file is not None:
+                self.spans_file.write(json.dumps(record, default=str) + '\n')
+
+    def count(self, event, n=1):
+        span = _active_span.get()
+        #spans are shared with the threads asyncio.to_thread starts, so they are updated under the lock too
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+            while span is not None:
+                span.counts[event] = span.counts.get(event, 0) + n
+                span = span.parent
+
+    def add_collector(self, collector):
+        """
+        Adds a function that returns extra metrics as (name, type, help, [(labels dict, value)]) tuples,
+        it is called every time the metrics are exported.
+        """
+        self.collectors.append(collector)
+
+    def metrics_text(self):
+        """
+        Returns:
+            str: All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            histograms = {name: dict(h, buckets=list(h['buckets'])) for name, h in self.histograms.items()}
+            counters = dict(self.counters)
+
+        name = f'{METRIC_PREFIX}_stage_seconds'
+        lines += [f'# HELP {name} Duration of the pipeline stages.', f'# TYPE {name} histogram']
+        for stage, histogram in sorted(histograms.items()):
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+        name = f'{METRIC_PREFIX}_stage_errors_total'
+        lines += [f'# HELP {name} Pipeline stages that raised an exception.', f'# TYPE {name} counter']
+        for stage, histogram in sorted(histograms.items()):
+            lines.append(f'{name}{{stage="{stage}"}} {histogram["errors"]}')
+
+        name = f'{METRIC_PREFIX}_events_total'
+        lines += [f'# HELP {name} Events counted in the pipeline (HTTP requests, cache hits, model calls, ...).',
+                  f'# TYPE {name} counter']
+        for event, count in sorted(counters.items()):
+            lines.append(f'{name}{{event="{event}"}} {count}')
+
+        for collector in self.collectors:
+            for metric, kind, description, samples in collector():
+                metric = f'{METRIC_PREFIX}_{metric}'
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}']
+                for labels, value in samples:
+                    label_text = ','.join(f'{key}="{label}"' for key, label in sorted(labels.items()))
+                    lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics(self):
+        directory = os.path.dirname(os.path.abspath(self.metrics_path))
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        with os.fdopen(handle, 'w', encoding='utf-8') as outfile:
+            outfile.write(self.metrics_text())
+        os.replace(tmp_path, self.metrics_path)
+
+    def _write_periodically(self, interval):
+        while not self.stop.wait(interval):
+            self.write_metrics()
+
+    def _handler(self):
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = tracer.metrics_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def close(self):
+        self.stop.set()
+        if self.metrics_path:
+            self.write_metrics()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        with self.lock:
+            if self.spans_file is not None:
+                self.spans_file.close()
+                self.spans_file = None
+
+
+def span(name, q_id=None, **attributes):
+    """
+    Context manager that times a stage, e.g. `with span('link', q_id=q_id): ...`.
+
+    The question id is inherited from the enclosing span when it is not given. When tracing is off this
+    returns a shared object that does nothing.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+    return Span(tracer, name, q_id, attributes)
+
+
+def count(event, n=1):
+    """
+    Counts an event (e.g. 'http_requests', 'cache_hits') in the metrics and the open spans.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.count(event, n)
+
+
+def configure_tracing(spans_path=None, metrics_path=None, metrics_port=None, metrics_interval=10.0,
+                      metrics_host=DEFAULT_METRICS_HOST):
+    """
+    Turns tracing on when any output is given and off otherwise (closing the previous tracer).
+
+    Returns:
+        Tracer: The new tracer or None.
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+    if spans_path or metrics_path or metrics_port:
+        _tracer = Tracer(spans_path, metrics_path, metrics_port, metrics_interval, metrics_host)
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def close_tracing():
+    configure_tracing()
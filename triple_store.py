@@ -0,0 +1,198 @@
+import argparse
+import os
+import tempfile
+from array import array
+
+import numpy as np
+
+from wikidata_index import iter_dump_entities
+
+# files of a store directory, all plain .npy arrays so they can be memory-mapped
+#   forward (sorted by subject, predicate, object):  subjects, subject_ptr, predicates, objects
+#   reverse (sorted by object, predicate, subject):  reverse_objects, object_ptr, reverse_predicates, reverse_subjects
+ARRAYS = ['subjects', 'subject_ptr', 'predicates', 'objects',
+          'reverse_objects', 'object_ptr', 'reverse_predicates', 'reverse_subjects']
+
+
+def to_int(entity_id):
+    """
+    Converts 'Q42' / 'P31' (or an int) to its numeric id.
+    """
+    if isinstance(entity_id, str):
+        return int(entity_id[1:])
+    return int(entity_id)
+
+
+def iter_truthy_statements(entity):
+    """
+    Yields the truthy (wdt:) item-valued statements of a dump entity as (subject, predicate, object) ints.
+
+    Truthy statements are the best ranked ones: the preferred statements of a property if there are any,
+    otherwise the normal ones. Deprecated statements and unknown/no values are left out.
+    """
+    entity_id = entity.get('id', '')
+    if not entity_id.startswith('Q'):
+        return
+    subject = int(entity_id[1:])
+
+    for property_id, claims in entity.get('claims', {}).items():
+        preferred = [claim for claim in claims if claim.get('rank') == 'preferred']
+        best = preferred or [claim for claim in claims if claim.get('rank', 'normal') == 'normal']
+        for claim in best:
+            snak = claim.get('mainsnak', {})
+            if snak.get('snaktype') != 'value':
+                continue
+            value = snak.get('datavalue', {}).get('value')
+            if not isinstance(value, dict) or value.get('entity-type') != 'item':
+                continue
+            yield subject, int(property_id[1:]), int(value['numeric-id'])
+
+
+def _csr(keys, middle, values):
+    """
+    Builds a CSR adjacency (unique keys, pointers, middle, values) from triples sorted by (key, middle, value).
+    """
+    unique_keys, starts = np.unique(keys, return_index=True)
+    pointers = np.append(starts, len(keys)).astype(np.int64)
+    return unique_keys, pointers, middle, values
+
+
+def build_store(dump_path, store_dir, chunk_size=1000000):
+    """
+    Builds a triple store with the truthy item-valued statements of a wikidata JSON dump (subset).
+
+    The statements are streamed to a temporary file in chunks, then sorted and written as CSR style adjacency
+    arrays in both directions.
+
+    Args:
+        dump_path (str): The (bz2/gz compressed) JSON dump or a filtered subset of it.
+        store_dir (str): Directory the .npy arrays are written to.
+        chunk_size (int): Number of statements buffered in memory while reading the dump.
+
+    Returns:
+        int: The number of distinct statements.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=store_dir, suffix='.raw') as raw:
+        buffer = array('I')
+        for entity in iter_dump_entities(dump_path):
+            for statement in iter_truthy_statements(entity):
+                buffer.extend(statement)
+            if len(buffer) >= 3 * chunk_size:
+                buffer.tofile(raw)
+                buffer = array('I')
+        buffer.tofile(raw)
+        raw.flush()
+
+        triples = np.fromfile(raw.name, dtype=np.uint32).reshape(-1, 3)
+
+    triples = np.unique(triples, axis=0)
+    subjects, predicates, objects = triples[:, 0], triples[:, 1], triples[:, 2]
+
+    forward = _csr(subjects, np.ascontiguousarray(predicates), np.ascontiguousarray(objects))
+    order = np.lexsort((subjects, predicates, objects))
+    reverse = _csr(objects[order], predicates[order], subjects[order])
+
+    for name, values in zip(ARRAYS, forward + reverse):
+        np.save(os.path.join(store_dir, name + '.npy'), np.ascontiguousarray(values))
+    return len(triples)
+
+
+class TripleStore:
+    """
+    Memory-mapped store of truthy statements built by build_store.
+
+    Args:
+        store_dir (str): Directory with the .npy arrays.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r'))
+
+    @staticmethod
+    def _range(keys, pointers, key):
+        i = np.searchsorted(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return 0, 0
+        return int(pointers[i]), int(pointers[i + 1])
+
+    @staticmethod
+    def _sub_range(values, low, high, value):
+        start = low + int(np.searchsorted(values[low:high], value, side='left'))
+        end = low + int(np.searchsorted(values[low:high], value, side='right'))
+        return start, end
+
+    def ask(self, subject, predicate, obj):
+        """
+        ASK { wd:subject wdt:predicate wd:obj }
+
+        Args:
+            subject, predicate, obj: Ids like 'Q90', 'P17', 'Q142' (or their numbers).
+
+        Returns:
+            bool: True if the statement is in the store.
+        """
+        low, high = self._range(self.subjects, self.subject_ptr, to_int(subject))
+        start, end = self._sub_range(self.predicates, low, high, to_int(predicate))
+        position = start + int(np.searchsorted(self.objects[start:end], to_int(obj)))
+        return position < end and int(self.objects[position]) == to_int(obj)
+
+    def objects_of(self, subject, predicate):
+        """
+        SELECT ?x { wd:subject wdt:predicate ?x }
+
+        Returns:
+            list: Item ids like 'Q142'.
+        """
+        low, high = self._range(self.subjects, self.subject_ptr, to_int(subject))
+        start, end = self._sub_range(self.predicates, low, high, to_int(predicate))
+        return [f'Q{value}' for value in self.objects[start:end]]
+
+    def subjects_of(self, predicate, obj):
+        """
+        SELECT ?x { ?x wdt:predicate wd:obj }
+
+        Returns:
+            list: Item ids like 'Q90'.
+        """
+        low, high = self._range(self.reverse_objects, self.object_ptr, to_int(obj))
+        start, end = self._sub_range(self.reverse_predicates, low, high, to_int(predicate))
+        return [f'Q{value}' for value in self.reverse_subjects[start:end]]
+
+    def __len__(self):
+        return len(self.objects)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query a local store of truthy wikidata statements.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='build a store from a (bz2/gz) wikidata JSON dump')
+    build.add_argument('dump')
+    build.add_argument('store')
+    build.add_argument('--chunk-size', type=int, default=1000000)
+
+    ask = subparsers.add_parser('ask', help='check if a statement exists, e.g. Q90 P17 Q142')
+    ask.add_argument('store')
+    ask.add_argument('subject')
+    ask.add_argument('predicate')
+    ask.add_argument('object')
+
+    objects = subparsers.add_parser('objects', help='list ?x in (subject, predicate, ?x)')
+    objects.add_argument('store')
+    objects.add_argument('subject')
+    objects.add_argument('predicate')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        print(f'Stored {build_store(args.dump, args.store, chunk_size=args.chunk_size)} statements.')
+    elif args.command == 'ask':
+        print(TripleStore(args.store).ask(args.subject, args.predicate, args.object))
+    else:
+        print(TripleStore(args.store).objects_of(args.subject, args.predicate))
+
+
+if __name__ == '__main__':
+    main()
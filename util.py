@@ -1,10 +1,28 @@
-import spacy
+import os
 import subprocess
+import time
+from importlib import metadata
+
+def format_error(q_id: str, msg:str, raw_response: str):
+    return f'{q_id}\tR"{raw_response}"\n' + f'{q_id}\tA"{msg}"\n'
+
+def format_record(q_id:str,
+                  raw_response:str,
+                  answer:str = 'N/A',
+                  correctness:str = 'N/A',
+                  entities:list = []
+                  ):
+    
+    lines = [f'{q_id}\tR"{raw_response}"\n',
+             f'{q_id}\tA"{answer}"\n',
+             f'{q_id}\tC"{correctness}"\n']
+    for entity, _, url in entities:
+        lines.append(f'{q_id}\tE"{entity}"\t"{url}"\n')
+    return ''.join(lines)
 
 def write_error(q_id: str, msg:str, path:str, raw_response: str):
      with open(path, 'a') as outfile:
-        outfile.write(f'{q_id}\tR"{raw_response}"\n')
-        outfile.write(f'{q_id}\tA"{msg}"\n')
+        outfile.write(format_error(q_id, msg, raw_response))
 
 def append_outfile(path:str,
                    q_id:str,
@@ -15,41 +33,164 @@ def append_outfile(path:str,
                    ):
     
     with open(path, 'a') as outfile:
-        outfile.write(f'{q_id}\tR"{raw_response}"\n')
-        outfile.write(f'{q_id}\tA"{answer}"\n')
-        outfile.write(f'{q_id}\tC"{correctness}"\n')
-        for entity, _, url in entities:
-            outfile.write(f'{q_id}\tE"{entity}"\t"{url}"\n')
+        outfile.write(format_record(q_id, raw_response, answer, correctness, entities))
 
-def read_input(path):
+class ResultWriter:
+    """
+    Keeps the output file open for the whole run and writes the records in the append_outfile format.
+
+    Records are buffered and written once the buffer holds max_buffer_bytes characters
+    or max_delay seconds have passed since the last flush.
+
+    After the records of a question are safely on disk, the question id and the end offset of its
+    records are appended to a journal next to the output file (see load_checkpoint), so a crashed run
+    can be resumed without re-answering the questions that were already written.
+    """
+    
+    def __init__(self, path, mode='w', max_buffer_bytes=1 << 20, max_delay=5.0, journal=True):
+        self.path = path
+        self.file = open(path, mode)
+        self.offset = self.file.tell() if mode == 'a' else 0
+        self.journal = open(journal_path(path), mode) if journal else None
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_delay = max_delay
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+    
+    def write(self, text, q_id=None):
+        """
+        Buffers the records of one question, they are written (and journaled) together.
+        """
+        self.buffer.append((q_id, text))
+        self.buffered += len(text)
+        if self.buffered >= self.max_buffer_bytes or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
     
-    output = dict()
+    def write_error(self, q_id: str, msg: str, raw_response: str):
+        self.write(format_error(q_id, msg, raw_response), q_id=q_id)
+    
+    def append(self, q_id:str, raw_response:str, answer:str = 'N/A', correctness:str = 'N/A', entities:list = []):
+        self.write(format_record(q_id, raw_response, answer, correctness, entities), q_id=q_id)
+    
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(text for _, text in self.buffer))
+            self.file.flush()
+            
+            if self.journal is not None:
+                #the records have to be on disk before the journal says they are complete
+                os.fsync(self.file.fileno())
+                entries = []
+                for q_id, text in self.buffer:
+                    self.offset += len(text.encode(self.file.encoding))
+                    if q_id is not None:
+                        entries.append(f'{q_id}\t{self.offset}\n')
+                self.journal.write(''.join(entries))
+                self.journal.flush()
+            
+            self.buffer = []
+            self.buffered = 0
+        self.last_flush = time.monotonic()
+    
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+            if self.journal is not None:
+                self.journal.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def journal_path(path):
+    return path + '.journal'
+
+def load_checkpoint(path):
+    """
+    Finds the questions that are already completely written to the output file of an earlier run.
+
+    The journal is used when it exists. Without a journal the output file itself is read and every question
+    except the last one is considered complete (the last one might have been cut off).
+    Anything after the last complete question is truncated and the journal is rewritten to match,
+    so the output file can be opened in append mode afterwards.
+
+    Args:
+        path (str): The output file.
+
+    Returns:
+        set: The ids of the completed questions.
+    """
+    completed = dict()
+    
+    if os.path.exists(journal_path(path)):
+        with open(journal_path(path), 'r') as journal:
+            for line in journal:
+                #an unfinished last line means the journal write was interrupted
+                if not line.endswith('\n'):
+                    break
+                q_id, offset = line.rstrip('\n').split('\t')
+                completed[q_id] = int(offset)
+    
+    elif os.path.exists(path):
+        offset = 0
+        last_id = None
+        with open(path, 'rb') as outfile:
+            for line in outfile:
+                #an unfinished last line can be cut off anywhere, even inside the question id
+                if not line.endswith(b'\n'):
+                    break
+                q_id = line.split(b'\t', 1)[0].decode()
+                if q_id != last_id and last_id is not None:
+                    completed[last_id] = offset
+                last_id = q_id
+                offset += len(line)
+    
+    committed = max(completed.values(), default=0)
+    if os.path.exists(path) and os.path.getsize(path) > committed:
+        with open(path, 'r+b') as outfile:
+            outfile.truncate(committed)
+    
+    with open(journal_path(path), 'w') as journal:
+        journal.write(''.join(f'{q_id}\t{offset}\n' for q_id, offset in completed.items()))
+    
+    return set(completed)
+
+def iter_input(path):
+    """
+    Yields the (q_id, q_text) pairs of the input file one line at a time.
+    """
     
     with open(path, 'r') as infile:
-        content = infile.readlines()
-        
-    for line in content:
-        
-        if not line.startswith('question-'):
-            continue
-        
-        q_id, q_text = line.split('\t')
-        output[q_id] = q_text.rstrip('\n')
+        for line in infile:
+            
+            if not line.startswith('question-'):
+                continue
+            
+            q_id, q_text = line.split('\t')
+            yield q_id, q_text.rstrip('\n')
 
-    return output
+def read_input(path):
+    
+    return dict(iter_input(path))
 
 def ensure_model_installed(model_name="en_core_web_md"):
     """
     Ensure the specified spaCy model is installed. Install it if not available.
 
+    spaCy models are installed as python packages, so the package metadata tells whether it is there
+    without importing spaCy or loading the model (that happens when the first text is parsed).
+
     Args:
         model_name (str): Name of the spaCy model to check or install.
     """
     try:
-        # Try to load the model to check if it's installed
-        spacy.load(model_name)
-        print(f"Model '{model_name}' is already installed.")
-    except OSError:
+        version = metadata.version(model_name)
+        print(f"Model '{model_name}' {version} is already installed.")
+    except metadata.PackageNotFoundError:
         print(f"Model '{model_name}' not found. Installing...")
         # Install the model using subprocess
         subprocess.check_call(["python", "-m", "spacy", "download", model_name])
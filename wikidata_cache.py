@@ -0,0 +1,201 @@
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from tracing import count
+
+DAY = 24 * 60 * 60
+
+# how long a cached answer stays valid per kind of lookup (in seconds)
+DEFAULT_TTLS = {
+    'candidates': 7 * DAY,
+    'entity': 7 * DAY,
+    'search_id': 30 * DAY,
+    'ask': 7 * DAY,
+}
+DEFAULT_TTL = 7 * DAY
+
+# "no results" answers are cached too, but for a shorter time so new wikidata items show up
+NEGATIVE_TTL = DAY
+
+DEFAULT_CACHE_PATH = os.environ.get('WIKIDATA_CACHE', '.wikidata_cache.sqlite')
+
+
+def is_negative(value):
+    return value is None or value is False or value == [] or value == {}
+
+
+class WikidataCache:
+    """
+    Two level cache for wikidata lookups: an in-memory LRU in front of a SQLite file that survives restarts.
+
+    Values are stored as JSON, so only JSON serializable results can be cached.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_memory_items=10000, ttls=None, negative_ttl=NEGATIVE_TTL):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.negative_ttl = negative_ttl
+        self.memory = OrderedDict()
+        self.counters = dict()
+        self.lock = threading.RLock()
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                            'kind TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (kind, key))')
+            self.db.commit()
+
+    def _count(self, kind, event):
+        counts = self.counters.setdefault(kind, {'memory_hits': 0, 'disk_hits': 0, 'negative_hits': 0, 'misses': 0})
+        counts[event] += 1
+        count('cache_' + event)
+
+    def get(self, kind, key):
+        """
+        Look up a cached value.
+
+        Args:
+            kind (str): Kind of lookup (e.g. 'candidates'), used for TTLs and statistics.
+            key (str): Key within that kind.
+
+        Returns:
+            tuple: (found, value), found is False when the key is missing or expired.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get((kind, key))
+            if entry is not None and entry[1] > now:
+                self.memory.move_to_end((kind, key))
+                self._count(kind, 'memory_hits')
+                if is_negative(entry[0]):
+                    self._count(kind, 'negative_hits')
+                return True, entry[0]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT value, expires FROM cache WHERE kind = ? AND key = ?',
+                                      (kind, key)).fetchone()
+                if row is not None and row[1] > now:
+                    value = json.loads(row[0])
+                    self._remember(kind, key, value, row[1])
+                    self._count(kind, 'disk_hits')
+                    if is_negative(value):
+                        self._count(kind, 'negative_hits')
+                    return True, value
+
+            self._count(kind, 'misses')
+            return False, None
+
+    def set(self, kind, key, value):
+        """
+        Store a value, it expires after the TTL of its kind (or the negative TTL for empty results).
+        """
+        ttl = self.negative_ttl if is_negative(value) else self.ttls.get(kind, DEFAULT_TTL)
+        expires = time.time() + ttl
+        with self.lock:
+            self._remember(kind, key, value, expires)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO cache (kind, key, value, expires) VALUES (?, ?, ?, ?)',
+                                (kind, key, json.dumps(value), expires))
+                self.db.commit()
+
+    def _remember(self, kind, key, value, expires):
+        self.memory[(kind, key)] = (value, expires)
+        self.memory.move_to_end((kind, key))
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_or_compute(self, kind, key, compute):
+        """
+        Return the cached value for key, or call compute() and cache its result.
+
+        If compute raises, nothing is cached so transient errors are retried next time.
+        """
+        found, value = self.get(kind, key)
+        if found:
+            return value
+        value = compute()
+        self.set(kind, key, value)
+        return value
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss counters per kind plus a 'total' entry.
+        """
+        with self.lock:
+            total = {'memory_hits': 0, 'disk_hits': 0, 'negative_hits': 0, 'misses': 0}
+            for counts in self.counters.values():
+                for event, n in counts.items():
+                    total[event] += n
+            stats = {kind: dict(counts) for kind, counts in self.counters.items()}
+            stats['total'] = total
+            return stats
+
+    def purge_expired(self):
+        with self.lock:
+            now = time.time()
+            for k in [k for k, (_, expires) in self.memory.items() if expires <= now]:
+                del self.memory[k]
+            if self.db is not None:
+                self.db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+_cache = None
+_enabled = True
+
+
+def configure_cache(path=DEFAULT_CACHE_PATH, enabled=True, **kwargs):
+    """
+    (Re)configure the process-wide cache used by the cached lookups.
+
+    Args:
+        path (str): SQLite file to use, None keeps the cache in memory only.
+        enabled (bool): Set to False to bypass caching completely.
+        **kwargs: Passed on to WikidataCache (max_memory_items, ttls, negative_ttl).
+    """
+    global _cache, _enabled
+    if _cache is not None:
+        _cache.close()
+    _enabled = enabled
+    _cache = WikidataCache(path=path, **kwargs) if enabled else None
+    return _cache
+
+
+def get_cache():
+    global _cache
+    if _cache is None and _enabled:
+        _cache = WikidataCache()
+    return _cache
+
+
+def cached(kind):
+    """
+    Decorator that caches the results of a lookup function under the given kind.
+
+    The key is built from the call arguments, exceptions are not cached.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            if cache is None:
+                return function(*args, **kwargs)
+            key = json.dumps([function.__name__, args, sorted(kwargs.items())])
+            return cache.get_or_compute(kind, key, lambda: function(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,342 @@
+import argparse
+import bz2
+import gzip
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import unicodedata
+
+# On-disk layout (little endian), everything after the header is addressed by offset so the file can be memory-mapped:
+#   header    MAGIC, number of entities, number of keys, offsets of the entity table, key table and string blob
+#   entities  sorted by qid:  qid, sitelinks, label (offset, length), description (offset, length), enwiki title (offset, length)
+#   keys      sorted by (normalized label, -sitelinks, qid):  key (offset, length), qid, sitelinks
+#   strings   utf-8 blob the offsets point into
+MAGIC = b'WDLIDX01'
+HEADER = struct.Struct('<8sQQQQQ')
+ENTITY = struct.Struct('<IIQIQIQI')
+KEY = struct.Struct('<QIII')
+
+DEFAULT_LABEL_INDEX = os.environ.get('WIKIDATA_LABEL_INDEX')
+
+
+def normalize_label(text):
+    """
+    Normalizes a label or mention for lookups: unicode NFKC, case folded and with collapsed whitespace.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def open_dump(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def iter_dump_entities(path):
+    """
+    Streams the entities of a wikidata JSON dump (one entity per line inside a JSON array), in constant memory.
+
+    Args:
+        path (str): The dump, optionally compressed with bz2 or gzip.
+
+    Yields:
+        dict: Every entity.
+    """
+    with open_dump(path) as dump:
+        for line in dump:
+            line = line.strip().rstrip(',')
+            if not line or line in ('[', ']'):
+                continue
+            yield json.loads(line)
+
+
+def _sorted_runs(records, run_size, directory):
+    """
+    Sorts records (lists of str/int) in runs of run_size records that are written to temporary files.
+    """
+    paths = []
+    run = []
+
+    def flush():
+        run.sort()
+        handle, path = tempfile.mkstemp(suffix='.jsonl', dir=directory)
+        with os.fdopen(handle, 'w', encoding='utf-8') as outfile:
+            for record in run:
+                outfile.write(json.dumps(record, ensure_ascii=False) + '\n')
+        paths.append(path)
+        run.clear()
+
+    for record in records:
+        run.append(record)
+        if len(run) >= run_size:
+            flush()
+    if run:
+        flush()
+    return paths
+
+
+def _merge_runs(paths):
+    files = [open(path, 'r', encoding='utf-8') for path in paths]
+    try:
+        yield from heapq.merge(*[(json.loads(line) for line in f) for f in files])
+    finally:
+        for f in files:
+            f.close()
+
+
+class _StringWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+
+    def add(self, text):
+        data = text.encode('utf-8')
+        offset = self.offset
+        self.f.write(data)
+        self.offset += len(data)
+        return offset, len(data)
+
+
+def build_index(dump_path, index_path, languages=('en',), min_sitelinks=0, run_size=500000):
+    """
+    Builds a label index from a wikidata JSON dump.
+
+    Every normalized label and alias (in the given languages) of every item is mapped to its QID, with the
+    sitelink count as popularity prior. The english label, description and wikipedia title are stored per item.
+    The records are sorted externally in runs of run_size, so memory use does not grow with the dump size.
+
+    Args:
+        dump_path (str): The (bz2/gz compressed) JSON dump or a filtered subset of it.
+        index_path (str): Where to write the index.
+        languages (tuple): Languages whose labels and aliases become lookup keys.
+        min_sitelinks (int): Skip items with fewer sitelinks.
+        run_size (int): Number of records sorted in memory at once.
+
+    Returns:
+        tuple: (number of entities, number of keys)
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(index_path))) as tmp:
+        entity_dir = os.path.join(tmp, 'entities')
+        key_dir = os.path.join(tmp, 'keys')
+        os.mkdir(entity_dir)
+        os.mkdir(key_dir)
+
+        key_records = []
+        key_runs = []
+
+        def entity_records():
+            for entity in iter_dump_entities(dump_path):
+                entity_id = entity.get('id', '')
+                if entity.get('type') != 'item' or not entity_id.startswith('Q'):
+                    continue
+                sitelinks = entity.get('sitelinks', {})
+                if len(sitelinks) < min_sitelinks:
+                    continue
+                qid = int(entity_id[1:])
+
+                keys = set()
+                for language in languages:
+                    label = entity.get('labels', {}).get(language, {}).get('value')
+                    if label:
+                        keys.add(normalize_label(label))
+                    for alias in entity.get('aliases', {}).get(language, []):
+                        keys.add(normalize_label(alias['value']))
+                for key in keys:
+                    if key:
+                        key_records.append([key, -len(sitelinks), qid])
+                if len(key_records) >= run_size:
+                    key_runs.extend(_sorted_runs(key_records, run_size, key_dir))
+                    key_records.clear()
+
+                yield [qid,
+                       len(sitelinks),
+                       entity.get('labels', {}).get('en', {}).get('value', ''),
+                       entity.get('descriptions', {}).get('en', {}).get('value', ''),
+                       sitelinks.get('enwiki', {}).get('title', '')]
+
+        entity_runs = _sorted_runs(entity_records(), run_size, entity_dir)
+        key_runs.extend(_sorted_runs(key_records, run_size, key_dir))
+
+        entities_path = os.path.join(tmp, 'entities.bin')
+        keys_path = os.path.join(tmp, 'keys.bin')
+        strings_path = os.path.join(tmp, 'strings.bin')
+        n_entities = 0
+        n_keys = 0
+        with open(entities_path, 'wb') as entities_file, open(keys_path, 'wb') as keys_file, \
+                open(strings_path, 'wb') as strings_file:
+            strings = _StringWriter(strings_file)
+
+            last_qid = None
+            for qid, sitelinks, label, description, title in _merge_runs(entity_runs):
+                if qid == last_qid:
+                    continue
+                last_qid = qid
+                entities_file.write(ENTITY.pack(qid, sitelinks, *strings.add(label), *strings.add(description),
+                                                *strings.add(title)))
+                n_entities += 1
+
+            last_key = None
+            key_location = None
+            for key, negative_sitelinks, qid in _merge_runs(key_runs):
+                if key != last_key:
+                    key_location = strings.add(key)
+                    last_key = key
+                keys_file.write(KEY.pack(*key_location, qid, -negative_sitelinks))
+                n_keys += 1
+
+        entities_offset = HEADER.size
+        keys_offset = entities_offset + n_entities * ENTITY.size
+        strings_offset = keys_offset + n_keys * KEY.size
+        with open(index_path, 'wb') as index_file:
+            index_file.write(HEADER.pack(MAGIC, n_entities, n_keys, entities_offset, keys_offset, strings_offset))
+            for path in (entities_path, keys_path, strings_path):
+                with open(path, 'rb') as part:
+                    shutil.copyfileobj(part, index_file)
+
+    return n_entities, n_keys
+
+
+class LabelIndex:
+    """
+    Read-only, memory-mapped view of an index built by build_index.
+
+    Args:
+        path (str): The index file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_entities, self.n_keys, self.entities_offset, self.keys_offset, self.strings_offset = \
+            HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a wikidata label index')
+
+    def _string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length]
+
+    def _key(self, i):
+        key_offset, key_length, qid, sitelinks = KEY.unpack_from(self.data, self.keys_offset + i * KEY.size)
+        return self._string(key_offset, key_length), qid, sitelinks
+
+    def _lower_bound(self, key):
+        low, high = 0, self.n_keys
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, label, limit=10):
+        """
+        Exact lookup of a normalized label or alias.
+
+        Returns:
+            list: (QID, sitelinks) tuples, most sitelinks first.
+        """
+        key = normalize_label(label).encode('utf-8')
+        results = []
+        i = self._lower_bound(key)
+        while i < self.n_keys and len(results) < limit:
+            found, qid, sitelinks = self._key(i)
+            if found != key:
+                break
+            results.append((f'Q{qid}', sitelinks))
+            i += 1
+        return results
+
+    def prefix_lookup(self, prefix, limit=10, max_scan=10000):
+        """
+        Lookup of all labels and aliases starting with prefix.
+
+        Args:
+            prefix (str): The (unnormalized) prefix.
+            limit (int): Maximum number of results.
+            max_scan (int): Maximum number of keys that are looked at.
+
+        Returns:
+            list: (QID, sitelinks) tuples of distinct items, most sitelinks first.
+        """
+        key = normalize_label(prefix).encode('utf-8')
+        best = dict()
+        i = self._lower_bound(key)
+        end = min(self.n_keys, i + max_scan)
+        while i < end:
+            found, qid, sitelinks = self._key(i)
+            if not found.startswith(key):
+                break
+            best[qid] = sitelinks
+            i += 1
+        ranked = sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(f'Q{qid}', sitelinks) for qid, sitelinks in ranked]
+
+    def entity(self, entity_id):
+        """
+        Returns the stored information of an item in the same format as entity_extractor.summarize_entity, or None.
+        """
+        if not entity_id.startswith('Q') or not entity_id[1:].isdigit():
+            return None
+        qid = int(entity_id[1:])
+        low, high = 0, self.n_entities
+        while low < high:
+            middle = (low + high) // 2
+            row = ENTITY.unpack_from(self.data, self.entities_offset + middle * ENTITY.size)
+            if row[0] < qid:
+                low = middle + 1
+            elif row[0] > qid:
+                high = middle
+            else:
+                _, sitelinks, label_offset, label_length, description_offset, description_length, title_offset, title_length = row
+                label = self._string(label_offset, label_length).decode('utf-8') or 'No label available'
+                description = self._string(description_offset, description_length).decode('utf-8') or 'No description available'
+                title = self._string(title_offset, title_length).decode('utf-8')
+                url = 'https://en.wikipedia.org/wiki/' + title.replace(' ', '_') if title else ''
+                return {'label': label, 'description': description, 'sitelinks': sitelinks, 'url': url}
+        return None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query an offline wikidata label index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='build an index from a (bz2/gz) wikidata JSON dump')
+    build.add_argument('dump')
+    build.add_argument('index')
+    build.add_argument('--languages', nargs='+', default=['en'])
+    build.add_argument('--min-sitelinks', type=int, default=0)
+    build.add_argument('--run-size', type=int, default=500000)
+
+    lookup = subparsers.add_parser('lookup', help='look up a label in an index')
+    lookup.add_argument('index')
+    lookup.add_argument('label')
+    lookup.add_argument('--prefix', action='store_true')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        n_entities, n_keys = build_index(args.dump, args.index, languages=tuple(args.languages),
+                                         min_sitelinks=args.min_sitelinks, run_size=args.run_size)
+        print(f'Indexed {n_entities} entities under {n_keys} labels.')
+    else:
+        index = LabelIndex(args.index)
+        results = index.prefix_lookup(args.label) if args.prefix else index.lookup(args.label)
+        for entity_id, sitelinks in results:
+            print(entity_id, sitelinks, index.entity(entity_id))
+
+
+if __name__ == '__main__':
+    main()
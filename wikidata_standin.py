@@ -0,0 +1,310 @@
+import argparse
+import bisect
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from wikidata_index import iter_dump_entities, normalize_label
+
+ASK_PATTERN = re.compile(r'wd:(Q\d+)\s+wdt:(P\d+)\s+wd:(Q\d+)')
+ENTITY_URI = 'http://www.wikidata.org/entity/'
+PROPERTY_URI = 'http://www.wikidata.org/prop/direct/'
+
+
+class WikidataStandIn:
+    """
+    Local stand-in for the parts of the wikidata API and SPARQL endpoint the pipeline uses, serving
+    entities in the JSON dump format (wbsearchentities, wbgetentities, ASK queries and SELECT queries with a
+    VALUES block of statements).
+
+    Point the pipeline at it with the WIKIDATA_API_URL and WIKIDATA_SPARQL_URL environment variables
+    (api_url and sparql_url).
+
+    Args:
+        entities (iterable): Dump style entities (id, labels, descriptions, aliases, sitelinks, claims).
+        latency (float): Seconds every response is delayed, to simulate the network.
+    """
+
+    def __init__(self, entities, latency=0.0):
+        self.entities = {entity['id']: entity for entity in entities}
+        self.latency = latency
+        self.statements = set()
+        names = dict()
+        for entity_id, entity in self.entities.items():
+            labels = [entity.get('labels', {}).get('en', {}).get('value', '')]
+            labels += [alias['value'] for alias in entity.get('aliases', {}).get('en', [])]
+            for label in labels:
+                if label:
+                    names.setdefault(normalize_label(label), set()).add(entity_id)
+            for property_id, claims in entity.get('claims', {}).items():
+                for claim in claims:
+                    value = claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+                    if isinstance(value, dict) and 'numeric-id' in value:
+                        self.statements.add((entity_id, property_id, f"Q{value['numeric-id']}"))
+        self.keys = sorted(names)
+        self.names = {key: sorted(ids, key=lambda i: (-len(self.entities[i].get('sitelinks', {})), i))
+                      for key, ids in names.items()}
+
+        self.counts = dict()
+        self.lock = threading.Lock()
+        self.server = None
+
+    @classmethod
+    def from_dump(cls, path, **kwargs):
+        return cls(iter_dump_entities(path), **kwargs)
+
+    def search(self, text, search_type='item', limit=7):
+        """
+        wbsearchentities: exact label/alias matches first, then prefix matches, most sitelinks first.
+        """
+        key = normalize_label(text)
+        prefix = 'P' if search_type == 'property' else 'Q'
+        found = list(self.names.get(key, []))
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i].startswith(key) and len(found) < 10 * limit:
+            found.extend(entity_id for entity_id in self.names[self.keys[i]] if entity_id not in found)
+            i += 1
+        results = []
+        for entity_id in found:
+            if entity_id.startswith(prefix):
+                entity = self.entities[entity_id]
+                results.append({'id': entity_id,
+                                'label': entity.get('labels', {}).get('en', {}).get('value', ''),
+                                'description': entity.get('descriptions', {}).get('en', {}).get('value', '')})
+        return results[:limit]
+
+    def get_entities(self, ids):
+        """
+        wbgetentities: unknown ids are returned as missing.
+        """
+        entities = dict()
+        for entity_id in ids:
+            entity = self.entities.get(entity_id)
+            if entity is None:
+                entities[entity_id] = {'id': entity_id, 'missing': ''}
+            else:
+                entities[entity_id] = {'id': entity_id, 'labels': entity.get('labels', {}),
+                                       'descriptions': entity.get('descriptions', {}),
+                                       'claims': entity.get('claims', {}), 'sitelinks': entity.get('sitelinks', {})}
+        return {'entities': entities, 'success': 1}
+
+    def ask(self, query):
+        """
+        ASK queries made of wd:Q wdt:P wd:Q statements, true if all statements exist.
+        """
+        statements = ASK_PATTERN.findall(query)
+        return {'head': {}, 'boolean': bool(statements) and all(s in self.statements for s in statements)}
+
+    def select_values(self, query):
+        """
+        SELECT queries that list wd:Q wdt:P wd:Q statements in a VALUES block, the existing ones are returned
+        as ?s ?p ?o bindings.
+        """
+        statements = dict.fromkeys(ASK_PATTERN.findall(query))
+        bindings = [{'s': {'type': 'uri', 'value': ENTITY_URI + s},
+                     'p': {'type': 'uri', 'value': PROPERTY_URI + p},
+                     'o': {'type': 'uri', 'value': ENTITY_URI + o}}
+                    for s, p, o in statements if (s, p, o) in self.statements]
+        return {'head': {'vars': ['s', 'p', 'o']}, 'results': {'bindings': bindings}}
+
+    def handle(self, path, params):
+        if 'query' in params:
+            if 'VALUES' in params['query']:
+                return 'sparql_values', self.select_values(params['query'])
+            return 'sparql', self.ask(params['query'])
+        action = params.get('action')
+        if action == 'wbsearchentities':
+            return action, {'search': self.search(params.get('search', ''), params.get('type', 'item'),
+                                                  int(params.get('limit', 7)))}
+        if action == 'wbgetentities':
+            return action, self.get_entities(params.get('ids', '').split('|'))
+        return 'unknown', {'error': {'code': 'badvalue', 'info': f'unsupported request {path}'}}
+
+    def _record(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of requests per kind ('wbsearchentities', 'wbgetentities', 'sparql', ...).
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def reset_stats(self):
+        with self.lock:
+            self.counts.clear()
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serves the stand-in from a background thread, port 0 picks a free port.
+        """
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                if standin.latency:
+                    time.sleep(standin.latency)
+                kind, body = standin.handle(parsed.path, params)
+                standin._record(kind)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return self.base_url + '/w/api.php'
+
+    @property
+    def sparql_url(self):
+        return self.base_url + '/sparql'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 've', 'to', 'su', 'ne', 'dor', 'lan', 'bel', 'mar', 'tis', 'ven', 'gal', 'ro']
+
+# properties of the synthetic world, with their real ids and labels so the property index resolves them
+CAPITAL = 'P36'
+CAPITAL_OF = 'P1376'
+COUNTRY = 'P17'
+
+
+def _item(entity_id, label, description, sitelinks, claims=None):
+    return {'type': 'item', 'id': entity_id,
+            'labels': {'en': {'language': 'en', 'value': label}},
+            'descriptions': {'en': {'language': 'en', 'value': description}},
+            'aliases': {},
+            'sitelinks': {f'site{i}wiki': {'title': label} for i in range(sitelinks - 1)} |
+                         ({'enwiki': {'title': label}} if sitelinks else {}),
+            'claims': {property_id: [{'rank': 'normal', 'mainsnak': {
+                'snaktype': 'value', 'datavalue': {'value': {'entity-type': 'item', 'numeric-id': int(value[1:])}}}}
+                for value in values] for property_id, values in (claims or {}).items()}}
+
+
+def _name(rng, used):
+    while True:
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+        if name not in used:
+            used.add(name)
+            return name
+
+
+def synthetic_world(n_countries=50, seed=0):
+    """
+    Builds a made-up world of countries with a capital and a few other cities each.
+
+    Returns:
+        tuple: (entities in dump format, countries) where countries is a list of
+        (country id, country name, capital id, capital name, [(city id, city name)]) tuples.
+    """
+    rng = random.Random(seed)
+    used = set()
+    entities = [{'type': 'property', 'id': CAPITAL, 'labels': {'en': {'language': 'en', 'value': 'capital'}}},
+                {'type': 'property', 'id': CAPITAL_OF, 'labels': {'en': {'language': 'en', 'value': 'capital of'}}},
+                {'type': 'property', 'id': COUNTRY, 'labels': {'en': {'language': 'en', 'value': 'country'}}}]
+    countries = []
+    next_id = 900000000
+    for _ in range(n_countries):
+        country_id = f'Q{next_id}'
+        country_name = _name(rng, used)
+        cities = []
+        for i in range(3):
+            cities.append((f'Q{next_id + 1 + i}', _name(rng, used)))
+        next_id += 10
+        capital_id, capital_name = cities[0]
+        entities.append(_item(country_id, country_name, 'sovereign state', rng.randint(20, 200),
+                              {CAPITAL: [capital_id]}))
+        for i, (city_id, city_name) in enumerate(cities):
+            claims = {COUNTRY: [country_id]}
+            if i == 0:
+                claims[CAPITAL_OF] = [country_id]
+            entities.append(_item(city_id, city_name, f'city in {country_name}', rng.randint(5, 80), claims))
+        countries.append((country_id, country_name, capital_id, capital_name, cities[1:]))
+    return entities, countries
+
+
+def synthetic_questions(countries, n_questions, seed=0):
+    """
+    Makes yes/no and entity questions about the synthetic world, with a recorded llm answer that is
+    right or wrong and the expected correctness of that answer.
+
+    Returns:
+        list: (q_id, question, answer, expected) tuples, expected is 'correct' or 'incorrect'.
+    """
+    rng = random.Random(seed)
+    questions = []
+    #the llm stub answers by question text, so a question that comes up again gets the same answer
+    answered = dict()
+    for i in range(n_questions):
+        _, country, _, capital, cities = rng.choice(countries)
+        other_city = rng.choice(cities)[1]
+        q_id = f'question-{i + 1:06d}'
+        kind = rng.random()
+        if kind < 0.5:
+            #yes/no question about a true or a false statement, answered right or wrong
+            true_statement = rng.random() < 0.5
+            city = capital if true_statement else other_city
+            says_yes = rng.random() < 0.7
+            answer = f'Yes, {city} is the capital of {country}.' if says_yes else f'No, {city} is not the capital of {country}.'
+            question = f'Is {city} the capital of {country}?'
+            expected = 'correct' if says_yes == true_statement else 'incorrect'
+        else:
+            right = rng.random() < 0.7
+            city = capital if right else other_city
+            question = f'What is the capital of {country}?'
+            answer = f'{city}. It is a city in {country}.'
+            expected = 'correct' if right else 'incorrect'
+        answer, expected = answered.setdefault(question, (answer, expected))
+        questions.append((q_id, question, answer, expected))
+    return questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the wikidata API and SPARQL endpoint.')
+    parser.add_argument('--dump', help='JSON dump (subset) with the entities to serve, a synthetic world otherwise')
+    parser.add_argument('--countries', type=int, default=50, help='size of the synthetic world')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed')
+    args = parser.parse_args()
+
+    entities = iter_dump_entities(args.dump) if args.dump else synthetic_world(args.countries)[0]
+    standin = WikidataStandIn(entities, latency=args.latency).start(port=args.port)
+    print(f'WIKIDATA_API_URL={standin.api_url} WIKIDATA_SPARQL_URL={standin.sparql_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()